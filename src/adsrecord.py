@@ -45,7 +45,7 @@ class AdsRecord(object):
         return True
 
     def persist(self):
-        with self.eyeball.conn.cursor() as curs:
+        with self.eyeball.cursor() as curs:
             if not self.relationship.id:
                 self.relationship.persist(cursor=curs)
             if not self.adstxt.id:
@@ -94,7 +94,7 @@ class AdsRecord(object):
         if not account_type:
             all_account_types = True
         result = []
-        with cls.eyeball.conn.cursor() as curs:
+        with cls.eyeball.cursor(server_side=True) as curs:
             curs.execute('''SELECT destination, account_id, account_type, source,
                                    certification_authority_id, adstxt, id
                             FROM adsrecord_overview WHERE
@@ -104,7 +104,7 @@ class AdsRecord(object):
                             (account_type = %s OR %s)
                             ''', (aid, all_aids, domain, all_domains, account_id, all_account_ids,
                                   account_type, all_account_types))
-            for row in curs.fetchall():
+            for row in curs:
                 result.append(cls(*row))
         return result
 
@@ -3,19 +3,21 @@
 import logging
 from urllib.parse import urlparse
 
-import validators
-
-from utils import path_to_url, snarf_file
+from domains import is_domain
+from query import where
+from store import mirror, snarf_file
+from utils import path_to_url
 
 class AdsTxt(object):
     eyeball = None
 
-    def __init__(self, domain, fulltext='', created=None, modified=None, aid=None):
+    def __init__(self, domain, fulltext='', created=None, modified=None, aid=None, content_hash=None):
         self.id = aid
         self.domain = domain
         self.fulltext = fulltext
         self.created = created
         self.modified = modified
+        self.content_hash = content_hash
 
     def __repr__(self):
         return "ads.txt file from %s" % self.domain
@@ -37,14 +39,14 @@ class AdsTxt(object):
 
     def _persist(self, curs):
         if self.id is not None:
-            curs.execute('''UPDATE adstxt SET domain = %s, fulltext = %s
+            curs.execute('''UPDATE adstxt SET domain = %s, fulltext = %s, content_hash = %s
                             WHERE id = %s''',
-                (self.domain, self.fulltext, self.id))
+                (self.domain, self.fulltext, self.content_hash, self.id))
         else:
-            curs.execute('''INSERT INTO adstxt (domain, fulltext)
-                            VALUES (%s, %s)
+            curs.execute('''INSERT INTO adstxt (domain, fulltext, content_hash)
+                            VALUES (%s, %s, %s)
                             RETURNING id, created, modified''',
-                (self.domain, self.fulltext))
+                (self.domain, self.fulltext, self.content_hash))
             (self.id, self.created, self.modified) = curs.fetchone()
         logging.debug("persisted %s" % self)
 
@@ -56,7 +58,7 @@ class AdsTxt(object):
                 self._persist(cursor)
                 return self
             else:
-                with self.eyeball.conn.cursor() as curs:
+                with self.eyeball.cursor() as curs:
                     conn = curs.connection
                     self._persist(curs)
                     conn.commit()
@@ -66,88 +68,105 @@ class AdsTxt(object):
             conn.rollback()
             return None
 
+    @classmethod
+    def parse_lines(cls, entry, url):
+        "Valid relationships from the text of a mirrored ads.txt file, headers and all."
+        in_headers = True
+        lineno = 0
+        rels = []
+        for line in entry.fulltext.splitlines():
+            if not line: # out of headers with 1st blank line
+                in_headers=False
+            if in_headers:
+                continue
+            lineno += 1
+            if '#' in line:
+                (stuff, comment) = line.split('#', 1)
+                line = stuff
+            try:
+                line = line.strip()
+                if line.startswith('<'):
+                    logging.info("%s looks like HTML. Skipping." % url)
+                    logging.info(line)
+                    break
+                fields = line.split(',', 3)
+                for i in range(len(fields)):
+                    fields[i] = fields[i].strip()
+                (domain, account_id, account_type,
+                 certification_authority_id) = (None, None, None, None)
+                if len(fields) == 4:
+                    (domain, account_id, account_type, certification_authority_id) = fields
+                elif len(fields) == 3:
+                    (domain, account_id, account_type) = fields
+                else: # Line is all comments or whitespace
+                    continue
+                rel = cls.eyeball.relationship(entry.domain, domain, account_id, adstxt=entry,
+                                               account_type=account_type,
+                                               certification_authority_id=certification_authority_id)
+                if rel.is_valid:
+                    rels.append(rel)
+                else:
+                    logging.info('-------------------------------------------------------------------------------')
+                    logging.info("Error on line %d of %s" % (lineno, url))
+                    logging.info(line)
+                    for err in rel.validation_errors():
+                        logging.info(" -  %s" % err)
+                    logging.info('-------------------------------------------------------------------------------')
+            except Exception as e:
+                logging.error("Failed to parse %s: %s" % (url, e))
+                raise
+        return rels
+
     @classmethod
     def parse_file(cls, url):
         seen = {}
         domain = urlparse(url).netloc
         if ':' in domain:
             domain = domain.split(':')[0]
-        if not validators.domain(domain):
+        if not is_domain(domain):
             logging.info("Skipping % - not a domain." % domain)
             return False
+        content_hash = mirror.content_hash(url, 'ads')
+        if cls.is_parsed(domain, content_hash):
+            logging.info("%s unchanged since last parsed." % url)
+            return
         fulltext = snarf_file(url, 'ads')
-        entry = cls(domain, fulltext)
-        in_headers = True
-        lineno = 0
-        with cls.eyeball.conn.cursor() as curs:
+        entry = cls(domain, fulltext, content_hash=content_hash)
+        with cls.eyeball.cursor() as curs:
             if not entry.persist(cursor=curs):
                 return False    
-            for line in fulltext.splitlines():
-                if not line: # out of headers with 1st blank line
-                    in_headers=False
-                if in_headers:
-                    continue
-                lineno += 1
-                if '#' in line:
-                    (stuff, comment) = line.split('#', 1)
-                    line = stuff
-                try:
-                    line = line.strip()
-                    if line.startswith('<'):
-                        logging.info("%s looks like HTML. Skipping." % url)
-                        logging.info(line)
-                        break
-                    fields = line.split(',', 3)
-                    for i in range(len(fields)):
-                        fields[i] = fields[i].strip()
-                    (domain, account_id, account_type,
-                     certification_authority_id) = (None, None, None, None)
-                    if len(fields) == 4:
-                        (domain, account_id, account_type, certification_authority_id) = fields
-                    elif len(fields) == 3:
-                        (domain, account_id, account_type) = fields
-                    else: # Line is all comments or whitespace
-                        continue
-                    rel = cls.eyeball.relationship.lookup_or_new(source=entry.domain,
-                                                                 destination=domain,
-                                                                 account_id=account_id,
-                                                                 cursor=curs)
-                    rel.account_type = account_type.upper()
-                    rel.adstxt = entry
-                    rel.certification_authority_id = certification_authority_id
-                    if rel.is_valid:
-                        rel.persist(cursor=curs)
-                        seen[rel.destination]=1
-                    else:
-                        logging.info('-------------------------------------------------------------------------------')
-                        logging.info("Error on line %d of %s" % (lineno, url))
-                        logging.info(line)
-                        for err in rel.validation_errors():
-                            logging.info(" -  %s" % err)
-                        logging.info('-------------------------------------------------------------------------------')
-                except Exception as e:
-                    logging.error("Failed to parse %s: %s" % (url, e))
-                    raise
+            rels = cls.parse_lines(entry, url)
+            for rel in rels:
+                seen[rel.destination]=1
+            loader = cls.eyeball.ingest.loader(curs, 'adstxt', entry.domain)
+            loader.relationships(rels)
+            loader.finish()
+            if cls.eyeball.jobs.enabled:
+                cls.eyeball.jobs.enqueue(seen.keys(), 'sellers', cursor=curs)
             curs.connection.commit()
-            cls.eyeball.sellers.parse_list(seen.keys())
+        return list(seen.keys())
 
     @classmethod
     def lookup_all(cls, aid=None, domain=None):
-        (all_aids, all_domains) = (False, False)
-        if not aid:
-            all_aids = True
-        if not domain:
-            all_domains = True
+        (clause, params) = where((('id', aid or None), ('domain', domain or None)))
         result = []
-        with cls.eyeball.conn.cursor() as curs:
-            curs.execute('''SELECT domain, fulltext, created, modified, id FROM adstxt WHERE
-                            (id = %s OR %s) AND
-                            (domain = %s OR %s) 
-                            ''', (aid, all_aids, domain, all_domains))
-            for row in curs.fetchall():
+        # with no arguments this is every file, so read it a batch at a time
+        with cls.eyeball.cursor(server_side=not clause) as curs:
+            curs.execute('''SELECT domain, fulltext, created, modified, id, content_hash FROM adstxt
+                            %s''' % clause, params)
+            for row in curs:
                 result.append(cls(*row))
         return result
 
+    @classmethod
+    def is_parsed(cls, domain, content_hash):
+        "Is this the content of the last file parsed for domain?"
+        with cls.eyeball.cursor() as curs:
+            curs.execute('''SELECT content_hash FROM adstxt WHERE domain = %s ORDER BY id DESC LIMIT 1''',
+                         (domain,))
+            row = curs.fetchone()
+            return row is not None and row[0] == content_hash
+
     @classmethod
     def lookup_one(cls, aid=None, domain=None):
         tmp = list(cls.lookup_all(aid, domain))
@@ -157,29 +176,13 @@ class AdsTxt(object):
             return None
 
     @classmethod
-    def parse_all(cls, max=0):
-        count = 0
-        for domain in cls.eyeball.relationship.all_sources():
-            if cls.lookup_all(domain=domain):
-                logging.info("https://%s/ads.txt already parsed." % domain)
-                continue
-            try:
-                cls.parse_file('https://%s/ads.txt' % domain)
-                count += 1
-                if count == max:
-                    return
-            except FileNotFoundError:
-                pass
+    def parse_all(cls, max=0, since=None):
+        "Parse the ads.txt file of every known source, and whatever that leads to."
+        return cls.eyeball.frontier.explore(list(cls.eyeball.relationship.all_sources()), 'ads', max, since)
 
     @classmethod
     def parse_list(cls, todo):
-        for domain in todo:
-            if cls.lookup_all(domain=domain):
-                continue
-            try:
-                cls.parse_file('https://%s/ads.txt' % domain)
-            except:
-                pass
+        return cls.eyeball.frontier.explore(todo, 'ads')
 
 
 # vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+# Whole-graph numbers for every domain, worked out in one batch run over
+# the relationship graph (see graph.py) with SciPy sparse matrices instead
+# of a query or a Python loop per domain:
+#
+#  - the weakly connected component it is in, numbered by size, 0 largest
+#  - PageRank over the direction inventory is sold in, so the ad systems
+#    and intermediaries that the most inventory flows through rank highest
+#  - in and out degree, the domains that sell through it and that it
+#    sells through
+#  - chain depth, the most hops it takes to get to it on a supply chain
+#    that starts with a DIRECT relationship and goes on through RESELLER
+#    ones. Chains are followed a hop at a time, as one sparse matrix
+#    product per hop, and a domain on a loop of resellers only counts up
+#    to MAX_CHAIN_DEPTH.
+#
+# Results replace the domain_rank and graph_component tables in one
+# transaction, so the web pages see either the old run or the new one.
+# Run this file from cron, every few hours is plenty.
+
+import logging
+import time
+from io import StringIO
+
+import numpy as np
+from scipy.sparse import csr_matrix, diags
+from scipy.sparse.csgraph import connected_components
+
+import config
+from graph import Adjacency, DIRECT, RESELLER
+from query import RANK_ORDERS
+
+PAGERANK_DAMPING = getattr(config, 'PAGERANK_DAMPING', 0.85)
+PAGERANK_TOLERANCE = 1e-6   # total change in rank to stop iterating at
+PAGERANK_MAX_ITERATIONS = 100
+MAX_CHAIN_DEPTH = getattr(config, 'MAX_CHAIN_DEPTH', 10)
+
+def components(matrix):
+    "Weakly connected component of each node, numbered by size, and the size of each component."
+    (count, labels) = connected_components(matrix, directed=True, connection='weak')
+    sizes = np.bincount(labels, minlength=count)
+    renumber = np.empty(count, dtype=np.int32)
+    renumber[np.argsort(-sizes, kind='mergesort')] = np.arange(count, dtype=np.int32)
+    return (renumber[labels], np.sort(sizes)[::-1])
+
+def pagerank(matrix, damping=PAGERANK_DAMPING):
+    "PageRank of each node of a matrix with a 1 for each link from row to column, adding up to 1."
+    count = matrix.shape[0]
+    out_degree = np.asarray(matrix.sum(axis=1)).ravel()
+    dangling = out_degree == 0
+    # each node's rank is shared out among the nodes it links to
+    spread = diags(1.0 / np.maximum(out_degree, 1)).dot(matrix).T.tocsr()
+    rank = np.full(count, 1.0 / count)
+    for step in range(PAGERANK_MAX_ITERATIONS):
+        before = rank
+        rank = damping * spread.dot(rank)
+        rank += (damping * before[dangling].sum() + 1.0 - damping) / count
+        if np.abs(rank - before).sum() < PAGERANK_TOLERANCE:
+            break
+    return rank
+
+def chain_depth(count, heads, tails, roles, max_depth=MAX_CHAIN_DEPTH):
+    "Most hops from a DIRECT relationship on through RESELLER ones to each node, 0 if there are none."
+    depth = np.zeros(count, dtype=np.int32)
+    direct = (roles & DIRECT) != 0
+    reached = np.zeros(count, dtype=bool)
+    reached[tails[direct]] = True
+    resold = (roles & RESELLER) != 0
+    onward = csr_matrix((np.ones(resold.sum()), (tails[resold], heads[resold])), shape=(count, count))
+    hops = 1
+    while reached.any() and hops <= max_depth:
+        depth[reached] = hops
+        reached = onward.dot(reached.astype(np.float64)) > 0
+        hops += 1
+    return depth
+
+
+class Analytics(object):
+    eyeball = None
+
+    @classmethod
+    def compute(cls, graph):
+        "The numbers for every domain in a loaded RelationshipGraph, as a dict of arrays by node id."
+        count = len(graph.names)
+        # one link for each pair of domains, however many accounts there are between them
+        adjacency = Adjacency(graph.head, graph.tail, count)
+        matrix = csr_matrix((np.ones(len(adjacency.indices)), adjacency.indices, adjacency.indptr),
+                            shape=(count, count))
+        (component, sizes) = components(matrix)
+        return {'component': component, 'component_sizes': sizes,
+                'pagerank': pagerank(matrix),
+                'in_degree': np.bincount(adjacency.indices, minlength=count),
+                'out_degree': np.diff(adjacency.indptr),
+                'chain_depth': chain_depth(count, graph.head, graph.tail, graph.role)}
+
+    @classmethod
+    def run(cls):
+        "Load the whole relationship graph, work out the numbers and store them."
+        started = time.time()
+        graph = cls.eyeball.graph().load()
+        if not graph.names:
+            logging.info("No relationships to analyze")
+            return None
+        results = cls.compute(graph)
+        logging.info("Analyzed %d domain(s), %d relationship(s) in %.1fs" %
+                     (len(graph.names), len(graph.edge_id), time.time() - started))
+        cls.store(graph, results)
+        return results
+
+    @classmethod
+    def store(cls, graph, results):
+        rows = StringIO()
+        for (i, name) in enumerate(graph.names):
+            rows.write('%s\t%d\t%.9g\t%d\t%d\t%d\n' % (
+                name.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n'),
+                results['component'][i], results['pagerank'][i], results['in_degree'][i],
+                results['out_degree'][i], results['chain_depth'][i]))
+        rows.seek(0)
+        # the best ranked domain in each component, to name it by: the last of each in rank order
+        (component, count) = (results['component'], len(results['component_sizes']))
+        order = np.lexsort((results['pagerank'], component))
+        best = order[np.searchsorted(component[order], np.arange(count), side='right') - 1]
+        with cls.eyeball.cursor() as curs:
+            # only one run writes at a time; readers are not blocked
+            curs.execute('LOCK TABLE domain_rank, graph_component IN SHARE ROW EXCLUSIVE MODE')
+            curs.execute('DELETE FROM domain_rank')
+            curs.execute('DELETE FROM graph_component')
+            curs.copy_expert('''COPY domain_rank
+                                (name, component, pagerank, in_degree, out_degree, chain_depth)
+                                FROM STDIN''', rows)
+            curs.execute('''INSERT INTO graph_component (id, size, name)
+                            SELECT * FROM unnest(%s::INT[], %s::INT[], %s::TEXT[])''',
+                         (list(range(len(best))), [int(size) for size in results['component_sizes']],
+                          [graph.names[i] for i in best]))
+            curs.execute('''UPDATE analytics_state SET computed = NOW(), domains = %s, relationships = %s,
+                            max_chain_depth = %s''',
+                         (len(graph.names), len(graph.edge_id), int(results['chain_depth'].max())))
+            cls.eyeball.cache.bump(curs)
+            curs.connection.commit()
+        logging.info("Stored analytics for %d domain(s) in %d component(s)" %
+                     (len(graph.names), len(best)))
+
+    @classmethod
+    def lookup(cls, domain):
+        "The stored numbers for a domain, as a dict, or None if it was not in the last run."
+        with cls.eyeball.cursor() as curs:
+            curs.execute('''SELECT row_to_json(r) FROM
+                            (SELECT domain_rank.*, graph_component.size AS component_size,
+                             graph_component.name AS component_name
+                             FROM domain_rank JOIN graph_component ON graph_component.id = component
+                             WHERE domain_rank.name = %s) r''', (domain,))
+            row = curs.fetchone()
+            curs.connection.commit()
+        return row[0] if row else None
+
+    @classmethod
+    def top(cls, order='pagerank', limit=50, min_depth=0):
+        "The domains with the highest of one of the RANK_ORDERS, as dicts."
+        if order not in RANK_ORDERS:
+            raise ValueError("Unknown order %s" % order)
+        with cls.eyeball.cursor() as curs:
+            curs.execute('''SELECT COALESCE(json_agg(r ORDER BY r.%s DESC, r.name), '[]') FROM
+                            (SELECT * FROM domain_rank WHERE chain_depth >= %%s
+                             ORDER BY %s DESC, name LIMIT %%s) r''' % (order, order), (min_depth, limit))
+            found = curs.fetchone()[0]
+            curs.execute('SELECT row_to_json(analytics_state) FROM analytics_state')
+            state = curs.fetchone()[0]
+            curs.connection.commit()
+        return {'computed': state['computed'], 'order': order, 'domains': found}
+
+
+if __name__ == "__main__":
+    from eyeball import Eyeball
+    logging.basicConfig(level=logging.INFO)
+    e = Eyeball()
+    e.analytics.run()
+
+# vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
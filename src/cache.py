@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# Response caching for the web pages. Everything they show comes from
+# parsed files, so it only changes when parsers write. When they do, they
+# bump a generation number in the database (see strongset.py), and a
+# cached page is good for as long as the generation it was made in is the
+# current one. Each web process reads the generation at most every
+# GENERATION_CHECK seconds and keeps up to RESPONSE_CACHE_SIZE pages in
+# memory. With RESPONSE_CACHE_DIR set, pages are also kept there as files,
+# shared by all the processes on the host, in a directory for each
+# generation. The first page saved in a new generation removes the
+# directories of older ones. Each page has a strong ETag, the hash of its
+# body, for browsers and proxies to revalidate with.
+
+from collections import namedtuple, OrderedDict
+from hashlib import sha1
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import config
+
+RESPONSE_CACHE_SIZE = getattr(config, 'RESPONSE_CACHE_SIZE', 1000)
+RESPONSE_CACHE_DIR = getattr(config, 'RESPONSE_CACHE_DIR', None)
+RESPONSE_MAX_AGE = getattr(config, 'RESPONSE_MAX_AGE', 60)
+GENERATION_CHECK = 5  # seconds a process goes on trusting the generation it last read
+
+CachedResponse = namedtuple('CachedResponse', 'generation etag content_type body')
+
+class ResponseCache(object):
+    eyeball = None
+    lock = threading.Lock()
+    entries = OrderedDict()
+    (checked, current) = (0, None)
+
+    @staticmethod
+    def bump(curs):
+        "Note that the data changed, as part of the caller's transaction."
+        curs.execute('UPDATE data_generation SET generation = generation + 1')
+
+    @classmethod
+    def generation(cls):
+        now = time.time()
+        if cls.current is None or now - cls.checked > GENERATION_CHECK:
+            with cls.eyeball.cursor() as curs:
+                curs.execute('SELECT generation FROM data_generation')
+                cls.current = curs.fetchone()[0]
+                curs.connection.commit()
+            cls.checked = now
+        return cls.current
+
+    @staticmethod
+    def path(key, generation):
+        return os.path.join(RESPONSE_CACHE_DIR, str(generation), sha1(key.encode('utf-8')).hexdigest())
+
+    @staticmethod
+    def prune(generation):
+        "Remove the cached files of generations before this one."
+        for name in os.listdir(RESPONSE_CACHE_DIR):
+            if name.isdigit() and int(name) < generation:
+                shutil.rmtree(os.path.join(RESPONSE_CACHE_DIR, name), ignore_errors=True)
+
+    @classmethod
+    def load(cls, key, generation):
+        if not RESPONSE_CACHE_DIR:
+            return None
+        try:
+            with open(cls.path(key, generation), 'rb') as fd:
+                (generation, etag, content_type) = fd.readline().decode('utf-8').rstrip('\n').split('\t')
+                return CachedResponse(int(generation), etag, content_type, fd.read())
+        except (OSError, ValueError):
+            return None
+
+    @classmethod
+    def save(cls, key, entry):
+        if not RESPONSE_CACHE_DIR:
+            return
+        try:
+            directory = os.path.join(RESPONSE_CACHE_DIR, str(entry.generation))
+            if not os.path.isdir(directory):
+                os.makedirs(directory, exist_ok=True)
+                cls.prune(entry.generation)
+            (fd, tmpname) = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'wb') as fdout:
+                fdout.write(('%d\t%s\t%s\n' % (entry.generation, entry.etag, entry.content_type)).encode('utf-8'))
+                fdout.write(entry.body)
+            os.replace(tmpname, cls.path(key, entry.generation))
+        except OSError as e:
+            logging.warning("Failed to save cached response for %s: %s" % (key, e))
+
+    @classmethod
+    def get(cls, key, make, content_type='text/html; charset=utf-8'):
+        '''
+        The cached response for key, a CachedResponse. If there is none from the current
+        generation, make() is called for the body of a new one.
+        '''
+        generation = cls.generation()
+        with cls.lock:
+            found = cls.entries.get(key)
+        if found is None or found.generation != generation:
+            found = cls.load(key, generation)
+        if found is None or found.generation != generation:
+            body = make()
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            found = CachedResponse(generation, sha1(body).hexdigest(), content_type, body)
+            cls.save(key, found)
+        with cls.lock:
+            cls.entries[key] = found
+            cls.entries.move_to_end(key)
+            while len(cls.entries) > RESPONSE_CACHE_SIZE:
+                cls.entries.popitem(last=False)
+        return found
+
+
+# vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
@@ -1,98 +1,460 @@
 #!/usr/bin/env python3
 
-from email.utils import formatdate
-from http.client import RemoteDisconnected
+import asyncio
+import codecs
+from collections import OrderedDict
 import logging
 import multiprocessing
-import os
-import random 
 import sys
 from time import sleep, time
-from urllib.error import HTTPError, URLError
+from urllib.error import HTTPError
 from urllib.parse import urlparse
 from urllib.request import Request, urlopen
+import zlib
 
-from utils import spew_file, url_to_path, touch_file
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
-def crawl_wrap(domain, category):
-    c = Crawler()
-    c.mirror_domain(domain, category)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import config
+from hosts import CRAWL_HOST_DELAY, CRAWL_PER_HOST, HostLimiter, HostManager, classify
+from manifest import STATUS_HEADER
+from store import mirror
+
+CRAWL_CONCURRENCY = getattr(config, 'CRAWL_CONCURRENCY', 1000)
+CRAWL_TIMEOUT = getattr(config, 'CRAWL_TIMEOUT', 10)
+CRAWL_MAX_AGE = getattr(config, 'CRAWL_MAX_AGE', None)
+CRAWL_MAX_SIZE = getattr(config, 'CRAWL_MAX_SIZE', 256 * 1024 * 1024)
+CHUNK_SIZE = 65536
+CHARSET_PREFIX = 65536
+ACCEPT_ENCODING = 'gzip, deflate, br' if brotli else 'gzip, deflate'
+
+# Returned instead of True when a refresh found the mirrored copy still current.
+NOT_MODIFIED = 'not modified'
+
+def by_host(urls):
+    "(url, category) pairs in a list for each host, so a pool worker can take a whole host."
+    hosts = OrderedDict()
+    for (url, category) in urls:
+        hosts.setdefault(urlparse(url).hostname, []).append((url, category))
+    return list(hosts.values())
+
+def host_wrap(urls, max_age=None):
+    """
+    Mirror one host's (url, category) pairs, one at a time and CRAWL_HOST_DELAY seconds apart.
+    Returns the results in order and the host records for the parent to merge.
+    """
+    (results, started) = ([], None)
+    for (url, category) in urls:
+        if not Crawler.is_fresh(url, category, max_age):
+            if started is not None:
+                sleep(max(0, started + CRAWL_HOST_DELAY - time()))
+            started = time()
+        results.append(Crawler.mirror_url(url, category, max_age))
+    return (results, HostManager.drain())
+
+def domain_to_url(domain, category):
+    if "ads" == category:
+        return "https://%s/ads.txt" % domain
+    elif "sellers" == category:
+        return "https://%s/sellers.json" % domain
+    else:
+        raise NotImplementedError
+
+def request_headers(url, category):
+    "Headers for a fetch, conditional on the validators saved with any earlier copy."
+    headers = {'User-Agent': 'eyeball', 'Accept-Encoding': ACCEPT_ENCODING}
+    saved = mirror.headers(url, category)
+    if saved.get('etag'):
+        headers['If-None-Match'] = saved['etag']
+    if saved.get('last-modified'):
+        headers['If-Modified-Since'] = saved['last-modified']
+    return headers
+
+class TooLarge(Exception):
+    pass
+
+class BrotliDecompressor(object):
+    def __init__(self):
+        self.decompressor = brotli.Decompressor()
+
+    # brotli has no output limit, so the size cap is only checked after each chunk
+    unconsumed_tail = b''
+
+    def decompress(self, data, max_length=0):
+        # brotli and brotlipy spell this differently
+        if hasattr(self.decompressor, 'process'):
+            return self.decompressor.process(data)
+        return self.decompressor.decompress(data)
+
+    def flush(self):
+        return b''
+
+class DeflateDecompressor(object):
+    "Deflate as the RFC has it, with a zlib header, or raw, as some servers send it."
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        self.started = False
+
+    def decompress(self, data, max_length=0):
+        try:
+            result = self.decompressor.decompress(data, max_length)
+        except zlib.error:
+            if self.started:
+                raise
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            result = self.decompressor.decompress(data, max_length)
+        self.started = True
+        return result
+
+    @property
+    def unconsumed_tail(self):
+        return self.decompressor.unconsumed_tail
+
+    def flush(self):
+        return self.decompressor.flush()
+
+def decompressor(content_encoding):
+    content_encoding = (content_encoding or '').strip().lower()
+    if content_encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if 'deflate' == content_encoding:
+        return DeflateDecompressor()
+    if 'br' == content_encoding and brotli:
+        return BrotliDecompressor()
+    return None
+
+def known_charset(charset):
+    try:
+        codecs.lookup(charset)
+        return True
+    except (LookupError, TypeError):
+        return False
+
+class BodyDecoder(object):
+    """
+    Decompress and decode a response body one chunk at a time, writing text to out.
+    The charset is the first of the declared one, utf-8 and latin_1 that can decode
+    the first CHARSET_PREFIX bytes.
+    """
+
+    def __init__(self, out, charset=None, content_encoding=None, max_size=CRAWL_MAX_SIZE):
+        self.out = out
+        self.charsets = [c for c in (charset, 'utf-8', 'latin_1') if c and known_charset(c)]
+        self.decompressor = decompressor(content_encoding)
+        self.max_size = max_size
+        self.size = 0
+        self.prefix = b''
+        self.decoder = None
+
+    def write(self, chunk):
+        if not self.decompressor:
+            self._write(chunk)
+            return
+        # inflate no more than would go over max_size at a time
+        while chunk:
+            self._write(self.decompressor.decompress(chunk, self.max_size - self.size + 1
+                                                     if self.max_size else 0))
+            chunk = self.decompressor.unconsumed_tail
+
+    def _write(self, data):
+        self.size += len(data)
+        if self.max_size and self.size > self.max_size:
+            raise TooLarge("over %d bytes" % self.max_size)
+        if self.decoder is None:
+            self.prefix += data
+            if len(self.prefix) >= CHARSET_PREFIX:
+                self._start(False)
+        else:
+            self.out.write(self.decoder.decode(data))
+
+    def _start(self, final):
+        for charset in self.charsets:
+            try:
+                codecs.getincrementaldecoder(charset)().decode(self.prefix, final)
+                break
+            except UnicodeDecodeError:
+                pass
+        self.charset = charset
+        self.decoder = codecs.getincrementaldecoder(charset)(errors='replace')
+        self.out.write(self.decoder.decode(self.prefix))
+        self.prefix = b''
+
+    def close(self):
+        if self.decompressor:
+            self._write(self.decompressor.flush())
+        if self.decoder is None:
+            self._start(True)
+        self.out.write(self.decoder.decode(b'', True))
+
+def too_large(content_length, max_size=CRAWL_MAX_SIZE):
+    try:
+        return bool(max_size) and int(content_length) > max_size
+    except (TypeError, ValueError):
+        return False
 
 class Crawler(object):
     eyeball = None
 
-    @classmethod
-    def mirror_url(cls, url, category):
+    @staticmethod
+    def is_crawlable(url):
         tmp = urlparse(url)
         if not tmp or not tmp.hostname or not tmp.netloc or not tmp.scheme or not tmp.scheme.startswith('http'):
             logging.info("Skipping bad url %s" % url)
+            return False
+        return True
+
+    @staticmethod
+    def is_fresh(url, category, max_age=None):
+        "Is there a mirrored copy, and (if max_age is given) was it checked recently enough?"
+        try:
+            mtime = mirror.mtime(url, category)
+        except FileNotFoundError:
+            return False
+        if max_age is None:
+            return True
+        return time() - mtime < max_age
+
+    @classmethod
+    def mirror_url(cls, url, category, max_age=None):
+        "Fetch url unless already mirrored, or revalidate the copy if older than max_age seconds."
+        if not cls.is_crawlable(url):
             return
+        if cls.is_fresh(url, category, max_age):
+#            logging.info("Already mirrored: %s" % url)
+            return True
+        if HostManager.is_blocked(url):
+            logging.debug("Backing off: %s" % url)
+            return False
+        refresh = mirror.exists(url, category)
         try:
-            req = Request(url, headers={'User-Agent': 'eyeball'})
+            req = Request(url, headers=request_headers(url, category))
         except ValueError:
             logging.warning("Skipping unrequestable URL: %s" % url)
             return False
-        filename = url_to_path(url, category)
-        
-        # FIXME handle stale files and multiple versions
-        if os.path.exists(filename):
-#            logging.info("Already mirrored: %s at %s" % (url, filename))
-            return True
 
         try:
-            touch_file(filename)
-            res = urlopen(req, timeout=10)
-            encodings = (res.headers.get_content_charset(), 'utf-8', 'latin_1')
-            stuff = res.read()
-            headers = ''
-            for h in res.headers:
-                headers = headers + "%s: %s\n" % (h, res.getheader(h))
-            for encoding in encodings:
-                try:
-                    stuff = stuff.decode(encoding)
-                    break
-                except:
-                    pass
-            else:       
-                print("Failed to decode %s" % url)
-                return False
-            spew_file(filename, '\n'.join([headers, stuff]))
+            if not refresh:
+                mirror.touch(url, category)
+            res = urlopen(req, timeout=CRAWL_TIMEOUT)
+            if too_large(res.getheader('Content-Length')):
+                raise TooLarge("Content-Length %s" % res.getheader('Content-Length'))
+            headers = ''.join("%s: %s\n" % (h, res.getheader(h)) for h in res.headers)
+            headers += "%s: %d\n" % (STATUS_HEADER, res.status)
+            with mirror.writer(url, category, headers) as out:
+                body = BodyDecoder(out, res.headers.get_content_charset(), res.getheader('Content-Encoding'))
+                for chunk in iter(lambda: res.read(CHUNK_SIZE), b''):
+                    body.write(chunk)
+                body.close()
             logging.info("Mirrored: %s" % url)
+            HostManager.succeeded(url)
             return True
         except HTTPError as err:
             if err.code == 304:
                 logging.info("304 Not Modified: %s" % url)
-                return True
+                mirror.touch(url, category)
+                HostManager.succeeded(url)
+                return NOT_MODIFIED
             logging.warning("Failed %d fetching: %s" % (err.code, url))
-            touch_file(filename)
+            HostManager.failed(url, 'http', err.code)
+            if not refresh:
+                mirror.touch(url, category)
             return False
         except KeyboardInterrupt:
             raise
+        except TooLarge as e:
+            logging.warning("Too large (%s): %s" % (e, url))
+            HostManager.failed(url, 'size')
+            if not refresh:
+                mirror.touch(url, category)
+            return False
         except Exception as e:
             logging.warning("%s fetching %s" % (str(e), url))
-            touch_file(filename)
+            HostManager.failed(url, classify(e))
+            if not refresh:
+                mirror.touch(url, category)
             return False
 
     @classmethod
-    def mirror_domain(cls, domain, filetype="ads"):
-        if "ads" == filetype:
-            cls.mirror_url("https://%s/ads.txt" % domain, filetype)
-        elif "sellers" == filetype:
-            cls.mirror_url("https://%s/sellers.json" % domain, filetype)
-        else:
-            raise NotImplementedError
+    async def amirror_url(cls, session, url, category, max_age=None, limiter=None):
+        "Same as mirror_url, but on a shared aiohttp session so connections are reused."
+        if not cls.is_crawlable(url):
+            return
+        if cls.is_fresh(url, category, max_age):
+            return True
+        if HostManager.is_blocked(url):
+            logging.debug("Backing off: %s" % url)
+            return False
+        refresh = mirror.exists(url, category)
+        host = urlparse(url).hostname
+        if limiter is None:
+            limiter = HostLimiter()
+
+        try:
+            ip = await limiter.resolve(host)
+            async with limiter.slot(host, ip):
+                if not refresh:
+                    mirror.touch(url, category)
+                async with session.get(url, headers=request_headers(url, category)) as res:
+                    if res.status == 304:
+                        logging.info("304 Not Modified: %s" % url)
+                        mirror.touch(url, category)
+                        HostManager.succeeded(url)
+                        return NOT_MODIFIED
+                    if res.status >= 400:
+                        logging.warning("Failed %d fetching: %s" % (res.status, url))
+                        HostManager.failed(url, 'http', res.status)
+                        return False
+                    if too_large(res.headers.get('Content-Length')):
+                        raise TooLarge("Content-Length %s" % res.headers.get('Content-Length'))
+                    headers = ''.join("%s: %s\n" % h for h in res.headers.items())
+                    headers += "%s: %d\n" % (STATUS_HEADER, res.status)
+                    with mirror.writer(url, category, headers) as out:
+                        body = BodyDecoder(out, res.charset, res.headers.get('Content-Encoding'))
+                        async for chunk in res.content.iter_chunked(CHUNK_SIZE):
+                            body.write(chunk)
+                        body.close()
+                    logging.info("Mirrored: %s" % url)
+                    HostManager.succeeded(url)
+                    return True
+        except KeyboardInterrupt:
+            raise
+        except asyncio.CancelledError:
+            raise
+        except TooLarge as e:
+            logging.warning("Too large (%s): %s" % (e, url))
+            HostManager.failed(url, 'size')
+            return False
+        except asyncio.TimeoutError:
+            logging.warning("Timed out fetching %s" % url)
+            HostManager.failed(url, 'timeout')
+            return False
+        except Exception as e:
+            logging.warning("%s fetching %s" % (str(e), url))
+            HostManager.failed(url, classify(e))
+            return False
+
+    @classmethod
+    def mirror_domain(cls, domain, filetype="ads", max_age=None):
+        return cls.mirror_url(domain_to_url(domain, filetype), filetype, max_age)
+
+    @classmethod
+    def all_targets(cls):
+        for domain in cls.eyeball.relationship.all_sellers():
+            yield (domain, 'sellers')
+        for domain in cls.eyeball.relationship.all_sources():
+            yield (domain, 'ads')
+
+    @classmethod
+    def all_target_urls(cls):
+        for (domain, category) in cls.all_targets():
+            yield (domain_to_url(domain, category), category)
+
+    @classmethod
+    def mirror_all(cls, use_async=None, max_age=CRAWL_MAX_AGE):
+        """
+        Mirror every target. The pool of 4 processes gives each worker all of one host's URLs,
+        so it never has more than one request open to a host. CRAWL_PER_IP is only applied by
+        the asyncio crawler, which is the one that can have more than 4 requests open.
+        """
+        if use_async is None:
+            use_async = getattr(config, 'CRAWL_ASYNC', False)
+        if use_async:
+            return cls.mirror_all_async(max_age=max_age)
+        HostManager.load()
+        with multiprocessing.Pool(processes=4) as pool:
+            for urls in by_host(cls.all_target_urls()):
+                pool.apply_async(host_wrap, [urls, max_age],
+                                 callback=lambda outcome: HostManager.merge(outcome[1]))
+            pool.close()
+            pool.join()
+        HostManager.flush()
+
+    @classmethod
+    def mirror_all_async(cls, targets=None, concurrency=CRAWL_CONCURRENCY, max_age=CRAWL_MAX_AGE):
+        if targets is None:
+            targets = cls.all_targets()
+        urls = ((domain_to_url(domain, category), category) for (domain, category) in targets)
+        return cls.mirror_urls_async(urls, concurrency, max_age)
+
+    @classmethod
+    def mirror_urls_async(cls, urls, concurrency=CRAWL_CONCURRENCY, max_age=CRAWL_MAX_AGE):
+        "Mirror (url, category) pairs, return a dict of url to result."
+        if aiohttp is None:
+            raise RuntimeError("The asyncio crawler needs aiohttp installed.")
+        HostManager.load()
+        loop = asyncio.get_event_loop()
+        try:
+            return loop.run_until_complete(cls._mirror_urls_async(urls, concurrency, max_age))
+        finally:
+            HostManager.flush()
+
+    @classmethod
+    async def _mirror_urls_async(cls, urls, concurrency, max_age):
+        # Keep at most `concurrency` fetches in flight, instead of one task per domain.
+        connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=CRAWL_PER_HOST,
+                                         ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(total=CRAWL_TIMEOUT)
+        limiter = HostLimiter()
+        (pending, running, results) = (set(), {}, {})
+
+        def collect(done):
+            for task in done:
+                results[running.pop(task)] = task.result()
+            if len(HostManager.pending) >= 1000:
+                HostManager.flush()
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                         auto_decompress=False) as session:
+            for (url, category) in urls:
+                if len(pending) >= concurrency:
+                    (done, pending) = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    collect(done)
+                task = asyncio.ensure_future(cls.amirror_url(session, url, category, max_age, limiter))
+                running[task] = url
+                pending.add(task)
+            if pending:
+                (done, pending) = await asyncio.wait(pending)
+                collect(done)
+        return results
 
     @classmethod
-    def mirror_all(cls):
+    def mirror_urls(cls, urls, max_age=CRAWL_MAX_AGE):
+        "Mirror a batch of (url, category) pairs, return a dict of url to result."
+        urls = list(urls)
+        if getattr(config, 'CRAWL_ASYNC', False):
+            return cls.mirror_urls_async(urls, max_age=max_age)
+        HostManager.load()
+        hosts = by_host(urls)
         with multiprocessing.Pool(processes=4) as pool:
-            for domain in cls.eyeball.relationship.all_sellers():
-                pool.apply_async(crawl_wrap, [domain, 'sellers'])
-            for domain in cls.eyeball.relationship.all_sources():
-                pool.apply_async(crawl_wrap, [domain, 'ads'])
+            # one task per host, as in mirror_all
+            outcomes = pool.starmap(host_wrap, [(host_urls, max_age) for host_urls in hosts])
+        results = {}
+        # each worker hands back its host records, which only the parent writes
+        for (host_urls, (host_results, records)) in zip(hosts, outcomes):
+            for ((url, category), result) in zip(host_urls, host_results):
+                results[url] = result
+            HostManager.merge(records)
+        HostManager.flush()
+        return results
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
     c = Crawler()
-    for domain in sys.argv[1:]:
-        c.mirror_domain(domain)
+    max_age = None
+    if len(sys.argv) > 1 and sys.argv[1] == '--refresh':
+        max_age = 0
+        sys.argv.pop(1)
+    if len(sys.argv) > 1 and sys.argv[1] == '--async':
+        c.mirror_all_async([(domain, 'ads') for domain in sys.argv[2:]], max_age=max_age)
+    else:
+        for domain in sys.argv[1:]:
+            c.mirror_domain(domain, max_age=max_age)
     
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+# Database connections. Eyeball keeps a ConnectionPool, and everything
+# gets a cursor with
+#
+#     with cls.eyeball.cursor() as curs:
+#         ...
+#         curs.connection.commit()
+#
+# which checks a connection out of the pool for the block and puts it
+# back afterwards, rolled back if the block did not commit. Blocks nested
+# in the same thread share one connection, so a cursor passed down, or a
+# lookup made while a transaction is open, sees the same transaction as
+# before. Connections that have failed are replaced, not handed out again.
+#
+# Scans that can match much of a table go through stream() instead, which
+# reads rows DB_ITERSIZE at a time from a named, server-side cursor on a
+# connection of its own, so the caller can commit or look things up in
+# between without disturbing it, and memory use does not grow with the
+# size of the result.
+
+from contextlib import contextmanager
+from itertools import count
+import logging
+import os
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+import config
+
+DB_POOL_MIN = getattr(config, 'DB_POOL_MIN', 1)
+DB_POOL_MAX = getattr(config, 'DB_POOL_MAX', 10)
+DB_POOL_TIMEOUT = getattr(config, 'DB_POOL_TIMEOUT', 30)
+DB_ITERSIZE = getattr(config, 'DB_ITERSIZE', 2000)
+DB_CHECK_IDLE = 60  # seconds idle after which a connection is checked before use
+
+cursor_numbers = count()
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    "Thread-safe pool of between minconn and maxconn connections."
+
+    def __init__(self, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT):
+        (self.minconn, self.maxconn, self.timeout) = (minconn, max(minconn, maxconn), timeout)
+        self.available = threading.Condition()
+        self.local = threading.local()
+        self.reset()
+        for i in range(self.minconn):
+            self.idle.append((self.connect(), time.time()))
+            self.size += 1
+
+    def reset(self):
+        (self.idle, self.size, self.pid) = ([], 0, os.getpid())
+        self.abandoned = []
+
+    def connect(self, attempts=5):
+        for i in range(attempts):
+            try:
+                conn = psycopg2.connect(database=config.DB_NAME, user=config.DB_USER,
+                                        host=config.DB_HOST, port=config.DB_PORT)
+                if i > 0:
+                    logging.info("Connected to database after %d attempt(s)." % i)
+                return conn
+            except psycopg2.OperationalError:
+                logging.info("Waiting for database.")
+                time.sleep(2**(i+3))
+        logging.error("Database connection failed")
+        raise RuntimeError
+
+    def check_fork(self):
+        if self.pid == os.getpid():
+            return
+        # Connections made before a fork belong to the parent. Closing them here would
+        # close the parent's sessions too, so just keep them from being garbage collected.
+        with self.available:
+            abandoned = self.abandoned + [conn for (conn, since) in self.idle]
+            self.reset()
+            self.abandoned = abandoned
+        self.local = threading.local()
+
+    def healthy(self, conn, since):
+        if conn.closed:
+            return False
+        if time.time() - since < DB_CHECK_IDLE:
+            return True
+        try:
+            with conn.cursor() as curs:
+                curs.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        deadline = time.time() + self.timeout
+        with self.available:
+            while not self.idle and self.size >= self.maxconn:
+                if not self.available.wait(max(0, deadline - time.time())):
+                    raise PoolTimeout("No database connection free after %d seconds" % self.timeout)
+            if self.idle:
+                (conn, since) = self.idle.pop()
+            else:
+                (conn, since) = (None, None)
+                self.size += 1
+        try:
+            if conn is not None and not self.healthy(conn, since):
+                logging.info("Replacing a broken database connection.")
+                self.discard(conn)
+                conn = None
+            if conn is None:
+                conn = self.connect()
+        except:
+            with self.available:
+                self.size -= 1
+                self.available.notify()
+            raise
+        return conn
+
+    def putconn(self, conn, broken=False):
+        if not broken and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        if broken or conn.closed:
+            self.discard(conn)
+        with self.available:
+            if broken or conn.closed:
+                self.size -= 1
+            else:
+                self.idle.append((conn, time.time()))
+            self.available.notify()
+
+    @contextmanager
+    def connection(self):
+        "A connection for the duration of the block, shared by blocks nested in the same thread."
+        self.check_fork()
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+        conn = self.local.conn = self.getconn()
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.local.conn = None
+            self.putconn(conn, broken)
+
+    @staticmethod
+    def cursor_name():
+        return 'eyeball_%d_%d' % (os.getpid(), next(cursor_numbers))
+
+    @contextmanager
+    def cursor(self, server_side=False, itersize=DB_ITERSIZE):
+        "With server_side, rows are fetched itersize at a time while iterating over the cursor."
+        with self.connection() as conn:
+            with conn.cursor(self.cursor_name() if server_side else None) as curs:
+                if server_side:
+                    curs.itersize = itersize
+                yield curs
+
+    def stream(self, query, params=None, itersize=DB_ITERSIZE):
+        '''
+        Generate the rows of query from a server-side cursor on a connection of its own, which
+        goes back to the pool when the rows run out or the generator is closed.
+        '''
+        self.check_fork()
+        conn = self.getconn()
+        broken = False
+        try:
+            with conn.cursor(self.cursor_name()) as curs:
+                curs.itersize = itersize
+                curs.execute(query, params)
+                for row in curs:
+                    yield row
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.putconn(conn, broken)
+
+    def closeall(self):
+        with self.available:
+            for (conn, since) in self.idle:
+                self.discard(conn)
+            self.size -= len(self.idle)
+            self.idle = []
+
+
+# vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
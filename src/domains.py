@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# Domain name normalization and validation, shared by the parsers and
+# Relationship. The same few thousand ad system domains come up millions
+# of times, so results are kept in a bounded LRU cache, and ordinary
+# lowercase names are checked with one precompiled pattern before falling
+# back to the validators package.
+
+from functools import lru_cache
+import re
+
+import validators
+
+import config
+
+DOMAIN_CACHE_SIZE = getattr(config, 'DOMAIN_CACHE_SIZE', 65536)
+
+# Plain lowercase names, a subset of what validators.domain accepts
+SIMPLE_DOMAIN = re.compile(r'^(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z]{2,63}$')
+SEPARATORS = re.compile(r'[^A-Za-z0-9-\.]')
+
+@lru_cache(maxsize=DOMAIN_CACHE_SIZE)
+def _is_domain(text):
+    if SIMPLE_DOMAIN.match(text):
+        return True
+    return bool(validators.domain(text))
+
+def is_domain(text):
+    "Is text a valid domain name?"
+    if not text or not isinstance(text, str):
+        return False
+    return _is_domain(text)
+
+@lru_cache(maxsize=DOMAIN_CACHE_SIZE)
+def _extract_domain(text):
+    if _is_domain(text):
+        return text.lower()
+    for chunk in SEPARATORS.split(text):
+        if chunk and _is_domain(chunk):
+            return chunk.lower()
+    return text
+
+def extract_domain(text):
+    "The domain name in text, lowercased, such as example.com from 'Example (example.com)'."
+    if not text or not isinstance(text, str):
+        return text
+    return _extract_domain(text)
+
+def check_domains(texts):
+    "Validate many names at once. Returns a dict of each distinct name to True or False."
+    return dict((text, is_domain(text)) for text in set(texts))
+
+def valid_domains(texts):
+    "The valid domain names in texts, in order."
+    texts = list(texts)
+    valid = check_domains(texts)
+    return [text for text in texts if valid[text]]
+
+
+# vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
@@ -16,9 +16,18 @@ except:
 
 import config
 from adstxt import AdsTxt
+from cache import ResponseCache
+from db import ConnectionPool
 from crawl import Crawler
+from frontier import Frontier
+from hosts import HostManager
+from ingest import Ingest
+from jobs import JobQueue
+from pipeline import PARSE_PIPELINE, Pipeline
 from relationship import Relationship
+from schedule import Scheduler
 from sellers import Sellers
+from strongset import StrongSet
 
 class Eyeball(object):
 
@@ -29,30 +38,59 @@ class Eyeball(object):
         self.logging = logging
         self.adstxt = AdsTxt
         self.adstxt.eyeball = self
+        self.cache = ResponseCache
+        self.cache.eyeball = self
         self.crawler = Crawler
         self.crawler.eyeball = self
+        self.frontier = Frontier
+        self.frontier.eyeball = self
+        self.hosts = HostManager
+        self.hosts.eyeball = self
+        self.ingest = Ingest
+        self.ingest.eyeball = self
+        self.jobs = JobQueue
+        self.jobs.eyeball = self
+        self.pipeline = Pipeline
+        self.pipeline.eyeball = self
         self.relationship = Relationship
         self.relationship.eyeball = self
+        self.scheduler = Scheduler
+        self.scheduler.eyeball = self
         self.sellers = Sellers
         self.sellers.eyeball = self
+        self.strongset = StrongSet
+        self.strongset.eyeball = self
         if start_demo_db:
             self.start_demo_db()
         self.connect()
 
+    # The graph and analytics modules need NumPy and SciPy, which the crawl and parse
+    # processes can do without, so they are only imported when first asked for.
+
+    @property
+    def graph(self):
+        "The in-memory relationship graph class. See graph.py."
+        from graph import RelationshipGraph
+        RelationshipGraph.eyeball = self
+        return RelationshipGraph
+
+    @property
+    def analytics(self):
+        "Batch whole-graph analytics. See analytics.py."
+        from analytics import Analytics
+        Analytics.eyeball = self
+        return Analytics
+
     def connect(self):
-        for i in range(5):
-            try: 
-                self.conn = psycopg2.connect(database=config.DB_NAME, user=config.DB_USER,
-                                             host=config.DB_HOST, port=config.DB_PORT)
-                if i > 0:
-                    logging.info("Connected to database after %d attempt(s)." % i)
-                break
-            except psycopg2.OperationalError:
-                logging.info("Waiting for database.")
-                time.sleep(2**(i+3))
-        else:
-            logging.error("Database connection failed")
-            raise RuntimeError
+        self.pool = ConnectionPool()
+
+    def cursor(self, server_side=False):
+        "Context manager for a cursor on a pooled connection. See db.py."
+        return self.pool.cursor(server_side)
+
+    def stream(self, query, params=None):
+        "Generator of the rows of a large query, read a batch at a time. See db.py."
+        return self.pool.stream(query, params)
 
     def start_demo_db(self):
         try:
@@ -67,7 +105,7 @@ class Eyeball(object):
         logging.info("Started test database. PID is %d" % demo_db.pid)
 
     def stop_demo_db(self):
-        self.conn.close()
+        self.pool.closeall()
         try:
             with open("/var/lib/postgresql/9.6/main/postmaster.pid") as pidfile:
                 pidline = pidfile.readline()
@@ -84,7 +122,7 @@ class Eyeball(object):
                 return
 
     def now(self):
-        with self.conn.cursor() as curs:
+        with self.cursor() as curs:
             curs.execute("SELECT NOW()")
             when = curs.fetchone()[0]
             when = when.replace(tzinfo=timezone.utc)
@@ -95,20 +133,34 @@ class Eyeball(object):
         self.adstxt.parse_all()
 
     def do_background(self):
-        if not os.fork():
-            seller_parser = self.__class__()
-            while True:
-                seller_parser.sellers.parse_all()
-        if not os.fork():
-            adstxt_parser = self.__class__()
-            while True:
-                adstxt_parser.adstxt.parse_all()
+        if self.jobs.enabled:
+            return self.do_background_jobs()
+        if PARSE_PIPELINE:
+            if not os.fork():
+                self.__class__().pipeline.work()
+        else:
+            if not os.fork():
+                seller_parser = self.__class__()
+                seller_parser.frontier.work(seller_parser.sellers)
+            if not os.fork():
+                adstxt_parser = self.__class__()
+                adstxt_parser.frontier.work(adstxt_parser.adstxt)
         if not os.fork():
             mirrorer = self.__class__()
-            while True:
-                mirrorer.crawler.mirror_all()
+            mirrorer.scheduler.run()
         return
 
+    def do_background_jobs(self):
+        self.jobs.seed()
+        tasks = (('crawl', None),) if PARSE_PIPELINE else (('crawl', None), ('parse', 'sellers'), ('parse', 'ads'))
+        for (task, category) in tasks:
+            for i in range(getattr(config, 'JOB_WORKERS', 1)):
+                if not os.fork():
+                    worker = self.__class__()
+                    worker.jobs.work(task, category)
+        if PARSE_PIPELINE and not os.fork():
+            self.__class__().pipeline.work()
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
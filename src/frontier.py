@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+# Breadth-first discovery over the ad supply graph. Parsing an ads.txt
+# file turns up sellers.json files to parse, and parsing a sellers.json
+# file turns up ads.txt files. Instead of parse_file calling parse_list
+# calling parse_file, to whatever depth the graph goes, newly found
+# domains go on the end of a queue. A batch at a time comes off the front,
+# is checked against the database with one query, and is parsed, a batch
+# at a time through the parse pipeline if that is on. When the crawl_jobs
+# queue is in use it is the frontier instead (see jobs.py).
+#
+# With PARSE_INCREMENTAL, work() parses everything once, and after that
+# only files never parsed or fetched with new content since the last pass
+# (see Scheduler.changed_since), resting between passes that write nothing.
+
+from collections import deque
+import logging
+import time
+
+import config
+from crawl import domain_to_url
+from ingest import PARSE_INCREMENTAL
+from pipeline import PARSE_PIPELINE
+
+FRONTIER_BATCH_SIZE = getattr(config, 'FRONTIER_BATCH_SIZE', 100)
+PARSE_IDLE_SLEEP = 10
+
+OTHER = {'ads': 'sellers', 'sellers': 'ads'}
+
+
+class Frontier(object):
+    eyeball = None
+
+    def __init__(self, max_files=0, since=None):
+        self.queue = deque()
+        self.visited = set()
+        (self.max_files, self.parsed, self.since) = (max_files, 0, since)
+
+    def add(self, domains, category):
+        for domain in domains:
+            if domain and (domain, category) not in self.visited:
+                self.visited.add((domain, category))
+                self.queue.append((domain, category))
+
+    def next_batch(self, size=FRONTIER_BATCH_SIZE):
+        "Up to size queued (domain, category) pairs, all of one category."
+        batch = []
+        while self.queue and len(batch) < size and (not batch or self.queue[0][1] == batch[0][1]):
+            batch.append(self.queue.popleft())
+        return batch
+
+    def unparsed(self, domains, category):
+        '''
+        The domains that have no parsed file yet, in one query. With PARSE_INCREMENTAL, also
+        those whose file has changed since the last pass, or all of them on the first pass.
+        '''
+        if PARSE_INCREMENTAL and self.since is None:
+            # parse_file skips files that have not changed since they were parsed
+            return domains
+        table = 'adstxt' if 'ads' == category else 'sellersjson'
+        with self.eyeball.cursor() as curs:
+            curs.execute('SELECT DISTINCT domain FROM %s WHERE domain = ANY(%%s)' % table, (domains,))
+            parsed = set(row[0] for row in curs.fetchall())
+            curs.connection.commit()
+        if PARSE_INCREMENTAL:
+            changed = set(url for (url, cat) in self.eyeball.scheduler.changed_since(
+                self.since, [domain_to_url(domain, category) for domain in domains]))
+            parsed = set(domain for domain in parsed if domain_to_url(domain, category) not in changed)
+        for domain in domains:
+            if domain in parsed:
+                logging.debug("%s already parsed." % domain_to_url(domain, category))
+        return [domain for domain in domains if domain not in parsed]
+
+    def parse(self, domains, category):
+        "Parse a batch, and queue what it turns up."
+        if self.max_files:
+            domains = domains[:self.max_files - self.parsed]
+        if PARSE_PIPELINE:
+            found = set()
+            written = self.eyeball.pipeline.run([(domain_to_url(d, category), category) for d in domains],
+                                                discovered=found)
+            self.parsed += len(written)
+            self.add(found, OTHER[category])
+            return
+        parser = self.eyeball.adstxt if 'ads' == category else self.eyeball.sellers
+        for domain in domains:
+            try:
+                found = parser.parse_file(domain_to_url(domain, category))
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                logging.error("Failed to parse %s: %s" % (domain_to_url(domain, category), e))
+                continue
+            if found is None or found is False:
+                # unchanged since it was last parsed, or not a domain: nothing written
+                continue
+            self.parsed += 1
+            self.add(found, OTHER[category])
+
+    def run(self):
+        while self.queue:
+            if self.max_files and self.parsed >= self.max_files:
+                break
+            (domains, category) = ([], None)
+            for (domain, category) in self.next_batch():
+                domains.append(domain)
+            domains = self.unparsed(domains, category)
+            if domains:
+                self.parse(domains, category)
+        logging.info("Parsed %d file(s), %d domain(s) left in the frontier" % (self.parsed, len(self.queue)))
+        if self.parsed and not PARSE_PIPELINE:
+            # the pipeline does this for each batch
+            self.eyeball.strongset.changed()
+        return self.parsed
+
+    @classmethod
+    def explore(cls, domains, category, max_files=0, since=None):
+        '''
+        Parse the category files for domains, then everything reachable from them, breadth first.
+        since is when the last pass started, for PARSE_INCREMENTAL.
+        '''
+        frontier = cls(max_files, since)
+        frontier.add(domains, category)
+        return frontier.run()
+
+    @classmethod
+    def work(cls, parser):
+        "Run parser.parse_all, of AdsTxt or Sellers, forever."
+        since = None
+        while True:
+            started = cls.eyeball.scheduler.clock()
+            parsed = parser.parse_all(since=since)
+            if PARSE_INCREMENTAL:
+                since = started
+            if not parsed:
+                time.sleep(PARSE_IDLE_SLEEP)
+
+
+# vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
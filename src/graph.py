@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+# The relationship table as a graph in memory, for questions that would
+# take many queries or a whole-table scan: who a domain sells through,
+# everything reachable from it, and the supply paths between two domains.
+# Each domain is interned once as a small integer id, and edges are kept
+# as NumPy arrays in compressed sparse row form, one set for the edges an
+# ads.txt file lists, one for sellers.json, and one for edges that both
+# confirm, each in both directions. An edge goes from the relationship's
+# source to its destination, the way inventory is sold.
+#
+# A long-running process keeps one graph (see current()) and brings it up
+# to date from rows whose modified time is since the last load, with some
+# overlap for transactions that were still open. Deleted rows only drop
+# out at the next full load, every GRAPH_FULL_RELOAD seconds. A loaded
+# graph is never changed: updates make a new one, which replaces the old
+# one for later requests while earlier ones go on using what they had. Each edge also
+# has a role, whether the files call it DIRECT (or the seller a PUBLISHER)
+# or RESELLER (INTERMEDIARY), for the supply chains in analytics.py.
+
+from array import array
+from datetime import timedelta
+import logging
+import sys
+import threading
+import time
+
+import numpy as np
+
+import config
+
+GRAPH_RELOAD = getattr(config, 'GRAPH_RELOAD', 300)
+GRAPH_FULL_RELOAD = getattr(config, 'GRAPH_FULL_RELOAD', 3600)
+LOAD_OVERLAP = 600  # seconds before the last load to look for changed rows from
+
+ADSTXT = 1
+SELLERSJSON = 2
+KINDS = {'adstxt': ADSTXT, 'sellersjson': SELLERSJSON, 'both': ADSTXT | SELLERSJSON}
+
+DIRECT = 1
+RESELLER = 2
+ROLES = {'DIRECT': DIRECT, 'PUBLISHER': DIRECT, 'RESELLER': RESELLER, 'INTERMEDIARY': RESELLER,
+         'BOTH': DIRECT | RESELLER}
+
+class Adjacency(object):
+    "Compressed sparse rows: the neighbors of node i are indices[indptr[i]:indptr[i + 1]], in order."
+
+    def __init__(self, heads, tails, count):
+        pairs = np.unique(heads.astype(np.int64) * count + tails)
+        self.indices = (pairs % count).astype(np.int32)
+        self.indptr = np.zeros(count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pairs // count, minlength=count), out=self.indptr[1:])
+
+    def neighbors(self, node):
+        return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+    def expand(self, nodes):
+        "The neighbors of all of an array of nodes, with repeats."
+        (starts, lengths) = (self.indptr[nodes], self.indptr[nodes + 1] - self.indptr[nodes])
+        total = int(lengths.sum())
+        if not total:
+            return np.zeros(0, dtype=np.int32)
+        return self.indices[np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(total)]
+
+
+class RelationshipGraph(object):
+    eyeball = None
+    shared = None
+    lock = threading.Lock()
+
+    def __init__(self):
+        (self.names, self.ids) = ([], {})
+        self.edge_id = np.zeros(0, dtype=np.int64)    # relationship id, in order
+        self.head = np.zeros(0, dtype=np.int32)       # source domain id
+        self.tail = np.zeros(0, dtype=np.int32)       # destination domain id
+        self.kind = np.zeros(0, dtype=np.uint8)       # ADSTXT | SELLERSJSON
+        self.role = np.zeros(0, dtype=np.uint8)       # DIRECT | RESELLER, from account or seller type
+        self.adjacency = {}
+        (self.since, self.loaded, self.checked) = (None, 0, 0)
+
+    def intern(self, name):
+        nid = self.ids.get(name)
+        if nid is None:
+            nid = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return nid
+
+    def fetch(self, since=None):
+        "Edges from relationship rows, all of them or those modified since a time, as arrays."
+        (rids, heads, tails, kinds, roles) = (array('q'), array('i'), array('i'), array('B'), array('B'))
+        query = '''SELECT id, source, destination, adstxt IS NOT NULL, sellersjson IS NOT NULL,
+                   account_type, seller_type FROM relationship WHERE source IS NOT NULL'''
+        if since is not None:
+            query += ' AND modified >= %(since)s'
+        rows = self.eyeball.stream(query, {'since': since})
+        for (rid, source, destination, in_adstxt, in_sellersjson, account_type, seller_type) in rows:
+            rids.append(rid)
+            heads.append(self.intern(source))
+            tails.append(self.intern(destination))
+            kinds.append((ADSTXT if in_adstxt else 0) | (SELLERSJSON if in_sellersjson else 0))
+            roles.append(ROLES.get(account_type, 0) | ROLES.get(seller_type, 0))
+        return (np.array(rids, dtype=np.int64), np.array(heads, dtype=np.int32),
+                np.array(tails, dtype=np.int32), np.array(kinds, dtype=np.uint8),
+                np.array(roles, dtype=np.uint8))
+
+    def start_time(self):
+        with self.eyeball.cursor() as curs:
+            curs.execute('SELECT NOW()::TIMESTAMP')
+            started = curs.fetchone()[0]
+            curs.connection.commit()
+        return started
+
+    def load(self):
+        "Read the whole relationship table."
+        started = self.start_time()
+        self.__init__()
+        (rids, heads, tails, kinds, roles) = self.fetch()
+        order = np.argsort(rids, kind='mergesort')
+        (self.edge_id, self.head, self.tail, self.kind, self.role) = (rids[order], heads[order], tails[order],
+                                                                      kinds[order], roles[order])
+        self.build()
+        (self.since, self.loaded, self.checked) = (started, time.time(), time.time())
+        logging.info("Loaded %d domain(s), %d relationship(s)" % (len(self.names), len(self.edge_id)))
+        return self
+
+    def copy(self):
+        "A new graph sharing this one's arrays, to change without disturbing its readers."
+        graph = self.__class__()
+        (graph.names, graph.ids) = (list(self.names), dict(self.ids))
+        (graph.edge_id, graph.head, graph.tail, graph.kind, graph.role) = (self.edge_id, self.head, self.tail,
+                                                                           self.kind, self.role)
+        graph.adjacency = self.adjacency
+        (graph.since, graph.loaded, graph.checked) = (self.since, self.loaded, self.checked)
+        return graph
+
+    def update(self):
+        '''
+        A copy of the graph brought up to date with rows inserted or changed since the last load.
+        The graph itself is left as it was.
+        '''
+        started = self.start_time()
+        graph = self.copy()
+        (rids, heads, tails, kinds, roles) = graph.fetch(self.since - timedelta(seconds=LOAD_OVERLAP))
+        graph.checked = time.time()
+        if len(rids):
+            at = np.searchsorted(self.edge_id, rids)
+            known = (at < len(self.edge_id))
+            known[known] = self.edge_id[at[known]] == rids[known]
+            (head, tail, kind, role) = (self.head.copy(), self.tail.copy(), self.kind.copy(), self.role.copy())
+            (head[at[known]], tail[at[known]], kind[at[known]], role[at[known]]) = (heads[known], tails[known],
+                                                                                    kinds[known], roles[known])
+            new = ~known
+            edge_id = np.concatenate((self.edge_id, rids[new]))
+            order = np.argsort(edge_id, kind='mergesort')
+            graph.edge_id = edge_id[order]
+            graph.head = np.concatenate((head, heads[new]))[order]
+            graph.tail = np.concatenate((tail, tails[new]))[order]
+            graph.kind = np.concatenate((kind, kinds[new]))[order]
+            graph.role = np.concatenate((role, roles[new]))[order]
+            graph.adjacency = {}
+            graph.build()
+            logging.info("Updated %d relationship(s), added %d" % (known.sum(), new.sum()))
+        graph.since = started
+        return graph
+
+    def build(self):
+        count = max(1, len(self.names))
+        for (kind, mask) in KINDS.items():
+            selected = (self.kind & mask) == mask
+            (heads, tails) = (self.head[selected], self.tail[selected])
+            self.adjacency[kind] = (Adjacency(heads, tails, count), Adjacency(tails, heads, count))
+
+    @classmethod
+    def current(cls):
+        '''
+        A graph kept for the life of the process, no more than GRAPH_RELOAD seconds out of date.
+        One caller at a time loads or updates it, while the others go on with the one there is.
+        '''
+        graph = cls.shared
+        if graph is None:
+            with cls.lock:
+                if cls.shared is None:
+                    cls.shared = cls().load()
+                return cls.shared
+        now = time.time()
+        full = now - graph.loaded > GRAPH_FULL_RELOAD
+        if (full or now - graph.checked > GRAPH_RELOAD) and cls.lock.acquire(False):
+            try:
+                if cls.shared is graph:
+                    cls.shared = cls().load() if full else graph.update()
+            finally:
+                cls.lock.release()
+        return cls.shared
+
+    def adjacent(self, kind, direction):
+        "Adjacency for kind ('adstxt', 'sellersjson' or 'both'), out to destinations or in from sources."
+        return self.adjacency[kind][0 if 'out' == direction else 1]
+
+    def neighbors(self, domain, kind='both', direction='out'):
+        "The domains that domain sells through, or with direction 'in', that sell through it."
+        nid = self.ids.get(domain)
+        if nid is None:
+            return []
+        return [self.names[i] for i in self.adjacent(kind, direction).neighbors(nid)]
+
+    def distances(self, nid, adjacency, max_hops=None):
+        "Hops from nid to each node, -1 where it cannot be reached."
+        distance = np.full(len(self.names), -1, dtype=np.int32)
+        distance[nid] = 0
+        (frontier, hops) = (np.array([nid], dtype=np.int32), 0)
+        while len(frontier) and (max_hops is None or hops < max_hops):
+            hops += 1
+            found = adjacency.expand(frontier)
+            frontier = np.unique(found[distance[found] < 0])
+            distance[frontier] = hops
+        return distance
+
+    def reachable(self, domain, kind='both', direction='out', max_hops=None):
+        "Every domain reachable from domain, by the number of hops it takes."
+        nid = self.ids.get(domain)
+        if nid is None:
+            return {}
+        distance = self.distances(nid, self.adjacent(kind, direction), max_hops)
+        return dict((self.names[i], int(distance[i])) for i in np.nonzero(distance > 0)[0])
+
+    def paths(self, source, destination, kind='both', max_hops=3, limit=100):
+        "Up to limit supply paths from source to destination, lists of domains, shortest first."
+        (start, end) = (self.ids.get(source), self.ids.get(destination))
+        if start is None or end is None:
+            return []
+        forward = self.adjacent(kind, 'out')
+        # how far each domain is from destination, to only follow links that can get there in time
+        togo = self.distances(end, self.adjacent(kind, 'in'), max_hops)
+        if togo[start] < 0:
+            return []
+        (found, path) = ([], [start])
+        def walk(node, left):
+            "Paths from node to end of exactly left more hops."
+            if node == end:
+                if not left:
+                    found.append([self.names[i] for i in path])
+                return
+            following = forward.neighbors(node)
+            # only neighbors that can still get to end in time, and are not on the path already
+            following = following[(togo[following] >= 0) & (togo[following] <= left - 1)]
+            following = following[~np.isin(following, path)]
+            for nxt in following:
+                if len(found) >= limit:
+                    return
+                path.append(nxt)
+                walk(nxt, left - 1)
+                path.pop()
+        # one length at a time, so the shortest paths are the ones found before the limit
+        for hops in range(togo[start], max_hops + 1):
+            if len(found) >= limit:
+                break
+            walk(start, hops)
+        return found
+
+
+if __name__ == "__main__":
+    from eyeball import Eyeball
+    logging.basicConfig(level=logging.INFO)
+    e = Eyeball()
+    g = e.graph().load()
+    if len(sys.argv) == 2:
+        print(g.reachable(sys.argv[1]))
+    elif len(sys.argv) == 3:
+        for path in g.paths(sys.argv[1], sys.argv[2]):
+            print(' -> '.join(path))
+
+# vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
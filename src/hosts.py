@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+# Host politeness and backoff.
+#
+# HostLimiter caps how many requests the asyncio crawler has open to one
+# host and to one IP address (many publishers share a CDN front end), and
+# spaces out request starts to the same host. The process pool crawler
+# gets the same spacing by handing all of a host's URLs to one worker,
+# which fetches them one at a time; with only 4 workers it never has more
+# requests open than CRAWL_PER_IP allows.
+#
+# HostManager is a negative cache of failed fetches, kept in the
+# fetch_failure table. DNS, connect and timeout failures block every URL on
+# the host; HTTP errors block just the URL. Each failure in a row doubles
+# the wait before the next try, up to CRAWL_BACKOFF_MAX. Crawler processes
+# record outcomes in memory and the parent writes them with flush().
+
+import asyncio
+from collections import Counter
+import logging
+import socket
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlparse
+
+import config
+
+CRAWL_PER_HOST = getattr(config, 'CRAWL_PER_HOST', 2)
+CRAWL_PER_IP = getattr(config, 'CRAWL_PER_IP', 8)
+CRAWL_HOST_DELAY = getattr(config, 'CRAWL_HOST_DELAY', 1.0)
+CRAWL_BACKOFF_BASE = getattr(config, 'CRAWL_BACKOFF_BASE', 3600)
+CRAWL_BACKOFF_MAX = getattr(config, 'CRAWL_BACKOFF_MAX', 30 * 86400)
+
+HOST_FAILURES = ('dns', 'connect', 'timeout')
+
+def classify(exc):
+    "Sort a fetch exception into 'dns', 'timeout', 'connect', 'http' or 'error'."
+    if isinstance(exc, HTTPError):
+        return 'http'
+    if isinstance(exc, URLError) and not isinstance(exc.reason, str):
+        exc = exc.reason
+    if isinstance(exc, socket.gaierror):
+        return 'dns'
+    if isinstance(exc, (socket.timeout, asyncio.TimeoutError)):
+        return 'timeout'
+    if isinstance(exc, (ConnectionError, URLError)):
+        return 'connect'
+    if isinstance(getattr(exc, 'os_error', None), socket.gaierror):
+        return 'dns'
+    if isinstance(exc, OSError):
+        return 'connect'
+    return 'error'
+
+
+class HostSlot(object):
+    def __init__(self, limiter, host, ip):
+        (self.limiter, self.host, self.ip) = (limiter, host, ip)
+
+    async def __aenter__(self):
+        await self.limiter.acquire(self.host, self.ip)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.limiter.release(self.host, self.ip)
+
+
+class HostLimiter(object):
+    "Per-host and per-IP concurrency and rate limits. Create one inside the running event loop."
+
+    def __init__(self, per_host=CRAWL_PER_HOST, per_ip=CRAWL_PER_IP, delay=CRAWL_HOST_DELAY):
+        (self.per_host, self.per_ip, self.delay) = (per_host, per_ip, delay)
+        self.active = Counter()
+        self.next_start = {}
+        self.addresses = {}
+        self.changed = asyncio.Condition()
+
+    async def resolve(self, host):
+        "IP address for host. Raises socket.gaierror for DNS failures."
+        if host not in self.addresses:
+            loop = asyncio.get_event_loop()
+            info = await loop.getaddrinfo(host, 443, type=socket.SOCK_STREAM)
+            self.addresses[host] = info[0][4][0]
+        return self.addresses[host]
+
+    def slot(self, host, ip=None):
+        return HostSlot(self, host, ip)
+
+    def _busy(self, host, ip):
+        if self.active[('host', host)] >= self.per_host:
+            return True
+        return ip is not None and self.active[('ip', ip)] >= self.per_ip
+
+    async def acquire(self, host, ip):
+        async with self.changed:
+            while self._busy(host, ip):
+                await self.changed.wait()
+            self.active[('host', host)] += 1
+            if ip is not None:
+                self.active[('ip', ip)] += 1
+        now = asyncio.get_event_loop().time()
+        if len(self.next_start) > 10000:
+            # forget hosts that could be started again right away anyway
+            self.next_start = dict((h, t) for (h, t) in self.next_start.items() if t > now)
+        start = max(now, self.next_start.get(host, now))
+        self.next_start[host] = start + self.delay
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    async def release(self, host, ip):
+        async with self.changed:
+            for key in (('host', host), ('ip', ip)):
+                if key not in self.active:
+                    continue
+                self.active[key] -= 1
+                if self.active[key] <= 0:
+                    del self.active[key]
+            self.changed.notify_all()
+
+
+class HostManager(object):
+    eyeball = None
+    blocked_urls = set()
+    blocked_hosts = set()
+    pending = []
+
+    @classmethod
+    def load(cls):
+        "Refresh the in-memory negative cache from the database."
+        if cls.eyeball is None:
+            return
+        with cls.eyeball.cursor() as curs:
+            curs.execute('''SELECT url, host, kind FROM fetch_failure WHERE retry_after > NOW()''')
+            (urls, hosts) = (set(), set())
+            for (url, host, kind) in curs.fetchall():
+                urls.add(url)
+                if kind in HOST_FAILURES:
+                    hosts.add(host)
+            curs.connection.commit()
+        (cls.blocked_urls, cls.blocked_hosts) = (urls, hosts)
+        logging.debug("%d URL(s) and %d host(s) in backoff" % (len(urls), len(hosts)))
+
+    @classmethod
+    def is_blocked(cls, url):
+        return url in cls.blocked_urls or urlparse(url).hostname in cls.blocked_hosts
+
+    @classmethod
+    def failed(cls, url, kind, status=None):
+        cls.pending.append((url, kind, status))
+        if kind in HOST_FAILURES:
+            # don't keep trying the same dead host for the rest of this run
+            cls.blocked_hosts.add(urlparse(url).hostname)
+
+    @classmethod
+    def succeeded(cls, url):
+        cls.pending.append((url, None, None))
+
+    @classmethod
+    def drain(cls):
+        (records, cls.pending) = (cls.pending, [])
+        return records
+
+    @classmethod
+    def merge(cls, records):
+        cls.pending.extend(records or [])
+
+    @classmethod
+    def flush(cls):
+        "Write recorded outcomes to the fetch_failure table."
+        records = cls.drain()
+        if cls.eyeball is None or not records:
+            return
+        latest = dict((url, (kind, status)) for (url, kind, status) in records)
+        succeeded = [url for (url, (kind, status)) in latest.items() if kind is None]
+        with cls.eyeball.cursor() as curs:
+            if succeeded:
+                curs.execute('''DELETE FROM fetch_failure WHERE url = ANY(%s) OR
+                                (host = ANY(%s) AND kind IN %s)''',
+                             (succeeded, list(set(urlparse(url).hostname for url in succeeded)),
+                              HOST_FAILURES))
+            for (url, (kind, status)) in latest.items():
+                if kind is None:
+                    continue
+                host = urlparse(url).hostname
+                curs.execute('''INSERT INTO fetch_failure (url, host, kind, status, failures, retry_after)
+                                VALUES (%s, %s, %s, %s, 1, NOW() + %s * INTERVAL '1 second')
+                                ON CONFLICT (url) DO UPDATE SET
+                                host = EXCLUDED.host, kind = EXCLUDED.kind, status = EXCLUDED.status,
+                                failures = fetch_failure.failures + 1,
+                                retry_after = NOW() + LEAST(%s * POWER(2, fetch_failure.failures), %s)
+                                              * INTERVAL '1 second'
+                                ''', (url, host, kind, status, CRAWL_BACKOFF_BASE,
+                                      CRAWL_BACKOFF_BASE, CRAWL_BACKOFF_MAX))
+            curs.connection.commit()
+
+
+# vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+# Bulk loading of parsed relationships. A whole ads.txt or sellers.json
+# file is COPYed into a temporary staging table and merged into
+# relationship with one INSERT ... ON CONFLICT, instead of a lookup and
+# an INSERT or UPDATE per line. Rows are matched on the natural key
+# (source, destination, account_id), which has a unique index (see
+# schema.sql). An ads.txt file only updates the ads.txt columns of a
+# matching row and a sellers.json file only the sellers.json ones, so
+# one row can carry both sides of a relationship.
+
+import io
+import logging
+
+import config
+
+PARSE_INCREMENTAL = getattr(config, 'PARSE_INCREMENTAL', False)
+
+COLUMNS = ('source', 'destination', 'account_id', 'adstxt', 'sellersjson', 'is_confidential',
+           'seller_type', 'account_type', 'certification_authority_id', 'is_passthrough', 'name',
+           'comment')
+
+# What to SET on conflict, by the kind of file the rows came from
+UPDATES = {
+    'adstxt': ('adstxt = EXCLUDED.adstxt',
+               'account_type = EXCLUDED.account_type',
+               'certification_authority_id = EXCLUDED.certification_authority_id'),
+    'sellersjson': ('sellersjson = EXCLUDED.sellersjson',
+                    'is_confidential = EXCLUDED.is_confidential',
+                    'seller_type = EXCLUDED.seller_type',
+                    'is_passthrough = EXCLUDED.is_passthrough',
+                    'name = EXCLUDED.name',
+                    'comment = EXCLUDED.comment',
+                    'account_type = COALESCE(EXCLUDED.account_type, relationship.account_type)',
+                    'certification_authority_id = COALESCE(EXCLUDED.certification_authority_id, '
+                    'relationship.certification_authority_id)'),
+}
+
+# Fields that count as a change for each kind of file, by position in COLUMNS.
+# An ads.txt line is only its account type and certification authority.
+COMPARED = {
+    'adstxt': (7, 8),
+    'sellersjson': (5, 6, 9, 10, 11),
+}
+
+# How to take a row's ads.txt or sellers.json side away, when the row has the other side too
+CLEARS = {
+    'adstxt': ('sellersjson', '''adstxt = NULL, account_type = NULL, certification_authority_id = NULL'''),
+    'sellersjson': ('adstxt', '''sellersjson = NULL, is_confidential = FALSE, seller_type = NULL,
+                                 is_passthrough = FALSE, name = NULL, comment = NULL'''),
+}
+
+def copy_value(value):
+    "One field in PostgreSQL COPY text format."
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+def natural_key(row):
+    return (row[0] or '', row[1], row[2] or '')
+
+
+class Ingest(object):
+    eyeball = None
+
+    @staticmethod
+    def row(rel):
+        (aid, jid) = (rel.adstxt, rel.sellersjson)
+        if aid is not None and not isinstance(aid, int):
+            aid = aid.id
+        if jid is not None and not isinstance(jid, int):
+            jid = jid.id
+        account_id = None if rel.account_id is None else str(rel.account_id)
+        return (rel.source, rel.destination, account_id, aid, jid, rel.is_confidential,
+                rel.seller_type, rel.account_type, rel.certification_authority_id,
+                rel.is_passthrough, rel.name, rel.comment)
+
+    @classmethod
+    def _rows(cls, curs, rows, kind):
+        "Upsert rows, tuples of values for COLUMNS."
+        latest = {}
+        for row in rows:
+            latest[natural_key(row)] = row  # later lines in a file win
+        if not latest:
+            return 0
+        data = io.StringIO()
+        for row in latest.values():
+            data.write('\t'.join(copy_value(v) for v in row) + '\n')
+        data.seek(0)
+        curs.execute('''CREATE TEMPORARY TABLE IF NOT EXISTS relationship_staging (
+                            source TEXT, destination TEXT, account_id TEXT, adstxt INT, sellersjson INT,
+                            is_confidential BOOLEAN, seller_type TEXT, account_type TEXT,
+                            certification_authority_id TEXT, is_passthrough BOOLEAN, name TEXT,
+                            comment TEXT
+                        ) ON COMMIT DELETE ROWS''')
+        curs.execute('TRUNCATE relationship_staging')
+        curs.copy_expert('COPY relationship_staging (%s) FROM STDIN' % ', '.join(COLUMNS), data)
+        curs.execute('''INSERT INTO relationship (%s)
+                        SELECT source, destination, account_id, adstxt, sellersjson, is_confidential,
+                        seller_type::seller_seller_type, account_type::ads_account_type,
+                        certification_authority_id, is_passthrough, name, comment
+                        FROM relationship_staging
+                        ON CONFLICT (COALESCE(source, ''), destination, COALESCE(account_id, ''))
+                        DO UPDATE SET %s''' % (', '.join(COLUMNS), ', '.join(UPDATES[kind])))
+        return curs.rowcount
+
+    @classmethod
+    def loader(cls, curs, kind, domain):
+        '''
+        Start loading a new version of the ads.txt or sellers.json file for domain.
+        In incremental mode only the difference from the last version is written.
+        '''
+        if PARSE_INCREMENTAL:
+            return RowDiff(cls, curs, kind, domain)
+        return RowLoader(cls, curs, kind)
+
+    @classmethod
+    def relationships(cls, rels, kind, cursor=None):
+        '''
+        Insert or update Relationship objects parsed from one file, in one statement.
+        kind is 'adstxt' or 'sellersjson'. With a cursor, the caller commits.
+        '''
+        return cls.rows([cls.row(rel) for rel in rels], kind, cursor)
+
+    @classmethod
+    def rows(cls, rows, kind, cursor=None):
+        "Like relationships, for rows already made with row()."
+        if cursor:
+            return cls._rows(cursor, rows, kind)
+        with cls.eyeball.cursor() as curs:
+            count = cls._rows(curs, rows, kind)
+            curs.connection.commit()
+        logging.debug("Loaded %d relationship(s)" % count)
+        return count
+
+
+class RowLoader(object):
+    "Upsert a file's rows as they come."
+
+    def __init__(self, ingest, curs, kind):
+        (self.ingest, self.curs, self.kind) = (ingest, curs, kind)
+
+    def add(self, rows):
+        self.ingest._rows(self.curs, rows, self.kind)
+
+    def relationships(self, rels):
+        self.add([self.ingest.row(rel) for rel in rels])
+
+    def finish(self):
+        pass
+
+
+class RowDiff(RowLoader):
+    '''
+    Compare a file's rows with the ones the domain's previous version of the file left in
+    relationship, and write only the difference. Feed it rows with add() or relationships(),
+    in as many batches as needed, then call finish() to take away the rows that are gone.
+    Unchanged rows are not written at all, so they keep pointing at the file they came from.
+    '''
+
+    def __init__(self, ingest, curs, kind, domain):
+        super().__init__(ingest, curs, kind)
+        owner = 'source' if 'adstxt' == kind else 'destination'
+        curs.execute('''SELECT %s, id FROM relationship WHERE %s = %%s AND %s IS NOT NULL'''
+                     % (', '.join(COLUMNS), owner, kind), (domain.lower(),))
+        self.old = dict((natural_key(row), (tuple(row[:-1]), row[-1])) for row in curs.fetchall())
+        (self.added, self.changed, self.removed) = (0, 0, 0)
+
+    def is_same(self, old, new):
+        for i in COMPARED[self.kind]:
+            if old[i] != new[i]:
+                return False
+        # a sellers.json file only changes these when it sets them (see UPDATES)
+        return 'adstxt' == self.kind or all(new[i] is None or old[i] == new[i] for i in (7, 8))
+
+    def add(self, rows):
+        todo = []
+        for row in rows:
+            key = natural_key(row)
+            if key in self.old:
+                (old, rid) = self.old.pop(key)
+                if self.is_same(old, row):
+                    continue
+                self.changed += 1
+            else:
+                self.added += 1
+            todo.append(row)
+        self.ingest._rows(self.curs, todo, self.kind)
+
+    def finish(self):
+        "Remove what the new file no longer lists. Returns (added, changed, removed) counts."
+        gone = [rid for (old, rid) in self.old.values()]
+        if gone:
+            (other, clear) = CLEARS[self.kind]
+            self.curs.execute('''DELETE FROM relationship WHERE id = ANY(%%s) AND %s IS NULL''' % other,
+                              (gone,))
+            self.curs.execute('''UPDATE relationship SET %s WHERE id = ANY(%%s)''' % clear, (gone,))
+            self.removed = len(gone)
+        self.old = {}
+        logging.debug("%d added, %d changed, %d removed" % (self.added, self.changed, self.removed))
+        return (self.added, self.changed, self.removed)
+
+
+# vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+# Crawl and parse queue on the crawl_jobs table. Workers lease a batch
+# of rows with FOR UPDATE SKIP LOCKED, so any number of them, on any
+# number of machines, can share the queue without doing the same work twice.
+# https://layerci.com/blog/postgres-is-the-answer/
+#
+# new --(crawler)--> fetching --> fetched --(parser)--> parsing --> parsed
+#                            \--> failed
+#
+# A job whose lease runs out JOB_MAX_ATTEMPTS times in a row, because the
+# URL crashed or hung its worker, is failed instead of leased again.
+
+import logging
+import sys
+import time
+
+import config
+from crawl import NOT_MODIFIED, domain_to_url
+
+JOB_BATCH_SIZE = getattr(config, 'JOB_BATCH_SIZE', 500)
+JOB_LEASE_TIMEOUT = getattr(config, 'JOB_LEASE_TIMEOUT', 600)
+JOB_IDLE_SLEEP = getattr(config, 'JOB_IDLE_SLEEP', 10)
+JOB_MAX_ATTEMPTS = getattr(config, 'JOB_MAX_ATTEMPTS', 3)
+
+class JobQueue(object):
+    eyeball = None
+    enabled = getattr(config, 'USE_JOB_QUEUE', False)
+
+    @classmethod
+    def _enqueue(cls, curs, urls, category):
+        curs.execute('''INSERT INTO crawl_jobs (url, category, status)
+                        SELECT unnest(%s::TEXT[]), %s, 'new'::crawl_job_status
+                        ON CONFLICT (url) DO NOTHING''', (urls, category))
+        return curs.rowcount
+
+    @classmethod
+    def enqueue(cls, domains, category, cursor=None):
+        "Add the ads.txt or sellers.json URLs for newly discovered domains."
+        urls = list(set(domain_to_url(d, category) for d in domains if d))
+        if not urls:
+            return 0
+        if cursor:
+            return cls._enqueue(cursor, urls, category)
+        with cls.eyeball.cursor() as curs:
+            count = cls._enqueue(curs, urls, category)
+            curs.connection.commit()
+        if count:
+            logging.debug("Queued %d new %s URL(s)" % (count, category))
+        return count
+
+    @classmethod
+    def requeue(cls, targets):
+        "Queue (url, category) pairs for another fetch, unless already in progress."
+        targets = list(targets)
+        if not targets:
+            return 0
+        with cls.eyeball.cursor() as curs:
+            curs.execute('''INSERT INTO crawl_jobs (url, category, status)
+                            SELECT unnest(%s::TEXT[]), unnest(%s::TEXT[]), 'new'::crawl_job_status
+                            ON CONFLICT (url) DO UPDATE SET status = 'new', attempts = 0
+                            WHERE crawl_jobs.status IN ('parsed', 'failed')''',
+                         ([url for (url, category) in targets], [category for (url, category) in targets]))
+            count = curs.rowcount
+            curs.connection.commit()
+        return count
+
+    @classmethod
+    def seed(cls):
+        "Queue every domain already known from the relationship table."
+        cls.enqueue(cls.eyeball.relationship.all_sellers(), 'sellers')
+        cls.enqueue(cls.eyeball.relationship.all_sources(), 'ads')
+
+    @classmethod
+    def lease(cls, category, status, leased_status, limit=JOB_BATCH_SIZE):
+        with cls.eyeball.cursor() as curs:
+            curs.execute('''UPDATE crawl_jobs SET status = %s, attempts = attempts + 1
+                            WHERE url IN (
+                                SELECT url FROM crawl_jobs
+                                WHERE status = %s AND category = %s AND attempts < %s
+                                ORDER BY modified
+                                LIMIT %s
+                                FOR UPDATE SKIP LOCKED)
+                            RETURNING url''', (leased_status, status, category, JOB_MAX_ATTEMPTS, limit))
+            urls = [row[0] for row in curs.fetchall()]
+            curs.connection.commit()
+        return urls
+
+    @classmethod
+    def finish(cls, urls, status):
+        if not urls:
+            return
+        with cls.eyeball.cursor() as curs:
+            curs.execute('''UPDATE crawl_jobs SET status = %s, attempts = 0
+                            WHERE url = ANY(%s)''', (status, list(urls)))
+            curs.connection.commit()
+
+    @classmethod
+    def expire_leases(cls, timeout=JOB_LEASE_TIMEOUT):
+        '''
+        Put jobs back on the queue if the worker that leased them has gone quiet, or fail them
+        if that has happened JOB_MAX_ATTEMPTS times.
+        '''
+        with cls.eyeball.cursor() as curs:
+            curs.execute('''UPDATE crawl_jobs SET status = CASE
+                                WHEN attempts >= %s THEN 'failed'::crawl_job_status
+                                WHEN status = 'fetching' THEN 'new'::crawl_job_status
+                                ELSE 'fetched'::crawl_job_status END
+                            WHERE status IN ('fetching', 'parsing')
+                            AND modified < NOW() - %s * INTERVAL '1 second'
+                            RETURNING status''', (JOB_MAX_ATTEMPTS, timeout))
+            failed = sum(1 for (status,) in curs.fetchall() if 'failed' == status)
+            if curs.rowcount:
+                logging.info("Expired %d stuck crawl job lease(s), %d failed after %d attempts" %
+                             (curs.rowcount, failed, JOB_MAX_ATTEMPTS))
+            curs.connection.commit()
+
+    @classmethod
+    def crawl_batch(cls, category, limit=JOB_BATCH_SIZE):
+        urls = cls.lease(category, 'new', 'fetching', limit)
+        if not urls:
+            return 0
+        # Anything on the queue is due, so always revalidate an existing copy.
+        results = cls.eyeball.crawler.mirror_urls([(url, category) for url in urls], max_age=0)
+        cls.eyeball.scheduler.observe([(url, category) for url in urls], results)
+        # A 304 means the copy we already parsed is current, so skip the parse.
+        unchanged = [url for url in urls if results.get(url) == NOT_MODIFIED]
+        fetched = [url for url in urls if results.get(url) and url not in unchanged]
+        cls.finish(unchanged, 'parsed')
+        cls.finish(fetched, 'fetched')
+        # observe() gave these a retry time, and requeue_due() puts them back on the queue then
+        cls.finish(set(urls) - set(fetched) - set(unchanged), 'failed')
+        return len(urls)
+
+    @classmethod
+    def parse_batch(cls, category, limit=JOB_BATCH_SIZE):
+        parser = cls.eyeball.adstxt if 'ads' == category else cls.eyeball.sellers
+        urls = cls.lease(category, 'fetched', 'parsing', limit)
+        written = 0
+        for url in urls:
+            try:
+                # None or False when there was nothing to write
+                if parser.parse_file(url) not in (None, False):
+                    written += 1
+            except FileNotFoundError:
+                logging.warning("No %s file cached for %s" % (category, url))
+            except Exception as e:
+                logging.error("Failed to parse %s: %s" % (url, e))
+            cls.finish([url], 'parsed')
+        if written:
+            cls.eyeball.strongset.changed()
+        return len(urls)
+
+    @classmethod
+    def work(cls, task, category=None):
+        "Run a crawl or parse worker until killed."
+        categories = (category,) if category else ('sellers', 'ads')
+        batch = cls.crawl_batch if 'crawl' == task else cls.parse_batch
+        while True:
+            cls.expire_leases()
+            if 'crawl' == task:
+                cls.eyeball.scheduler.requeue_due()
+                # a stale strong set that was too recently refreshed to claim is picked up here
+                cls.eyeball.strongset.refresh_if_due()
+            count = 0
+            for category in categories:
+                count += batch(category)
+            if not count:
+                time.sleep(JOB_IDLE_SLEEP)
+
+
+if __name__ == "__main__":
+    from eyeball import Eyeball
+    logging.basicConfig(level=logging.INFO)
+    e = Eyeball()
+    if len(sys.argv) < 2 or sys.argv[1] not in ('seed', 'crawl', 'parse'):
+        print("usage: %s seed | crawl [ads|sellers] | parse [ads|sellers]" % sys.argv[0])
+        sys.exit(1)
+    if 'seed' == sys.argv[1]:
+        e.jobs.seed()
+    else:
+        e.jobs.work(sys.argv[1], (sys.argv[2:] or [None])[0])
+
+# vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
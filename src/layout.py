@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+# Positions for the nodes of the strong set graph, worked out once when the
+# graph is refreshed instead of by a force simulation in every visitor's
+# browser. This is the Fruchterman-Reingold force-directed layout in
+# NumPy: every pair of nodes pushes apart, every link pulls its ends
+# together, and a little gravity keeps separate pieces of the graph from
+# drifting off. Repulsion is done a block of rows at a time to bound
+# memory, and on big graphs against a random sample of nodes per step.
+# Nodes that already had a position start from it, so the picture stays
+# about the same from one refresh to the next. Positions are in the unit
+# square.
+
+import logging
+import sys
+
+import numpy as np
+
+import config
+
+LAYOUT_ITERATIONS = getattr(config, 'LAYOUT_ITERATIONS', 100)
+LAYOUT_EXACT_NODES = getattr(config, 'LAYOUT_EXACT_NODES', 2000)
+LAYOUT_SAMPLE = 500                 # nodes to repel from per step above LAYOUT_EXACT_NODES
+BLOCK_ELEMENTS = 256 * 1024         # pairs of nodes per block of the repulsion step
+GRAVITY = 0.05
+
+def repulsion(pos, k, others, scale=1.0):
+    "Push from the nodes at others on each node in pos, k**2 / distance."
+    disp = np.zeros_like(pos)
+    (ox, oy) = (others[:, 0], others[:, 1])
+    rows = max(1, BLOCK_ELEMENTS // max(1, len(others)))
+    # the same scratch arrays for every block
+    (dx, dy, push) = (np.empty((rows, len(others))) for i in range(3))
+    for start in range(0, len(pos), rows):
+        block = pos[start:start + rows]
+        (bx, by, bp) = (dx[:len(block)], dy[:len(block)], push[:len(block)])
+        np.subtract(block[:, 0, np.newaxis], ox, out=bx)
+        np.subtract(block[:, 1, np.newaxis], oy, out=by)
+        np.multiply(bx, bx, out=bp)
+        bp += by * by
+        np.maximum(bp, 1e-9, out=bp)
+        np.divide(k * k * scale, bp, out=bp)
+        disp[start:start + len(block), 0] = np.einsum('ij,ij->i', bx, bp)
+        disp[start:start + len(block), 1] = np.einsum('ij,ij->i', by, bp)
+    return disp
+
+def force_layout(count, sources, targets, initial=None, iterations=LAYOUT_ITERATIONS, seed=0):
+    '''
+    Positions for count nodes joined by links from sources[i] to targets[i], node numbers.
+    initial is an optional list of the (x, y) each node starts at, or None for a random start.
+    Returns a (count, 2) array of positions between 0 and 1.
+    '''
+    if count == 0:
+        return np.zeros((0, 2))
+    random = np.random.RandomState(seed)
+    pos = random.random_sample((count, 2))
+    if count == 1:
+        return np.full((1, 2), 0.5)
+    for (i, start) in enumerate(initial or []):
+        if start is not None:
+            pos[i] = start
+    (sources, targets) = (np.asarray(sources, dtype=np.intp), np.asarray(targets, dtype=np.intp))
+    k = np.sqrt(1.0 / count)
+    temperature = 0.1
+    for step in range(iterations):
+        if count > LAYOUT_EXACT_NODES:
+            sample = random.choice(count, LAYOUT_SAMPLE, replace=False)
+            disp = repulsion(pos, k, pos[sample], count / float(LAYOUT_SAMPLE))
+        else:
+            disp = repulsion(pos, k, pos)
+        if len(sources):
+            delta = pos[sources] - pos[targets]
+            dist = np.sqrt((delta ** 2).sum(axis=1))[:, np.newaxis]
+            pull = delta * dist / k
+            np.add.at(disp, sources, -pull)
+            np.add.at(disp, targets, pull)
+        disp -= (pos - pos.mean(axis=0)) * GRAVITY * count * k
+        length = np.maximum(np.sqrt((disp ** 2).sum(axis=1)), 1e-9)[:, np.newaxis]
+        pos += disp / length * np.minimum(length, temperature)
+        temperature *= 1.0 - 1.0 / iterations
+    pos -= pos.min(axis=0)
+    return pos / max(pos.max(), 1e-9)
+
+
+if __name__ == "__main__":
+    from eyeball import Eyeball
+    logging.basicConfig(level=logging.INFO)
+    e = Eyeball()
+    # lay out the stored graph again, with a fresh start if asked
+    e.strongset.relayout(fresh='fresh' in sys.argv[1:])
+
+# vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+# Index of the mirror cache, in an SQLite file at the top of the cache
+# tree. spew_file, touch_file and SegmentStore keep it current, so listing the mirrored
+# URLs for a category, oldest first, or finding stale ones, is an indexed
+# query instead of a walk over millions of files. The files on disk are
+# the real data: if the manifest is lost or out of date, rebuild it with
+# "manifest.py rebuild [category]".
+
+import logging
+import os
+import sqlite3
+import sys
+import time
+from urllib.parse import unquote
+
+import config
+import utils
+
+MIRROR_MANIFEST = getattr(config, 'MIRROR_MANIFEST', True)
+STATUS_HEADER = 'X-Eyeball-Status'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS mirror_file (
+    path TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    category TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    content_hash TEXT,
+    status INTEGER
+);
+CREATE INDEX IF NOT EXISTS mirror_file_age ON mirror_file (category, mtime);
+CREATE INDEX IF NOT EXISTS mirror_file_url ON mirror_file (url);
+'''
+
+def split_path(filename):
+    "(category, url) for a file under url_to_path(..., kind='latest'), or None for anything else."
+    parts = os.path.relpath(filename, utils.root).split(os.sep)
+    if len(parts) != 6 or parts[4] != 'latest' or parts[0] in ('blobs', 'segments'):
+        return None
+    return (parts[0], unquote(parts[5]))
+
+def header_status(headers):
+    "HTTP status from a dict of saved headers, or None for a placeholder with no headers."
+    if not headers:
+        return None
+    return int(headers.get(STATUS_HEADER.lower(), 200))
+
+def entry_row(url, category, size, mtime, content_hash, status):
+    "Manifest row for a URL not kept in a file of its own, under the path FileStore would use."
+    return (utils.url_to_path(url, category), url, category, size, mtime, content_hash, status)
+
+
+class Manifest(object):
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        (self.conn, self.pid) = (None, None)
+
+    def connect(self):
+        # sqlite connections must not be shared across a fork
+        if self.conn is None or self.pid != os.getpid():
+            filename = self.filename or os.path.join(utils.root, 'manifest.sqlite')
+            self.conn = sqlite3.connect(filename, timeout=60)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.executescript(SCHEMA)
+            self.pid = os.getpid()
+        return self.conn
+
+    def describe(self, filename, content_hash=None):
+        "Manifest row for a mirrored file, or None if it is not one. Hashes the body unless given content_hash."
+        where = split_path(filename)
+        if where is None:
+            return None
+        (category, url) = where
+        stat = os.stat(filename)
+        headers = utils.read_headers(filename)
+        if not headers:
+            # placeholder left by a fetch that has not succeeded yet
+            content_hash = None
+        elif content_hash is None:
+            content_hash = headers.get('x-eyeball-blob') or utils.body_hash(filename)
+        status = header_status(headers)
+        return (filename, url, category, stat.st_size, stat.st_mtime, content_hash, status)
+
+    def insert(self, row):
+        with self.connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO mirror_file VALUES (?, ?, ?, ?, ?, ?, ?)', row)
+
+    def record(self, filename, content_hash=None):
+        "Add or update the entry for a file that has just been written, and its body hash if known."
+        if not MIRROR_MANIFEST:
+            return
+        try:
+            row = self.describe(filename, content_hash)
+            if row is not None:
+                self.insert(row)
+        except (OSError, sqlite3.Error) as e:
+            logging.warning("Manifest not updated for %s: %s" % (filename, e))
+
+    def record_entry(self, url, category, size, mtime, content_hash, status):
+        "Add or update the entry for a URL not kept in a file of its own, such as a segment record."
+        if not MIRROR_MANIFEST:
+            return
+        try:
+            self.insert(entry_row(url, category, size, mtime, content_hash, status))
+        except sqlite3.Error as e:
+            logging.warning("Manifest not updated for %s: %s" % (url, e))
+
+    def touched(self, filename, mtime=None):
+        """Update the mtime for a file that has just been touched. Pass mtime for an entry
+        added by record_entry, which has no file to look at."""
+        if not MIRROR_MANIFEST or split_path(filename) is None:
+            return
+        try:
+            with self.connect() as conn:
+                updated = conn.execute('UPDATE mirror_file SET mtime = ? WHERE path = ?',
+                                       (mtime or os.path.getmtime(filename), filename)).rowcount
+        except (OSError, sqlite3.Error) as e:
+            logging.warning("Manifest not updated for %s: %s" % (filename, e))
+            return
+        if not updated and mtime is None:
+            self.record(filename)
+
+    def urls(self, category):
+        "Mirrored URLs in category, least recently checked first."
+        rows = self.connect().execute('''SELECT url FROM mirror_file WHERE category = ?
+                                         ORDER BY mtime''', (category,))
+        return [row[0] for row in rows]
+
+    def stale(self, category, max_age, limit=None):
+        "URLs in category not checked for max_age seconds, oldest first."
+        rows = self.connect().execute('''SELECT url FROM mirror_file WHERE category = ? AND mtime < ?
+                                         ORDER BY mtime LIMIT ?''',
+                                      (category, time.time() - max_age, -1 if limit is None else limit))
+        return [row[0] for row in rows]
+
+    def get(self, url, category):
+        "(path, size, mtime, content_hash, status) for url, or None."
+        return self.connect().execute('''SELECT path, size, mtime, content_hash, status FROM mirror_file
+                                         WHERE url = ? AND category = ?''', (url, category)).fetchone()
+
+    def rebuild(self, category=None, entries=()):
+        """Replace the entries for category, or for everything, with what is on disk. entries
+        has the rows for URLs not kept in files of their own, from the mirror's manifest_rows()."""
+        categories = [category] if category else [name for name in os.listdir(utils.root)
+                                                  if name not in ('blobs', 'segments')
+                                                  and os.path.isdir(os.path.join(utils.root, name))]
+        count = 0
+        conn = self.connect()
+        for category in categories:
+            with conn:
+                conn.execute('DELETE FROM mirror_file WHERE category = ?', (category,))
+                batch = []
+                for (dirpath, dirs, files) in os.walk(os.path.join(utils.root, category)):
+                    for filename in files:
+                        try:
+                            row = self.describe(os.path.join(dirpath, filename))
+                        except OSError:
+                            continue
+                        if row is not None:
+                            batch.append(row)
+                    if len(batch) >= 1000:
+                        conn.executemany('INSERT OR REPLACE INTO mirror_file VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                         batch)
+                        count += len(batch)
+                        batch = []
+                conn.executemany('INSERT OR REPLACE INTO mirror_file VALUES (?, ?, ?, ?, ?, ?, ?)', batch)
+                count += len(batch)
+            logging.info("Manifest rebuilt for %s" % category)
+        with conn:
+            for row in entries:
+                conn.execute('INSERT OR REPLACE INTO mirror_file VALUES (?, ?, ?, ?, ?, ?, ?)', row)
+                count += 1
+        return count
+
+manifest = Manifest()
+
+
+if __name__ == "__main__":
+    from store import mirror
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 2 or sys.argv[1] != 'rebuild':
+        print("usage: %s rebuild [category]" % sys.argv[0])
+        sys.exit(1)
+    category = (sys.argv[2:] or [None])[0]
+    print("%d file(s) indexed" % manifest.rebuild(category, mirror.manifest_rows(category)))
+
+# vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
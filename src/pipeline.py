@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+# Parallel parsing. A pool of PARSE_WORKERS processes reads mirrored
+# ads.txt and sellers.json files and turns them into validated
+# relationship rows, without touching the database. The parent process is
+# the only writer: it stores each parsed file and its rows, a file at a
+# time inside one transaction per PARSE_COMMIT_ROWS rows or so, so parse
+# throughput grows with the number of cores while the database sees one
+# connection doing large batches.
+
+import logging
+from multiprocessing import Pool, cpu_count
+import sys
+import time
+from urllib.parse import urlparse
+
+import config
+from crawl import domain_to_url
+from domains import is_domain
+from ingest import PARSE_INCREMENTAL
+from sellers import SELLERS_KEEP_FULLTEXT
+from store import mirror, snarf_file
+
+PARSE_PIPELINE = getattr(config, 'PARSE_PIPELINE', False)
+PARSE_WORKERS = getattr(config, 'PARSE_WORKERS', None) or cpu_count()
+PARSE_COMMIT_ROWS = getattr(config, 'PARSE_COMMIT_ROWS', 100000)
+PARSE_IDLE_SLEEP = 10
+
+# Domains named in column of relationship, with no parsed file in table unless
+# the WHERE is left out, in one query instead of a lookup per domain
+UNPARSED = '''SELECT domain FROM (SELECT DISTINCT %(column)s AS domain FROM relationship
+                                  WHERE %(column)s IS NOT NULL) AS known
+              %(where)s ORDER BY domain'''
+UNPARSED_WHERE = 'WHERE NOT EXISTS (SELECT 1 FROM %(table)s WHERE %(table)s.domain = known.domain)'
+
+def url_domain(url):
+    return urlparse(url).netloc.split(':')[0]
+
+def parse_worker(target):
+    '''
+    Parse one mirrored file in a pool process. target is (url, category, hash of the last
+    version parsed). Returns (url, category, entry, rows), with an AdsTxt or Sellers entry that
+    is not saved yet, or None if there is nothing to load.
+    '''
+    (url, category, parsed_hash) = target
+    eyeball = Pipeline.eyeball
+    domain = url_domain(url)
+    try:
+        content_hash = mirror.content_hash(url, category)
+        if content_hash == parsed_hash:
+            return None
+        if 'ads' == category:
+            if not is_domain(domain):
+                logging.info("Skipping %s - not a domain." % domain)
+                return None
+            entry = eyeball.adstxt(domain, snarf_file(url, 'ads'), content_hash=content_hash)
+            rels = eyeball.adstxt.parse_lines(entry, url)
+        else:
+            fulltext = snarf_file(url, 'sellers') if SELLERS_KEEP_FULLTEXT else None
+            entry = eyeball.sellers(domain, fulltext=fulltext, content_hash=content_hash)
+            header = {}
+            with mirror.open_body(url, 'sellers') as fdin:
+                rels = list(eyeball.sellers.parse_sellers(entry, fdin, header, url))
+            entry.set_header(header)
+    except FileNotFoundError:
+        logging.warning("No %s file cached for %s" % (category, url))
+        return None
+    except Exception as e:
+        logging.error("Failed to parse %s: %s" % (url, e))
+        return None
+    return (url, category, entry, [eyeball.ingest.row(rel) for rel in rels])
+
+
+class Pipeline(object):
+    eyeball = None
+
+    @classmethod
+    def _store(cls, curs, parsed):
+        "Write one parsed file. Returns the domains it lists, or None if skipped."
+        (url, category, entry, rows) = parsed
+        if 'ads' == category:
+            (kind, column, discovered) = ('adstxt', 3, 'sellers')
+        else:
+            (kind, column, discovered) = ('sellersjson', 4, 'ads')
+        if entry.is_parsed(entry.domain, entry.content_hash):
+            return None
+        entry._persist(curs)
+        rows = [row[:column] + (entry.id,) + row[column + 1:] for row in rows]
+        loader = cls.eyeball.ingest.loader(curs, kind, entry.domain)
+        loader.add(rows)
+        loader.finish()
+        found = [row[1 if 'ads' == category else 0] for row in rows]
+        if cls.eyeball.jobs.enabled:
+            cls.eyeball.jobs.enqueue(found, discovered, cursor=curs)
+        return found
+
+    @classmethod
+    def write(cls, results, discovered=None):
+        '''
+        Drain parsed files into the database in large transactions. Returns the URLs written.
+        The domains the files list are added to the discovered set, if there is one.
+        '''
+        (done, pending, count) = ([], [], 0)
+        with cls.eyeball.cursor() as curs:
+            for parsed in results:
+                if parsed is None:
+                    continue
+                curs.execute('SAVEPOINT parsed_file')
+                try:
+                    stored = cls._store(curs, parsed)
+                    curs.execute('RELEASE SAVEPOINT parsed_file')
+                except Exception as e:
+                    logging.error("Failed to store %s: %s" % (parsed[0], e))
+                    curs.execute('ROLLBACK TO SAVEPOINT parsed_file')
+                    continue
+                if stored is None:
+                    continue
+                pending.append(parsed[0])
+                count += len(stored)
+                if discovered is not None:
+                    discovered.update(d for d in stored if d)
+                if count >= PARSE_COMMIT_ROWS:
+                    curs.connection.commit()
+                    logging.info("Committed %d file(s), %d relationship(s)" % (len(pending), count))
+                    (done, pending, count) = (done + pending, [], 0)
+            curs.connection.commit()
+        return done + pending
+
+    @classmethod
+    def parsed_hashes(cls, targets):
+        "Content hash of the last file parsed for each (url, category) target, by url."
+        result = {}
+        with cls.eyeball.cursor() as curs:
+            for (category, table) in (('ads', 'adstxt'), ('sellers', 'sellersjson')):
+                urls = dict((url_domain(url), url) for (url, cat) in targets if cat == category)
+                if not urls:
+                    continue
+                curs.execute('''SELECT DISTINCT ON (domain) domain, content_hash FROM %s
+                                WHERE domain = ANY(%%s) ORDER BY domain, id DESC''' % table,
+                             (list(urls),))
+                for (domain, content_hash) in curs.fetchall():
+                    result[urls[domain]] = content_hash
+            curs.connection.commit()
+        return result
+
+    @classmethod
+    def run(cls, targets, workers=PARSE_WORKERS, discovered=None):
+        "Parse (url, category) pairs in a pool of processes and load the results."
+        targets = list(targets)
+        if not targets:
+            return []
+        hashes = cls.parsed_hashes(targets)
+        targets = [(url, category, hashes.get(url)) for (url, category) in targets]
+        with Pool(workers) as pool:
+            written = cls.write(pool.imap_unordered(parse_worker, targets, chunksize=4), discovered)
+            pool.close()
+            pool.join()
+        logging.info("Parsed %d of %d file(s)" % (len(written), len(targets)))
+        if written:
+            cls.eyeball.strongset.changed()
+        return written
+
+    @classmethod
+    def unparsed(cls, since=None):
+        '''
+        Known sources and sellers to parse, like parse_all. Unchanged files are skipped in run().
+        With PARSE_INCREMENTAL and since, when the last pass started, only files fetched with new
+        content since then.
+        '''
+        if PARSE_INCREMENTAL and since is not None:
+            for target in cls.eyeball.scheduler.changed_since(since):
+                yield target
+            return
+        for (column, table, category) in (('destination', 'sellersjson', 'sellers'),
+                                          ('source', 'adstxt', 'ads')):
+            # unchanged files are skipped later anyway with PARSE_INCREMENTAL, so take them all
+            where = '' if PARSE_INCREMENTAL else UNPARSED_WHERE % {'table': table}
+            for (domain,) in cls.eyeball.stream(UNPARSED % {'column': column, 'where': where}):
+                if is_domain(domain):
+                    yield (domain_to_url(domain, category), category)
+
+    @classmethod
+    def work(cls):
+        "Parse forever, from the crawl_jobs queue if it is in use, otherwise whatever is unparsed."
+        jobs = cls.eyeball.jobs
+        since = None
+        while True:
+            if jobs.enabled:
+                jobs.expire_leases()
+                targets = []
+                for category in ('sellers', 'ads'):
+                    targets += [(url, category) for url in jobs.lease(category, 'fetched', 'parsing')]
+                cls.run(targets)
+                jobs.finish([url for (url, category) in targets], 'parsed')
+                busy = targets
+            else:
+                started = cls.eyeball.scheduler.clock()
+                busy = cls.run(list(cls.unparsed(since)))
+                if PARSE_INCREMENTAL:
+                    since = started
+            if not busy:
+                time.sleep(PARSE_IDLE_SLEEP)
+
+
+if __name__ == "__main__":
+    from eyeball import Eyeball
+    logging.basicConfig(level=logging.INFO)
+    e = Eyeball()
+    if sys.argv[1:]:
+        # URLs ending in ads.txt or sellers.json
+        e.pipeline.run([(url, 'ads' if url.endswith('ads.txt') else 'sellers') for url in sys.argv[1:]])
+    else:
+        e.pipeline.work()
+
+# vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
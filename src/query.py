@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+# Building SQL for lookups with optional arguments. A predicate like
+# "(source = %s OR %s)" keeps the planner from using an index on source,
+# so emit only the predicates that were actually given.
+#
+# Long lists are paged by key, not OFFSET: a page starts after the sort key
+# of the last row on the page before, which the web pages pass along as an
+# opaque token.
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+import json
+
+# Columns of domain_rank (see analytics.py) that may be put into an ORDER BY.
+RANK_ORDERS = ('pagerank', 'in_degree', 'out_degree', 'chain_depth')
+
+def where(predicates):
+    '''
+    A WHERE clause ANDing "column = %s" for each (column, value) pair whose value is not None,
+    and the list of parameters to go with it. Both are empty if no value is given.
+    Column names are put into the SQL as they are, so they must not come from user input.
+    '''
+    (terms, params) = ([], [])
+    for (column, value) in predicates:
+        if value is None:
+            continue
+        terms.append('%s = %%s' % column)
+        params.append(value)
+    if not terms:
+        return ('', params)
+    return ('WHERE ' + ' AND '.join(terms), params)
+
+def encode_key(key):
+    "A URL-safe token for a sort key, a tuple of strings."
+    return urlsafe_b64encode(json.dumps(list(key)).encode('utf-8')).decode('ascii')
+
+def decode_key(token, length):
+    "The sort key in token. Raises ValueError if it is not a key of length strings."
+    key = json.loads(urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    if not isinstance(key, list) or len(key) != length or not all(isinstance(k, str) for k in key):
+        raise ValueError("Not a page key: %s" % token)
+    return tuple(key)
+
+
+# vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
@@ -1,16 +1,44 @@
 #!/usr/bin/env python3
 
 import logging
-import re
-import validators
 
-def extract_domain(text):
-    if validators.domain(text):
-        return text.lower()
-    for chunk in re.split('[^A-Za-z0-9-\.]', text):
-        if validators.domain(chunk):
-            return chunk.lower()
-    return text
+import config
+from domains import extract_domain, is_domain
+from ingest import UPDATES
+from query import where
+
+DOMAIN_PAGE_SIZE = getattr(config, 'DOMAIN_PAGE_SIZE', 100)
+MAX_PAGE_SIZE = 1000
+
+# Columns in the order Relationship() takes them
+FIELDS = '''source, destination, account_id, adstxt, sellersjson, is_confidential, seller_type,
+            account_type, certification_authority_id, is_passthrough, name, comment, created,
+            modified, id'''
+SELECT = '''SELECT %s FROM relationship %%s ORDER BY source, destination, account_id''' % FIELDS
+
+# The natural key (see schema.sql), which orders pages the way SELECT orders rows,
+# except for rows with no source, which come first
+KEY = "COALESCE(source, ''), destination, COALESCE(account_id, '')"
+
+# Upserting a single record never clears a file link, so a record from one file, or
+# from neither, leaves the other link as it was
+KEEP_LINKS = ('adstxt = COALESCE(EXCLUDED.adstxt, relationship.adstxt)',
+              'sellersjson = COALESCE(EXCLUDED.sellersjson, relationship.sellersjson)')
+
+# A domain's relationships as source and as seller, from an index range scan each.
+# The source >= condition follows from the key one, but lets the seller side start
+# its scan at the right place. LIMIT NULL is no limit.
+DOMAIN_SELECT = '''SELECT %(fields)s FROM (
+                       (SELECT %(fields)s FROM relationship
+                        WHERE COALESCE(source, '') = %%(domain)s AND (%(key)s) > %%(after)s
+                        ORDER BY %(key)s LIMIT %%(limit)s)
+                       UNION
+                       (SELECT %(fields)s FROM relationship
+                        WHERE destination = %%(domain)s AND COALESCE(source, '') >= %%(after_source)s
+                        AND (%(key)s) > %%(after)s
+                        ORDER BY %(key)s LIMIT %%(limit)s)
+                   ) AS domain_relationship
+                   ORDER BY %(key)s LIMIT %%(limit)s''' % {'fields': FIELDS, 'key': KEY}
 
 class Relationship(object):
     eyeball = None
@@ -49,6 +77,20 @@ class Relationship(object):
     def html(self):
         return '<a href="/domain/%s">%s</a> &rarr; <a href="/domain/%s">%s</a>' % (self.source, self.source, self.destination, self.destination)
 
+    def as_dict(self):
+        result = {}
+        for field in ('source', 'destination', 'account_id', 'adstxt', 'sellersjson', 'is_confidential',
+                      'seller_type', 'account_type', 'certification_authority_id', 'is_passthrough',
+                      'name', 'comment', 'id'):
+            result[field] = getattr(self, field)
+        for field in ('adstxt', 'sellersjson'):
+            if result[field] is not None and not isinstance(result[field], int):
+                result[field] = result[field].id
+        for field in ('created', 'modified'):
+            when = getattr(self, field)
+            result[field] = when.isoformat() if when else None
+        return result
+
     def __eq__(self, other):
         if (not self) or (not other):
             return False
@@ -76,9 +118,9 @@ class Relationship(object):
             result.append('account id but no seller domain')
         if self.adstxt and not self.destination:
             result.append('missing domain name for ad system')
-        if self.source and not validators.domain(self.source):
+        if self.source and not is_domain(self.source):
             result.append('%s does not appear to be a domain name' % self.source)
-        if self.destination and not validators.domain(self.destination):
+        if self.destination and not is_domain(self.destination):
             result.append('%s does not appear to be a domain name' % self.destination)
         if (self.account_type is not None and
            self.account_type != 'DIRECT' and self.account_type != 'RESELLER'):
@@ -111,11 +153,17 @@ class Relationship(object):
                  self.is_confidential, self.seller_type, self.account_type, self.certification_authority_id,
                  self.is_passthrough, self.name, self.comment, self.created, self.modified, self.id))
         else:
+            # only what this record's file says, as in a bulk load, so the other file's side stays
+            kind = 'sellersjson' if jid else 'adstxt'
+            updates = tuple(update for update in UPDATES[kind]
+                            if not update.startswith(kind + ' =')) + KEEP_LINKS
             curs.execute('''INSERT INTO relationship (source, destination, account_id, adstxt, sellersjson,
                             is_confidential, seller_type, account_type, certification_authority_id, is_passthrough,
                             name, comment)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                            RETURNING id''', 
+                            VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s)
+                            ON CONFLICT (COALESCE(source, ''), destination, COALESCE(account_id, ''))
+                            DO UPDATE SET %s
+                            RETURNING id''' % ', '.join(updates), 
                     (self.source, self.destination, self.account_id, aid, jid,
                      self.is_confidential, self.seller_type, self.account_type, self.certification_authority_id,
                      self.is_passthrough, self.name, self.comment))
@@ -129,7 +177,7 @@ class Relationship(object):
                 conn = cursor.connection
                 return self._persist(cursor)
             else:
-                with self.eyeball.conn.cursor() as curs:
+                with self.eyeball.cursor() as curs:
                     conn = curs.connection
                     self._persist(curs)
                     conn.commit()
@@ -142,41 +190,40 @@ class Relationship(object):
 
     @classmethod
     def lookup_all(cls, rid=None, source=None, destination=None, account_id=None, cursor=None):
-        (all_rids, all_sources, all_destinations, all_account_ids) = (False, False, False, False)
-        if rid is None:
-            all_rids = True
-        if not source:
-            all_sources = True
-        if not destination:
-            all_destinations = True
-        if account_id is None:
-            all_account_ids = True
-        else:
+        if account_id is not None:
             account_id = str(account_id)
         result = []
         if rid is None and source is None and destination is None and account_id is None:
             return result
+        (clause, params) = cls._where(rid, source, destination, account_id)
         if cursor is None:
-            cursor = cls.eyeball.conn.cursor()
+            # a lookup by id is one row, otherwise it could be a big ad system's whole list
+            cursor = cls.eyeball.cursor(server_side=rid is None)
         try:
             with cursor as curs:
-                curs.execute('''SELECT source, destination, account_id, adstxt, sellersjson,
-                                is_confidential, seller_type, account_type, certification_authority_id,
-                                is_passthrough, name, comment, created, modified, id FROM relationship WHERE 
-                                (id = %s OR %s) AND
-                                (source = %s OR %s) AND
-                                (destination = %s OR %s) AND
-                                (account_id = %s OR %s)
-                                ORDER BY source, destination, account_id
-                                ''', (rid, all_rids, source, all_sources,
-                                      destination, all_destinations,
-                                      account_id, all_account_ids))
-                for row in curs.fetchall():
+                curs.execute(SELECT % clause, params)
+                for row in curs:
                     result.append(cls(*row))
         except Exception as exc:
             logging.warning(exc)
         return result
 
+    @classmethod
+    def iter_all(cls, rid=None, source=None, destination=None, account_id=None):
+        "Like lookup_all, but generates the matches a batch at a time instead of making a list."
+        if account_id is not None:
+            account_id = str(account_id)
+        if rid is None and source is None and destination is None and account_id is None:
+            return
+        (clause, params) = cls._where(rid, source, destination, account_id)
+        for row in cls.eyeball.stream(SELECT % clause, params):
+            yield cls(*row)
+
+    @staticmethod
+    def _where(rid, source, destination, account_id):
+        return where((('id', rid), ('source', source or None),
+                      ('destination', destination or None), ('account_id', account_id)))
+
     @classmethod
     def lookup_one(cls, rid=None, source=None, destination=None, account_id=None, cursor=None):
         try:
@@ -195,21 +242,59 @@ class Relationship(object):
             return tmp
         return cls(source, destination, account_id)
 
+    @classmethod
+    def domain_page(cls, domain, after=None, limit=DOMAIN_PAGE_SIZE):
+        '''
+        A page of the relationships that domain is the source or destination of, and the key to
+        pass as after for the next page, or None for the last page. after is the key of the last
+        relationship on the page before.
+        '''
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        after = tuple(after or ('', '', ''))
+        with cls.eyeball.cursor() as curs:
+            # one row more than the page, to tell if there is another
+            curs.execute(DOMAIN_SELECT, {'domain': domain, 'after': after, 'after_source': after[0],
+                                         'limit': limit + 1})
+            rows = curs.fetchall()
+        rels = [cls(*row) for row in rows[:limit]]
+        if len(rows) > limit:
+            # as stored, since the constructor tidies up domains
+            (source, destination, account_id) = rows[limit - 1][:3]
+            return (rels, (source or '', destination, account_id or ''))
+        return (rels, None)
+
+    @classmethod
+    def iter_domain(cls, domain):
+        "All the relationships that domain is the source or destination of, in page order."
+        params = {'domain': domain, 'after': ('', '', ''), 'after_source': '', 'limit': None}
+        for row in cls.eyeball.stream(DOMAIN_SELECT, params):
+            yield cls(*row)
+
+    @classmethod
+    def summary(cls, domain):
+        "Counts of domain's relationships, without reading them."
+        with cls.eyeball.cursor() as curs:
+            # one scan of each side, since the pages call this for every domain they show
+            curs.execute('''SELECT COUNT(*), COUNT(*) FILTER (WHERE adstxt IS NOT NULL)
+                            FROM relationship WHERE COALESCE(source, '') = %s''', (domain,))
+            (as_source, in_adstxt) = curs.fetchone()
+            curs.execute('''SELECT COUNT(*), COUNT(*) FILTER (WHERE sellersjson IS NOT NULL)
+                            FROM relationship WHERE destination = %s''', (domain,))
+            (as_destination, in_sellersjson) = curs.fetchone()
+        return {'as_source': as_source, 'as_destination': as_destination,
+                'in_adstxt': in_adstxt, 'in_sellersjson': in_sellersjson}
+
     @classmethod
     def all_sellers(cls):
-        with cls.eyeball.conn.cursor() as curs:
-            curs.execute('SELECT DISTINCT destination FROM relationship ORDER BY destination')
-            for row in curs.fetchall():
-                if validators.domain(row[0]):
-                    yield(row[0])
+        for (domain,) in cls.eyeball.stream('SELECT DISTINCT destination FROM relationship ORDER BY destination'):
+            if is_domain(domain):
+                yield(domain)
 
     @classmethod
     def all_sources(cls):
-        with cls.eyeball.conn.cursor() as curs:
-            curs.execute('SELECT DISTINCT source FROM relationship ORDER BY source')
-            for row in curs.fetchall():
-                if validators.domain(row[0]):
-                    yield(row[0])
+        for (domain,) in cls.eyeball.stream('SELECT DISTINCT source FROM relationship ORDER BY source'):
+            if is_domain(domain):
+                yield(domain)
 
     @classmethod
     def strong_set(cls):
@@ -217,11 +302,11 @@ class Relationship(object):
         (nodelist, edgelist) = ([], [])
         node_number = {}
         for item in cls.two_way_links():
-            if not node_number.get(item.source):
+            if item.source not in node_number:
                 nodelist.append({'name': item.source})
                 node_number[item.source] = node_counter
                 node_counter += 1
-            if not node_number.get(item.destination):
+            if item.destination not in node_number:
                 nodelist.append({'name': item.destination})
                 node_number[item.destination] = node_counter
                 node_counter += 1
@@ -232,44 +317,36 @@ class Relationship(object):
     def two_way_links(cls):
         connected = {}
         (last_source, last_destination) = (None, None)
-        with cls.eyeball.conn.cursor() as curs:
-            curs.execute('''SELECT DISTINCT source, destination, account_id, adstxt, sellersjson,
-                            is_confidential, seller_type, account_type, certification_authority_id,
-                            is_passthrough, name, comment, created, modified, id FROM relationship WHERE 
-                            source = 'nytimes.com' AND destination IS NOT NULL 
-                            ORDER BY source, destination, account_id
-                            ''')
-            for row in curs.fetchall():
-                tmp = cls(*row)
-                if not tmp.is_valid:
-                    continue
-                if not tmp.source or not tmp.destination:
-                    continue
-                connected[tmp.source] = 1
-                connected[tmp.destination] = 1
-                yield tmp
-
-            curs.execute('''SELECT DISTINCT source, destination, account_id, adstxt, sellersjson,
-                            is_confidential, seller_type, account_type, certification_authority_id,
-                            is_passthrough, name, comment, created, modified, id FROM relationship WHERE 
-                            source IS NOT NULL AND destination IS NOT NULL AND
-                            sellersjson IS NOT NULL and adstxt IS NOT NULL
-                            ORDER BY source, destination, account_id
-                            ''')
-            for row in curs.fetchall():
-                tmp = cls(*row)
-                if not tmp.is_valid:
-                    continue
-                if not tmp.source or not tmp.destination:
-                    continue
-                if tmp.source == last_source or tmp.destination == last_destination:
-                    continue
-                if not connected.get(tmp.source) and not connected.get(tmp.destination):
-                    continue
-                connected[tmp.source] = 1
-                connected[tmp.destination] = 1
-                (last_source, last_destination) = (tmp.source, tmp.destination)
-                yield tmp
+        seeds = cls.eyeball.stream('''SELECT DISTINCT %s FROM relationship WHERE
+                                      source = 'nytimes.com' AND destination IS NOT NULL
+                                      ORDER BY source, destination, account_id''' % FIELDS)
+        for row in seeds:
+            tmp = cls(*row)
+            if not tmp.is_valid:
+                continue
+            if not tmp.source or not tmp.destination:
+                continue
+            connected[tmp.source] = 1
+            connected[tmp.destination] = 1
+            yield tmp
 
+        links = cls.eyeball.stream('''SELECT DISTINCT %s FROM relationship WHERE
+                                      source IS NOT NULL AND destination IS NOT NULL AND
+                                      sellersjson IS NOT NULL and adstxt IS NOT NULL
+                                      ORDER BY source, destination, account_id''' % FIELDS)
+        for row in links:
+            tmp = cls(*row)
+            if not tmp.is_valid:
+                continue
+            if not tmp.source or not tmp.destination:
+                continue
+            if tmp.source == last_source or tmp.destination == last_destination:
+                continue
+            if not connected.get(tmp.source) and not connected.get(tmp.destination):
+                continue
+            connected[tmp.source] = 1
+            connected[tmp.destination] = 1
+            (last_source, last_destination) = (tmp.source, tmp.destination)
+            yield tmp
 
 # vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+# Revisit scheduling. Every mirrored URL gets a row in crawl_schedule with
+# the hash of its body at the last fetch and a revisit interval. The
+# interval shrinks when a fetch finds new content and grows when it does
+# not, between CRAWL_MIN_INTERVAL and CRAWL_MAX_INTERVAL, so busy
+# sellers.json files get checked often and parked domains rarely. No
+# URL goes longer than CRAWL_MAX_INTERVAL without a check. The first fetch
+# of a URL only sets the baseline hash. A failed fetch is retried after
+# CRAWL_MIN_INTERVAL, doubling with each failure in a row.
+
+import logging
+import time
+
+import config
+from crawl import NOT_MODIFIED
+from store import mirror
+
+CRAWL_MIN_INTERVAL = getattr(config, 'CRAWL_MIN_INTERVAL', 3600)
+CRAWL_MAX_INTERVAL = getattr(config, 'CRAWL_MAX_INTERVAL', 7 * 86400)
+CRAWL_INITIAL_INTERVAL = getattr(config, 'CRAWL_INITIAL_INTERVAL', 86400)
+CRAWL_BATCH_SIZE = getattr(config, 'JOB_BATCH_SIZE', 500)
+CHANGED_FACTOR = 0.5
+UNCHANGED_FACTOR = 1.5
+CHANGE_OVERLAP = 300  # seconds before a time to look for changes from, for transactions still open
+
+class Scheduler(object):
+    eyeball = None
+
+    @staticmethod
+    def next_interval(interval, changed):
+        if interval is None:
+            interval = CRAWL_INITIAL_INTERVAL
+        interval = interval * (CHANGED_FACTOR if changed else UNCHANGED_FACTOR)
+        return int(min(max(interval, CRAWL_MIN_INTERVAL), CRAWL_MAX_INTERVAL))
+
+    @classmethod
+    def seed(cls, targets=None, batch_size=1000):
+        "Schedule an immediate fetch of any URL that is not scheduled yet."
+        if targets is None:
+            targets = cls.eyeball.crawler.all_target_urls()
+        count = 0
+        with cls.eyeball.cursor() as curs:
+            batch = []
+            for target in targets:
+                batch.append(target)
+                if len(batch) >= batch_size:
+                    count += cls._seed(curs, batch)
+                    batch = []
+            if batch:
+                count += cls._seed(curs, batch)
+            curs.connection.commit()
+        if count:
+            logging.info("Scheduled %d new URL(s)" % count)
+        return count
+
+    @classmethod
+    def _seed(cls, curs, batch):
+        curs.execute('''INSERT INTO crawl_schedule (url, category, revisit_interval)
+                        SELECT unnest(%s::TEXT[]), unnest(%s::TEXT[]), %s
+                        ON CONFLICT (url) DO NOTHING''',
+                     ([url for (url, category) in batch], [category for (url, category) in batch],
+                      CRAWL_INITIAL_INTERVAL))
+        return curs.rowcount
+
+    @classmethod
+    def due(cls, limit=CRAWL_BATCH_SIZE):
+        '''
+        Take up to limit URLs that are due, oldest first, as (url, category) pairs.
+        Their next check is provisionally pushed out by their current interval, so
+        other schedulers skip them and a failed fetch is retried one interval later.
+        '''
+        with cls.eyeball.cursor() as curs:
+            curs.execute('''UPDATE crawl_schedule
+                            SET next_due = NOW() + revisit_interval * INTERVAL '1 second'
+                            WHERE url IN (
+                                SELECT url FROM crawl_schedule
+                                WHERE next_due <= NOW()
+                                ORDER BY next_due
+                                LIMIT %s
+                                FOR UPDATE SKIP LOCKED)
+                            RETURNING url, category''', (limit,))
+            result = curs.fetchall()
+            curs.connection.commit()
+        return result
+
+    @staticmethod
+    def _failed(curs, failed):
+        "Put off the next try of failed (url, category) targets, longer for each failure in a row."
+        curs.execute('''INSERT INTO crawl_schedule (url, category, revisit_interval, next_due, failure_count)
+                        SELECT url, category, %(initial)s, NOW() + %(min)s * INTERVAL '1 second', 1
+                        FROM unnest(%(urls)s::TEXT[], %(categories)s::TEXT[]) AS failed (url, category)
+                        ON CONFLICT (url) DO UPDATE SET
+                        failure_count = crawl_schedule.failure_count + 1,
+                        next_due = NOW() + LEAST(%(min)s * 2 ^ crawl_schedule.failure_count, %(max)s)
+                                           * INTERVAL '1 second'
+                        ''', {'urls': [url for (url, category) in failed],
+                              'categories': [category for (url, category) in failed],
+                              'initial': CRAWL_INITIAL_INTERVAL, 'min': CRAWL_MIN_INTERVAL,
+                              'max': CRAWL_MAX_INTERVAL})
+
+    @classmethod
+    def observe(cls, targets, results):
+        "Update the schedule from the results of mirroring (url, category) targets."
+        failed = [(url, category) for (url, category) in targets if not results.get(url)]
+        targets = [(url, category) for (url, category) in targets if results.get(url)]
+        if not targets and not failed:
+            return
+        with cls.eyeball.cursor() as curs:
+            if failed:
+                cls._failed(curs, failed)
+            curs.execute('''SELECT url, content_hash, revisit_interval FROM crawl_schedule
+                            WHERE url = ANY(%s)''', ([url for (url, category) in targets],))
+            known = dict((row[0], row[1:]) for row in curs.fetchall())
+            for (url, category) in targets:
+                (old_hash, interval) = known.get(url, (None, None))
+                new_hash = old_hash
+                if results[url] != NOT_MODIFIED:
+                    try:
+                        new_hash = mirror.content_hash(url, category)
+                    except FileNotFoundError:
+                        continue
+                # the first fetch is the baseline to tell changes from, not a change
+                first = old_hash is None
+                changed = not first and new_hash != old_hash
+                interval = interval or CRAWL_INITIAL_INTERVAL
+                if not first:
+                    interval = cls.next_interval(interval, changed)
+                curs.execute('''INSERT INTO crawl_schedule (url, category, content_hash, revisit_interval,
+                                next_due, last_fetched, last_changed, fetch_count, change_count)
+                                VALUES (%s, %s, %s, %s, NOW() + %s * INTERVAL '1 second', NOW(), NOW(), 1, 0)
+                                ON CONFLICT (url) DO UPDATE SET
+                                content_hash = EXCLUDED.content_hash,
+                                revisit_interval = EXCLUDED.revisit_interval,
+                                next_due = EXCLUDED.next_due,
+                                last_fetched = NOW(),
+                                last_changed = CASE WHEN %s OR crawl_schedule.last_changed IS NULL
+                                               THEN NOW() ELSE crawl_schedule.last_changed END,
+                                fetch_count = crawl_schedule.fetch_count + 1,
+                                change_count = crawl_schedule.change_count + %s::INT,
+                                failure_count = 0
+                                ''', (url, category, new_hash, interval, interval, changed, changed))
+                if changed or first:
+                    curs.execute('''INSERT INTO crawl_history (url, content_hash) VALUES (%s, %s)''',
+                                 (url, new_hash))
+            curs.connection.commit()
+
+    @classmethod
+    def clock(cls):
+        "The database's time, to compare with the times in crawl_schedule."
+        with cls.eyeball.cursor() as curs:
+            curs.execute('SELECT NOW()::TIMESTAMP')
+            now = curs.fetchone()[0]
+            curs.connection.commit()
+        return now
+
+    @classmethod
+    def changed_since(cls, since, urls=None):
+        '''
+        The (url, category) pairs fetched with new content since a time from clock(), or only those
+        of a list of urls.
+        '''
+        query = "SELECT url, category FROM crawl_schedule WHERE last_changed >= %s - %s * INTERVAL '1 second'"
+        params = [since, CHANGE_OVERLAP]
+        if urls is not None:
+            query += ' AND url = ANY(%s)'
+            params.append(list(urls))
+        with cls.eyeball.cursor() as curs:
+            curs.execute(query, params)
+            result = curs.fetchall()
+            curs.connection.commit()
+        return result
+
+    @classmethod
+    def requeue_due(cls, limit=CRAWL_BATCH_SIZE):
+        "Put due URLs back on the crawl_jobs queue."
+        return cls.eyeball.jobs.requeue(cls.due(limit))
+
+    @classmethod
+    def run(cls, idle_sleep=60):
+        "Mirror whatever is due, forever."
+        cls.seed()
+        while True:
+            # a stale strong set that was too recently refreshed to claim is picked up here
+            cls.eyeball.strongset.refresh_if_due()
+            targets = cls.due()
+            if not targets:
+                time.sleep(idle_sleep)
+                cls.seed()
+                continue
+            results = cls.eyeball.crawler.mirror_urls(targets, max_age=0)
+            cls.observe(targets, results)
+
+
+# vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
@@ -14,6 +14,8 @@ CREATE TABLE IF NOT EXISTS adstxt (
 	created TIMESTAMP NOT NULL DEFAULT NOW(),
 	modified TIMESTAMP NOT NULL DEFAULT NOW()
 );
+ALTER TABLE adstxt ADD COLUMN IF NOT EXISTS content_hash TEXT; -- sha256 of the mirrored body
+CREATE INDEX IF NOT EXISTS adstxt_domain_hash ON adstxt (domain, content_hash);
 DROP TRIGGER IF EXISTS update_adstxt_modified ON adstxt;
 CREATE TRIGGER update_adstxt_modified BEFORE UPDATE ON adstxt FOR EACH ROW EXECUTE PROCEDURE update_modified_column();
 
@@ -29,6 +31,8 @@ CREATE TABLE IF NOT EXISTS sellersjson (
 	created TIMESTAMP NOT NULL DEFAULT NOW(),
 	modified TIMESTAMP NOT NULL DEFAULT NOW()
 );
+ALTER TABLE sellersjson ADD COLUMN IF NOT EXISTS content_hash TEXT; -- sha256 of the mirrored body
+CREATE INDEX IF NOT EXISTS sellersjson_domain_hash ON sellersjson (domain, content_hash);
 DROP TRIGGER IF EXISTS update_sellersjson_modified ON sellersjson;
 CREATE TRIGGER update_sellersjson_modified BEFORE UPDATE ON sellersjson FOR EACH ROW EXECUTE PROCEDURE update_modified_column();
 
@@ -72,6 +76,25 @@ CREATE TABLE IF NOT EXISTS relationship (
 	created TIMESTAMP NOT NULL DEFAULT NOW(),
 	modified TIMESTAMP NOT NULL DEFAULT NOW()
 );
+-- One row per (source, destination, account_id), so parsed files can be upserted in bulk.
+-- Remove any duplicates left from before, keeping the newest, then add the key.
+DO $$ BEGIN
+	IF NOT EXISTS (SELECT 1 FROM pg_class WHERE relname = 'relationship_natural_key') THEN
+		DELETE FROM relationship a USING relationship b
+		WHERE a.id < b.id AND COALESCE(a.source, '') = COALESCE(b.source, '')
+		AND a.destination = b.destination AND COALESCE(a.account_id, '') = COALESCE(b.account_id, '');
+	END IF;
+END $$;
+CREATE UNIQUE INDEX IF NOT EXISTS relationship_natural_key
+	ON relationship ((COALESCE(source, '')), destination, (COALESCE(account_id, '')));
+CREATE INDEX IF NOT EXISTS relationship_source ON relationship (source);
+CREATE INDEX IF NOT EXISTS relationship_destination_account ON relationship (destination, account_id);
+-- a seller's relationships in the order of the natural key, for paging (see Relationship.domain_page)
+CREATE INDEX IF NOT EXISTS relationship_destination_key
+	ON relationship (destination, (COALESCE(source, '')), (COALESCE(account_id, '')));
+CREATE INDEX IF NOT EXISTS relationship_adstxt ON relationship (adstxt);
+CREATE INDEX IF NOT EXISTS relationship_sellersjson ON relationship (sellersjson);
+CREATE INDEX IF NOT EXISTS relationship_modified ON relationship (modified);  -- for graph.py updates
 DROP TRIGGER IF EXISTS update_relationship_modified ON relationship;
 CREATE TRIGGER update_relationship_modified BEFORE UPDATE ON relationship FOR EACH ROW EXECUTE PROCEDURE update_modified_column();
 
@@ -84,11 +107,113 @@ EXCEPTION
         WHEN duplicate_object THEN null;
 END $$;
 
-CREATE TABLE crawl_jobs(
+ALTER TYPE crawl_job_status ADD VALUE IF NOT EXISTS 'parsed';
+ALTER TYPE crawl_job_status ADD VALUE IF NOT EXISTS 'failed';
+
+CREATE TABLE IF NOT EXISTS crawl_jobs(
 	url TEXT PRIMARY KEY,
 	status crawl_job_status, 
 	modified TIMESTAMP NOT NULL DEFAULT NOW()
 );
+ALTER TABLE crawl_jobs ADD COLUMN IF NOT EXISTS category TEXT NOT NULL DEFAULT 'ads'; -- 'ads' or 'sellers'
+ALTER TABLE crawl_jobs ADD COLUMN IF NOT EXISTS attempts INT NOT NULL DEFAULT 0;
+CREATE INDEX IF NOT EXISTS crawl_jobs_lease ON crawl_jobs (status, category, modified);
+
+-- revisit schedule, adjusted by how often each URL's content changes
+CREATE TABLE IF NOT EXISTS crawl_schedule (
+	url TEXT PRIMARY KEY,
+	category TEXT NOT NULL,                    -- 'ads' or 'sellers'
+	content_hash TEXT,                         -- sha256 of the body at the last fetch
+	revisit_interval INT NOT NULL,             -- seconds
+	next_due TIMESTAMP NOT NULL DEFAULT NOW(),
+	last_fetched TIMESTAMP,
+	last_changed TIMESTAMP,
+	fetch_count INT NOT NULL DEFAULT 0,
+	change_count INT NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS crawl_schedule_due ON crawl_schedule (next_due);
+CREATE INDEX IF NOT EXISTS crawl_schedule_changed ON crawl_schedule (last_changed);  -- for incremental parsing
+ALTER TABLE crawl_schedule ADD COLUMN IF NOT EXISTS failure_count INT NOT NULL DEFAULT 0;  -- failed fetches in a row
+
+-- one row for each time a URL was fetched with new content
+CREATE TABLE IF NOT EXISTS crawl_history (
+	url TEXT NOT NULL,
+	content_hash TEXT NOT NULL,
+	fetched TIMESTAMP NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS crawl_history_url ON crawl_history (url, fetched);
+
+-- negative cache of failed fetches, with exponential backoff
+CREATE TABLE IF NOT EXISTS fetch_failure (
+	url TEXT PRIMARY KEY,
+	host TEXT NOT NULL,
+	kind TEXT NOT NULL,            -- 'dns', 'connect' and 'timeout' block the whole host; 'http', 'size', 'error' just the URL
+	status INT,                    -- HTTP status, if any
+	failures INT NOT NULL DEFAULT 1,
+	retry_after TIMESTAMP NOT NULL,
+	modified TIMESTAMP NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS fetch_failure_retry ON fetch_failure (retry_after);
+CREATE INDEX IF NOT EXISTS fetch_failure_host ON fetch_failure (host);
+DROP TRIGGER IF EXISTS update_fetch_failure_modified ON fetch_failure;
+CREATE TRIGGER update_fetch_failure_modified BEFORE UPDATE ON fetch_failure FOR EACH ROW EXECUTE PROCEDURE update_modified_column();
 DROP TRIGGER IF EXISTS update_crawl_jobs_modified ON crawl_jobs;
 CREATE TRIGGER update_crawl_jobs_modified BEFORE UPDATE ON crawl_jobs FOR EACH ROW EXECUTE PROCEDURE update_modified_column();
 
+
+-- the strong set graph, as last worked out from relationship (see strongset.py)
+CREATE TABLE IF NOT EXISTS strong_node (
+	id INT PRIMARY KEY,            -- position in the node list
+	name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS strong_link (
+	source INT NOT NULL,           -- strong_node id
+	target INT NOT NULL
+);
+ALTER TABLE strong_link ADD COLUMN IF NOT EXISTS id BIGINT;  -- position in the link list
+ALTER TABLE strong_node ADD COLUMN IF NOT EXISTS degree INT NOT NULL DEFAULT 0;  -- number of links
+ALTER TABLE strong_node ADD COLUMN IF NOT EXISTS x REAL;  -- position in the unit square (see layout.py)
+ALTER TABLE strong_node ADD COLUMN IF NOT EXISTS y REAL;
+CREATE INDEX IF NOT EXISTS strong_node_name ON strong_node (name);
+CREATE INDEX IF NOT EXISTS strong_link_source ON strong_link (source);
+CREATE INDEX IF NOT EXISTS strong_link_target ON strong_link (target);
+CREATE TABLE IF NOT EXISTS strong_set_state (
+	id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),  -- only one row
+	stale BOOLEAN NOT NULL DEFAULT TRUE,
+	refreshed TIMESTAMP
+);
+INSERT INTO strong_set_state (id) VALUES (TRUE) ON CONFLICT DO NOTHING;
+
+-- bumped whenever parsed data changes, so cached web pages can tell they are out of date (see cache.py)
+CREATE TABLE IF NOT EXISTS data_generation (
+	id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),  -- only one row
+	generation BIGINT NOT NULL DEFAULT 0
+);
+INSERT INTO data_generation (id) VALUES (TRUE) ON CONFLICT DO NOTHING;
+
+-- whole-graph numbers for each domain, from the last batch run of analytics.py
+CREATE TABLE IF NOT EXISTS domain_rank (
+	name TEXT PRIMARY KEY,
+	component INT NOT NULL,        -- graph_component id
+	pagerank REAL NOT NULL,
+	in_degree INT NOT NULL,        -- domains that sell through this one
+	out_degree INT NOT NULL,       -- domains this one sells through
+	chain_depth INT NOT NULL       -- most hops to it from a DIRECT relationship on through RESELLER ones
+);
+CREATE INDEX IF NOT EXISTS domain_rank_pagerank ON domain_rank (pagerank DESC, name);
+CREATE INDEX IF NOT EXISTS domain_rank_in_degree ON domain_rank (in_degree DESC, name);
+CREATE INDEX IF NOT EXISTS domain_rank_out_degree ON domain_rank (out_degree DESC, name);
+CREATE INDEX IF NOT EXISTS domain_rank_chain_depth ON domain_rank (chain_depth DESC, name);
+CREATE TABLE IF NOT EXISTS graph_component (
+	id INT PRIMARY KEY,            -- 0 is the largest
+	size INT NOT NULL,
+	name TEXT NOT NULL             -- the domain in it with the highest pagerank
+);
+CREATE TABLE IF NOT EXISTS analytics_state (
+	id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),  -- only one row
+	computed TIMESTAMP,
+	domains INT,
+	relationships BIGINT,
+	max_chain_depth INT
+);
+INSERT INTO analytics_state (id) VALUES (TRUE) ON CONFLICT DO NOTHING;
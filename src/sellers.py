@@ -4,14 +4,83 @@ import json
 import logging
 from urllib.parse import urlparse
 
-from utils import path_to_url, snarf_file
+import config
+from query import where
+from store import mirror, snarf_file
+from utils import path_to_url
+
+SELLERS_KEEP_FULLTEXT = getattr(config, 'SELLERS_KEEP_FULLTEXT', False)
+INGEST_BATCH_SIZE = 10000
+CHUNK_SIZE = 65536
+
+def iter_sellers(fdin, header, chunk_size=CHUNK_SIZE):
+    '''
+    Yield the entries of a sellers.json "sellers" array one at a time, reading fdin a
+    chunk at a time, so memory use depends on the largest entry, not the file size.
+    The other top-level members are put in the header dict as they are read, so the
+    ones that come after "sellers" are only there once the generator is finished.
+    Raises json.JSONDecodeError for anything that is not a sellers.json object.
+    '''
+    decoder = json.JSONDecoder()
+    state = {'buf': '', 'pos': 0, 'eof': False}
+
+    def fill():
+        if state['eof']:
+            raise json.JSONDecodeError("Unexpected end of file", state['buf'], len(state['buf']))
+        chunk = fdin.read(chunk_size)
+        state['buf'] = state['buf'][state['pos']:] + chunk
+        state['pos'] = 0
+        state['eof'] = not chunk
+
+    def peek(skip=' \t\r\n'):
+        "Next significant character, after anything in skip."
+        while True:
+            (buf, pos) = (state['buf'], state['pos'])
+            while pos < len(buf) and buf[pos] in skip:
+                pos += 1
+            state['pos'] = pos
+            if pos < len(buf):
+                return buf[pos]
+            fill()
+
+    def expect(char):
+        if peek() != char:
+            raise json.JSONDecodeError("Expecting '%s'" % char, state['buf'], state['pos'])
+        state['pos'] += 1
+
+    def value():
+        peek()
+        while True:
+            try:
+                (result, end) = decoder.raw_decode(state['buf'], state['pos'])
+                # a number may go on into the next chunk
+                if (not isinstance(result, (int, float)) or state['eof'] or
+                    state['buf'][end:end + 1] in (' ', '\t', '\r', '\n', ',', '}', ']')):
+                    state['pos'] = end
+                    return result
+            except json.JSONDecodeError:
+                if state['eof']:
+                    raise
+            fill()
+
+    expect('{')
+    while peek(' \t\r\n,') != '}':
+        key = value()
+        expect(':')
+        if 'sellers' != key:
+            header[key] = value()
+            continue
+        expect('[')
+        while peek(' \t\r\n,') != ']':
+            yield value()
+        state['pos'] += 1
 
 class Sellers(object):
     eyeball = None
 
     def __init__(self, domain, contact_email=None, contact_address=None,
                  version='1.0', ext=None,
-                 fulltext='', created=None, modified=None, sid=None):
+                 fulltext='', created=None, modified=None, sid=None, content_hash=None):
         self.id = sid
         self.domain = domain
         self.contact_email = contact_email
@@ -21,6 +90,7 @@ class Sellers(object):
         self.fulltext = fulltext
         self.created = created
         self.modified = modified
+        self.content_hash = content_hash
 
     def __repr__(self):
         return "sellers.json file from %s" % self.domain
@@ -45,17 +115,17 @@ class Sellers(object):
     def _persist(self, curs):
         if self.id is not None:
             curs.execute('''UPDATE sellersjson SET domain = %s, contact_email = %s, contact_address = %s, 
-                            version = %s, ext = %s, fulltext = %s
+                            version = %s, ext = %s, fulltext = %s, content_hash = %s
                             WHERE id = %s''',
                 (self.domain, self.contact_email, self.contact_address,
-                 self.version, self.ext, self.fulltext, self.id))
+                 self.version, self.ext, self.fulltext, self.content_hash, self.id))
         else:
             curs.execute('''INSERT INTO sellersjson (domain, contact_email, contact_address,
-                            version, ext, fulltext)
-                            VALUES (%s, %s, %s, %s, %s, %s)
+                            version, ext, fulltext, content_hash)
+                            VALUES (%s, %s, %s, %s, %s, %s, %s)
                             RETURNING id, created, modified''',
                 (self.domain, self.contact_email, self.contact_address,
-                 self.version, self.ext, self.fulltext))
+                 self.version, self.ext, self.fulltext, self.content_hash))
             (self.id, self.created, self.modified) = curs.fetchone()
         logging.debug("persisted %s" % self)
 
@@ -67,7 +137,7 @@ class Sellers(object):
                 self._persist(cursor)
                 return self
             else:
-                with self.eyeball.conn.cursor() as curs:
+                with self.eyeball.cursor() as curs:
                     conn = curs.connection
                     self._persist(curs)
                     conn.commit()
@@ -77,84 +147,115 @@ class Sellers(object):
             conn.rollback()
             return None
 
+    def set_header(self, header):
+        "Fill in the file-level fields from the top-level members of a sellers.json file."
+        self.contact_email = header.get('contact_email')
+        self.contact_address = header.get('contact_address')
+        self.version = str(header.get('version', '1.0'))
+        if header.get('ext') is not None:
+            self.ext = json.dumps(header['ext'])
+
+    @classmethod
+    def parse_sellers(cls, entry, fdin, header, url):
+        "Yield valid relationships from the body of the sellers.json file for entry."
+        for seller in iter_sellers(fdin, header):
+            try:
+                pub_domain = seller.get('domain')
+                if pub_domain:
+                    try:
+                        pub_domain = pub_domain.strip()
+                    except:
+                        pass
+                rel = cls.eyeball.relationship(pub_domain, entry.domain, seller.get('seller_id'),
+                                               sellersjson=entry,
+                                               is_confidential=seller.get('is_confidential', False),
+                                               seller_type=seller.get('seller_type'),
+                                               account_type=seller.get('account_type'),
+                                               certification_authority_id=seller.get('certification_authority_id'),
+                                               is_passthrough=seller.get('is_passthrough'),
+                                               name=seller.get('name'),
+                                               comment=seller.get('comment'))
+                if rel.is_valid:
+                    yield rel
+                else:
+                    logging.info('-------------------------------------------------------------------------------')
+                    logging.info("Malformed seller entry in %s" % url)
+                    logging.info(seller)
+                    for err in rel.validation_errors():
+                        logging.info(" - %s" % err)
+                    logging.info('-------------------------------------------------------------------------------')
+            except Exception as e:
+                logging.error("Malformed seller entry in %s not caught by validation" % url)
+                logging.error(seller)
+                logging.error(e)
+                raise
+
     @classmethod
     def parse_file(cls, url):
         seen = {} 
         domain = urlparse(url).netloc
         if ':' in domain:
             domain = domain.split(':')[0]
-        fulltext = snarf_file(url, 'sellers')
-        entry = cls(domain, fulltext)
-        try:
-            data = json.loads(fulltext.split('\n\n',1)[1])
-        except:
-            logging.info("Missing or invalid content for %s" % url)
+        content_hash = mirror.content_hash(url, 'sellers')
+        if cls.is_parsed(domain, content_hash):
+            logging.info("%s unchanged since last parsed." % url)
             return
-        with cls.eyeball.conn.cursor() as curs:
+        fulltext = snarf_file(url, 'sellers') if SELLERS_KEEP_FULLTEXT else None
+        entry = cls(domain, fulltext=fulltext, content_hash=content_hash)
+        (rels, header) = ([], {})
+        with cls.eyeball.cursor() as curs:
             if not entry.persist(cursor=curs):
                 return False
+            loader = cls.eyeball.ingest.loader(curs, 'sellersjson', entry.domain)
             try:
-                for seller in data['sellers']:
-                    try:
-                        pub_domain = seller.get('domain')
-                        if pub_domain:
-                            try:
-                                pub_domain = pub_domain.strip()
-                            except:
-                                pass
-                        rel = cls.eyeball.relationship.lookup_or_new(account_id=seller.get('seller_id'),
-                                                                     source=pub_domain,
-                                                                     destination=domain)
-                        rel.name = data.get('name')
-                        rel.sellersjson = entry
-                        rel.is_confidential = data.get('is_confidential', False)
-                        rel.seller_type = data.get('seller_type')
-                        rel.account_type = data.get('account_type')
-                        if rel.account_type:
-                            rel.account_type = rel.account_type.upper()
-                        rel.certification_authority_id = data.get('certification_authority_id')
-                        rel.is_passthrough = data.get('is_passthrough')
-                        rel.name = data.get('name')
-                        rel.comment = data.get('comment')
-                        if rel.is_valid:
-                            rel.persist(cursor=curs)
-                            seen[pub_domain] = 1
-                        else:
-                            logging.info('-------------------------------------------------------------------------------')
-                            logging.info("Malformed seller entry in %s" % url)
-                            logging.info(seller)
-                            for err in rel.validation_errors():
-                                logging.info(" - %s" % err)
-                            logging.info('-------------------------------------------------------------------------------')
-                    except Exception as e:
-                        logging.error("Malformed seller entry in %s not caught by validation" % url)
-                        logging.error(seller)
-                        logging.error(e)
-                        raise
+                with mirror.open_body(url, 'sellers') as fdin:
+                    for rel in cls.parse_sellers(entry, fdin, header, url):
+                        rels.append(rel)
+                        seen[rel.source] = 1
+                        if len(rels) >= INGEST_BATCH_SIZE:
+                            loader.relationships(rels)
+                            rels = []
+                loader.relationships(rels)
+                loader.finish()
+                entry.set_header(header)
+                entry.persist(cursor=curs)
+            except json.JSONDecodeError as e:
+                logging.info("Missing or invalid content for %s: %s" % (url, e))
+                curs.connection.rollback()
+                return
             except Exception as e:
+                # nothing from a half-parsed file is kept, and it does not count as parsed
                 logging.info("Failed to parse %s" % url)
                 logging.error(e)
+                curs.connection.rollback()
+                return False
+            if cls.eyeball.jobs.enabled:
+                cls.eyeball.jobs.enqueue(seen.keys(), 'ads', cursor=curs)
             curs.connection.commit()
-            cls.eyeball.adstxt.parse_list(seen.keys())
+        return list(seen.keys())
 
     @classmethod
     def lookup_all(cls, sid=None, domain=None):
-        (all_sids, all_domains) = (False, False)
-        if not sid:
-            all_sids = True
-        if not domain:
-            all_domains = True
+        (clause, params) = where((('id', sid or None), ('domain', domain or None)))
         result = []
-        with cls.eyeball.conn.cursor() as curs:
+        # with no arguments this is every file, so read it a batch at a time
+        with cls.eyeball.cursor(server_side=not clause) as curs:
             curs.execute('''SELECT domain, contact_email, contact_address, 
-                                   version, ext, fulltext, created, modified, id FROM sellersjson WHERE
-                            (id = %s OR %s) AND
-                            (domain = %s OR %s) 
-                            ''', (sid, all_sids, domain, all_domains))
-            for row in curs.fetchall():
+                                   version, ext, fulltext, created, modified, id, content_hash
+                            FROM sellersjson %s''' % clause, params)
+            for row in curs:
                 result.append(cls(*row))
         return result
 
+    @classmethod
+    def is_parsed(cls, domain, content_hash):
+        "Is this the content of the last file parsed for domain?"
+        with cls.eyeball.cursor() as curs:
+            curs.execute('''SELECT content_hash FROM sellersjson WHERE domain = %s ORDER BY id DESC LIMIT 1''',
+                         (domain,))
+            row = curs.fetchone()
+            return row is not None and row[0] == content_hash
+
     @classmethod
     def lookup_one(cls, aid=None, domain=None):
         tmp = list(cls.lookup_all(aid, domain))
@@ -165,25 +266,14 @@ class Sellers(object):
             return None
 
     @classmethod
-    def parse_all(cls, max=0):
-        for domain in cls.eyeball.relationship.all_sellers():
-            if cls.lookup_all(domain=domain):
-                logging.info("https://%s/sellers.json already parsed." % domain)
-                continue
-            try:
-                cls.parse_file('https://%s/sellers.json' % domain)
-            except FileNotFoundError:
-                logging.warning("No sellers file cached for %s" % domain)
+    def parse_all(cls, max=0, since=None):
+        "Parse the sellers.json file of every known seller, and whatever that leads to."
+        return cls.eyeball.frontier.explore(list(cls.eyeball.relationship.all_sellers()), 'sellers', max,
+                                            since)
 
     @classmethod
     def parse_list(cls, todo):
-        for domain in todo:
-            if cls.lookup_all(domain=domain):
-                continue
-            try:
-                cls.parse_file('https://%s/sellers.json' % domain)
-            except:
-                pass
+        return cls.eyeball.frontier.explore(todo, 'sellers')
 
 
 # vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+
+# Storage for mirrored files.
+#
+# FileStore is the original layout: one file per URL under url_to_path,
+# holding the response headers, a blank line, then the body.
+#
+# BlobStore keeps each distinct body once, under blobs/ named by its
+# sha256. The per-URL file under latest/ holds only the headers plus an
+# X-Eyeball-Blob header naming the blob, and versions/ has one line per
+# change of content: "<unix time> <sha256>". Files written by FileStore
+# are still readable after switching MIRROR_STORE to 'blobs'.
+#
+# SegmentStore packs records into append-only, WARC-style segment files
+# (see the class for the format). Run "store.py compact" now and then to
+# merge old segments and drop superseded records.
+
+from collections import namedtuple
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import io
+import logging
+import mmap
+import os
+import shutil
+import sys
+from tempfile import NamedTemporaryFile, TemporaryFile
+import time
+import uuid
+
+import config
+from manifest import entry_row, header_status, manifest
+from utils import (blob_path, body_hash, parse_headers, read_headers, root, set_owner, spew_file,
+                   spewing, touch_file, url_to_path)
+
+BLOB_HEADER = 'X-Eyeball-Blob'
+SEGMENT_SIZE = getattr(config, 'SEGMENT_SIZE', 256 * 1024 * 1024)
+INDEX_REFRESH = 60
+HEADER_MAX = 65536   # bytes to look for the end of a record's headers in
+
+class HashingWriter(object):
+    "Text file wrapper that keeps a sha256 of the UTF-8 encoding of what is written."
+
+    def __init__(self, out):
+        self.out = out
+        self.sha = hashlib.sha256()
+
+    def write(self, text):
+        self.sha.update(text.encode('utf-8'))
+        return self.out.write(text)
+
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+
+class FileStore(object):
+
+    def path(self, url, category):
+        return url_to_path(url, category)
+
+    def exists(self, url, category):
+        return os.path.exists(self.path(url, category))
+
+    def mtime(self, url, category):
+        return os.path.getmtime(self.path(url, category))
+
+    def headers(self, url, category):
+        return read_headers(self.path(url, category))
+
+    def touch(self, url, category):
+        touch_file(self.path(url, category))
+
+    def content_hash(self, url, category):
+        return body_hash(self.path(url, category))
+
+    @contextmanager
+    def writer(self, url, category, headers):
+        "Yield a text file for the body. headers is the header lines as one string."
+        filename = self.path(url, category)
+        with spewing(filename, record=False) as scratch:
+            scratch.write(headers + '\n')
+            out = HashingWriter(scratch)
+            yield out
+        manifest.record(filename, out.hexdigest())
+
+    def open(self, url, category):
+        return open(self.path(url, category), 'r', encoding='utf-8')
+
+    def open_body(self, url, category):
+        "Open just the body, past the saved headers."
+        fdin = self.open(url, category)
+        while fdin.readline().strip('\r\n'):
+            pass
+        return fdin
+
+    def read(self, url, category):
+        with self.open(url, category) as fdin:
+            return fdin.read()
+
+    def manifest_rows(self, category=None):
+        "Manifest rows for URLs not kept in files of their own, for manifest.rebuild. None here."
+        return []
+
+
+class BlobStore(FileStore):
+
+    def versions_path(self, url, category):
+        return url_to_path(url, category, 'versions')
+
+    def content_hash(self, url, category):
+        digest = self.headers(url, category).get(BLOB_HEADER.lower())
+        if digest:
+            return digest
+        return body_hash(self.path(url, category))
+
+    @contextmanager
+    def writer(self, url, category, headers):
+        blobdir = os.path.join(root, 'blobs')
+        os.makedirs(blobdir, exist_ok=True)
+        scratch = NamedTemporaryFile(dir=blobdir, mode='w', delete=False, encoding='utf-8')
+        out = HashingWriter(scratch)
+        try:
+            with scratch:
+                yield out
+        except:
+            os.unlink(scratch.name)
+            raise
+        digest = out.hexdigest()
+        blob = blob_path(digest)
+        if os.path.exists(blob):
+            os.unlink(scratch.name)
+        else:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.replace(scratch.name, blob)
+            set_owner(blob)
+        previous = self.headers(url, category).get(BLOB_HEADER.lower())
+        spew_file(self.path(url, category), '%s%s: %s\n\n' % (headers, BLOB_HEADER, digest))
+        if digest != previous:
+            self.add_version(url, category, digest)
+
+    def add_version(self, url, category, digest):
+        filename = self.versions_path(url, category)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'a', encoding='utf-8') as fdout:
+            fdout.write('%d %s\n' % (time.time(), digest))
+
+    def versions(self, url, category):
+        "(timestamp, sha256) for each version of url, oldest first."
+        try:
+            with open(self.versions_path(url, category), 'r', encoding='utf-8') as fdin:
+                return [(int(when), digest) for (when, digest) in
+                        (line.split() for line in fdin if line.strip())]
+        except FileNotFoundError:
+            return []
+
+    def open_blob(self, digest):
+        return open(blob_path(digest), 'r', encoding='utf-8')
+
+    def open_body(self, url, category):
+        digest = self.headers(url, category).get(BLOB_HEADER.lower())
+        if digest:
+            return self.open_blob(digest)
+        return super().open_body(url, category)
+
+    def open(self, url, category):
+        return io.StringIO(self.read(url, category))
+
+    def read(self, url, category):
+        with FileStore.open(self, url, category) as fdin:
+            saved = fdin.read()
+        (headers, body) = (saved.split('\n\n', 1) + [''])[:2]
+        lines = headers.split('\n')
+        digest = None
+        for line in lines:
+            if line.lower().startswith(BLOB_HEADER.lower() + ':'):
+                digest = line.split(':', 1)[1].strip()
+        if not digest:
+            return saved
+        with self.open_blob(digest) as fdin:
+            body = fdin.read()
+        headers = '\n'.join(line for line in lines if not line.lower().startswith(BLOB_HEADER.lower() + ':'))
+        return '%s\n\n%s' % (headers, body)
+
+
+SegmentEntry = namedtuple('SegmentEntry', 'checked segment offset length digest source')
+
+EMPTY_DIGEST = hashlib.sha256(b'').hexdigest()
+
+class SegmentStore(FileStore):
+    '''
+    Records appended to large segment files instead of one file per URL.
+    Each record is a WARC/1.0 'resource' record whose block is what FileStore
+    would have written: headers, a blank line, the body. Next to every
+    segment is an .idx file with one tab-separated line per write or touch:
+    checked time, url, category, segment, block offset, block length, body
+    sha256. The newest line for a URL wins. Each process appends to its own
+    segment, and readers mmap segments and slice records out of them. A
+    writer holds an flock on its segment for as long as it has it open, so
+    compaction only touches segments that no one can still append to.
+    '''
+
+    def __init__(self, directory=None, segment_size=SEGMENT_SIZE):
+        self.directory = directory or os.path.join(root, 'segments')
+        self.segment_size = segment_size
+        self.reset()
+        (self.active, self.active_index, self.active_name, self.active_pid) = (None, None, None, None)
+
+    def reset(self):
+        (self.index, self.index_read, self.maps) = ({}, {}, {})
+        self.refreshed = 0
+
+    def refresh(self):
+        "Read any index lines added since the last refresh."
+        os.makedirs(self.directory, exist_ok=True)
+        names = os.listdir(self.directory)
+        segments = set(name[:-4] for name in names if name.endswith('.seg'))
+        for name in sorted(names):
+            if not name.endswith('.idx'):
+                continue
+            start = self.index_read.get(name, 0)
+            try:
+                with open(os.path.join(self.directory, name), 'rb') as fdin:
+                    fdin.seek(start)
+                    data = fdin.read()
+            except FileNotFoundError:
+                continue
+            end = data.rfind(b'\n') + 1
+            for line in data[:end].decode('utf-8').splitlines():
+                self._add(line, name[:-4], segments)
+            self.index_read[name] = start + end
+        self.refreshed = time.time()
+
+    def _add(self, line, source, segments):
+        (checked, url, category, segment, offset, length, digest) = line.split('\t')
+        if segment != '-' and segment not in segments:
+            return   # compacted away
+        entry = SegmentEntry(float(checked), segment, int(offset), int(length), digest, source)
+        old = self.index.get((url, category))
+        if old is None or entry.checked >= old.checked:
+            self.index[(url, category)] = entry
+
+    def entry(self, url, category):
+        if time.time() - self.refreshed > INDEX_REFRESH:
+            self.refresh()
+        entry = self.index.get((url, category))
+        if entry is None and time.time() - self.refreshed > 1:
+            self.refresh()
+            entry = self.index.get((url, category))
+        if entry is None:
+            raise FileNotFoundError("%s not in %s segments" % (url, category))
+        return entry
+
+    def _map(self, segment, end):
+        mapped = self.maps.get(segment)
+        if mapped is None or len(mapped) < end:
+            with open(os.path.join(self.directory, segment + '.seg'), 'rb') as fdin:
+                mapped = mmap.mmap(fdin.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = mapped
+        return mapped
+
+    def block(self, url, category):
+        "The stored headers and body for url, as a memoryview into the mapped segment."
+        entry = self.entry(url, category)
+        if '-' == entry.segment:
+            return memoryview(b'')
+        try:
+            mapped = self._map(entry.segment, entry.offset + entry.length)
+        except FileNotFoundError:
+            # compacted since we read the index
+            self.reset()
+            self.refresh()
+            entry = self.entry(url, category)
+            mapped = self._map(entry.segment, entry.offset + entry.length)
+        return memoryview(mapped)[entry.offset:entry.offset + entry.length]
+
+    def exists(self, url, category):
+        try:
+            self.entry(url, category)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def mtime(self, url, category):
+        return self.entry(url, category).checked
+
+    def content_hash(self, url, category):
+        return self.entry(url, category).digest
+
+    def read(self, url, category):
+        return str(self.block(url, category), 'utf-8')
+
+    def open(self, url, category):
+        return io.StringIO(self.read(url, category))
+
+    def headers(self, url, category):
+        headers = {}
+        try:
+            text = self.read(url, category)
+        except FileNotFoundError:
+            return headers
+        return parse_headers(text.splitlines())
+
+    def close(self):
+        "Stop appending to the active segment, which leaves it free to compact."
+        if self.active is not None and self.active_pid == os.getpid():
+            self.active.close()
+            self.active_index.close()
+        (self.active, self.active_index, self.active_name, self.active_pid) = (None, None, None, None)
+
+    def _start_segment(self):
+        self.close()
+        os.makedirs(self.directory, exist_ok=True)
+        self.active_name = '%d-%d-%s' % (time.time() * 1000, os.getpid(), uuid.uuid4().hex[:8])
+        self.active = open(os.path.join(self.directory, self.active_name + '.seg'), 'ab')
+        fcntl.flock(self.active, fcntl.LOCK_EX)
+        self.active_index = open(os.path.join(self.directory, self.active_name + '.idx'), 'a',
+                                 encoding='utf-8')
+        self.active_pid = os.getpid()
+
+    def _index(self, url, category, entry):
+        self.active_index.write('%f\t%s\t%s\t%s\t%d\t%d\t%s\n' % (entry.checked, url, category,
+                                entry.segment, entry.offset, entry.length, entry.digest))
+        self.active_index.flush()
+        self.index[(url, category)] = entry._replace(source=self.active_name)
+
+    def append(self, url, category, block, length, digest, checked=None):
+        "Append a record with length bytes read from the block file, and index it."
+        # a forked child must not write into its parent's segment
+        if self.active is None or self.active_pid != os.getpid() or self.active.tell() > self.segment_size:
+            self._start_segment()
+        if checked is None:
+            checked = time.time()
+        self.active.seek(0, os.SEEK_END)
+        header = ('WARC/1.0\r\n'
+                  'WARC-Type: resource\r\n'
+                  'WARC-Record-ID: <urn:uuid:%s>\r\n'
+                  'WARC-Date: %s\r\n'
+                  'WARC-Target-URI: %s\r\n'
+                  'WARC-Payload-Digest: sha256:%s\r\n'
+                  'Eyeball-Category: %s\r\n'
+                  'Content-Type: application/x-eyeball-mirror\r\n'
+                  'Content-Length: %d\r\n\r\n' % (uuid.uuid4(),
+                  time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(checked)),
+                  url, digest, category, length)).encode('utf-8')
+        self.active.write(header)
+        offset = self.active.tell()
+        shutil.copyfileobj(block, self.active)
+        self.active.write(b'\r\n\r\n')
+        self.active.flush()
+        self._index(url, category, SegmentEntry(checked, self.active_name, offset, length, digest, None))
+
+    @contextmanager
+    def writer(self, url, category, headers):
+        os.makedirs(self.directory, exist_ok=True)
+        with TemporaryFile(dir=self.directory) as scratch:
+            text = io.TextIOWrapper(scratch, encoding='utf-8', newline='')
+            text.write(headers + '\n')
+            out = HashingWriter(text)
+            yield out
+            text.flush()
+            length = scratch.tell()
+            scratch.seek(0)
+            self.append(url, category, scratch, length, out.hexdigest())
+            text.detach()
+        manifest.record_entry(url, category, length, self.index[(url, category)].checked,
+                              out.hexdigest(), header_status(parse_headers(headers.splitlines())))
+
+    def touch(self, url, category):
+        if self.active is None or self.active_pid != os.getpid():
+            self._start_segment()
+        try:
+            entry = self.entry(url, category)._replace(checked=time.time())
+        except FileNotFoundError:
+            entry = SegmentEntry(time.time(), '-', 0, 0, EMPTY_DIGEST, None)
+            manifest.record_entry(url, category, 0, entry.checked, None, None)
+        else:
+            manifest.touched(self.path(url, category), entry.checked)
+        self._index(url, category, entry)
+
+    def records(self, category=None):
+        "Every current (url, category, block) in segment order, for full-corpus reads."
+        self.refresh()
+        entries = sorted((entry.segment, entry.offset, key) for (key, entry) in self.index.items()
+                         if category is None or key[1] == category)
+        for (segment, offset, (url, cat)) in entries:
+            yield (url, cat, self.block(url, cat))
+
+    def manifest_rows(self, category=None):
+        self.refresh()
+        for ((url, cat), entry) in list(self.index.items()):
+            if category is not None and cat != category:
+                continue
+            if '-' == entry.segment:
+                yield entry_row(url, cat, 0, entry.checked, None, None)
+                continue
+            # only the headers are decoded, not the whole block
+            head = bytes(self.block(url, cat)[:HEADER_MAX]).split(b'\n\n', 1)[0]
+            headers = parse_headers(head.decode('utf-8', 'replace').splitlines())
+            yield entry_row(url, cat, entry.length, entry.checked, entry.digest, header_status(headers))
+
+    def _seal(self, segment):
+        "The segment's file, locked, if no writer has it open, or None."
+        try:
+            fd = open(os.path.join(self.directory, segment + '.seg'), 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fd.close()
+            return None
+        return fd
+
+    def compact(self, min_age=3600):
+        '''
+        Copy the live records out of closed segments idle for min_age seconds into new segments.
+        Returns the number of records copied.
+        '''
+        self.reset()
+        self.refresh()
+        cutoff = time.time() - min_age
+        locks = {}
+        for name in os.listdir(self.directory):
+            if name.endswith('.seg') and name[:-4] != self.active_name:
+                idx = os.path.join(self.directory, name[:-4] + '.idx')
+                if max(os.path.getmtime(os.path.join(self.directory, name)),
+                       os.path.getmtime(idx) if os.path.exists(idx) else 0) < cutoff:
+                    fd = self._seal(name[:-4])
+                    if fd is not None:
+                        locks[name[:-4]] = fd
+        sealed = set(locks)
+        if not sealed:
+            return 0
+        # what was written before the locks were taken
+        self.refresh()
+        self._start_segment()
+        moved = 0
+        for ((url, category), entry) in sorted(self.index.items(), key=lambda item: (item[1].segment, item[1].offset)):
+            if entry.segment in sealed:
+                block = self.block(url, category)
+                self.append(url, category, io.BytesIO(block), entry.length, entry.digest, entry.checked)
+                moved += 1
+            elif entry.source in sealed:
+                # a touch recorded in a segment's index; keep it
+                self._index(url, category, entry)
+        for segment in sealed:
+            for ext in ('.seg', '.idx'):
+                try:
+                    os.unlink(os.path.join(self.directory, segment + ext))
+                except FileNotFoundError:
+                    pass
+            locks[segment].close()
+        self.reset()
+        logging.info("Compacted %d segment(s), %d live record(s)" % (len(sealed), moved))
+        return moved
+
+
+if 'blobs' == getattr(config, 'MIRROR_STORE', 'files'):
+    mirror = BlobStore()
+elif 'segments' == getattr(config, 'MIRROR_STORE', 'files'):
+    mirror = SegmentStore()
+else:
+    mirror = FileStore()
+
+def snarf_file(url, category):
+    "Get a file content. Raises FileNotFoundError if nothing is there."
+    try:
+        return mirror.read(url, category)
+    except:
+        logging.warning("Could not find file for %s in category %s" % (url, category))
+        raise
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 2 or sys.argv[1] != 'compact':
+        print("usage: %s compact [min_age_seconds]" % sys.argv[0])
+        sys.exit(1)
+    SegmentStore().compact(*[int(arg) for arg in sys.argv[2:3]])
+
+
+# vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+# The strong set graph on the front page: ad systems linked by
+# relationships that both an ads.txt and a sellers.json file confirm.
+# Working it out takes two scans of relationship, so instead of doing it
+# for every page view it is kept in the strong_node and strong_link
+# tables. A refresh replaces both in one transaction, so readers go on
+# seeing the old graph until it commits and never wait for it. Parsers
+# mark the graph stale when they write relationships, and it is refreshed
+# at most once every STRONG_SET_INTERVAL seconds, by whichever process
+# claims the refresh first. The crawl loops check for a stale graph on
+# every pass, so the last batch of writes is not left waiting for
+# another. Both bump the generation number that cached web pages are
+# checked against (see cache.py).
+#
+# The graph page does not load the whole graph. It starts from one domain
+# and asks for neighborhood(), the nodes up to a few hops away, with the
+# best connected ones first when there are more than it can take, and
+# loads more around each node that is clicked. Node positions are worked
+# out at refresh time (see layout.py), so the page only has to draw. For
+# the whole graph zoomed out, overview() adds up nodes and links in a grid
+# of cells, finer at each level.
+
+import logging
+import sys
+
+import config
+
+STRONG_SET_INTERVAL = getattr(config, 'STRONG_SET_INTERVAL', 300)
+GRAPH_MAX_NODES = getattr(config, 'GRAPH_MAX_NODES', 100)
+GRAPH_MAX_LINKS = getattr(config, 'GRAPH_MAX_LINKS', 500)
+GRAPH_MAX_HOPS = 3
+OVERVIEW_MAX_LEVEL = 8  # 256 by 256 cells
+
+# Nodes next to any of ids and not in seen, best connected first.
+NEIGHBORS = '''SELECT id, name, degree, x, y FROM strong_node
+               WHERE id IN (SELECT target FROM strong_link WHERE source = ANY(%%(ids)s)
+                            UNION SELECT source FROM strong_link WHERE target = ANY(%%(ids)s))
+               AND NOT id = ANY(%%(seen)s) AND degree >= %%(min_degree)s %s
+               ORDER BY degree DESC, name LIMIT %%(limit)s'''
+
+class StrongSet(object):
+    eyeball = None
+
+    @classmethod
+    def mark_stale(cls, bump=True):
+        "Have the next refresh_if_due refresh the graph. bump=False leaves cached pages be."
+        with cls.eyeball.cursor() as curs:
+            curs.execute('UPDATE strong_set_state SET stale = TRUE WHERE NOT stale')
+            if bump:
+                cls.eyeball.cache.bump(curs)
+            curs.connection.commit()
+
+    @classmethod
+    def changed(cls):
+        "Relationships were written. Refresh the stored graph if it is due."
+        cls.mark_stale()
+        return cls.refresh_if_due()
+
+    @classmethod
+    def claim(cls, interval):
+        "Take on the refresh, if the graph is stale and was not refreshed in the last interval seconds."
+        with cls.eyeball.cursor() as curs:
+            curs.execute('''UPDATE strong_set_state SET stale = FALSE, refreshed = NOW()
+                            WHERE stale AND
+                            (refreshed IS NULL OR refreshed < NOW() - %s * INTERVAL '1 second')
+                            RETURNING refreshed''', (interval,))
+            claimed = curs.fetchone() is not None
+            curs.connection.commit()
+        return claimed
+
+    @classmethod
+    def refresh_if_due(cls, interval=STRONG_SET_INTERVAL):
+        if not cls.claim(interval):
+            return False
+        try:
+            return cls.refresh()
+        except Exception as e:
+            # writes made while this refresh was running leave it stale anyway
+            logging.error("Failed to refresh the strong set: %s" % e)
+            cls.mark_stale()
+            return False
+
+    @classmethod
+    def refresh(cls):
+        "Work out the strong set from relationship and store it."
+        graph = cls.eyeball.relationship.strong_set()
+        names = [node['name'] for node in graph['nodes']]
+        degrees = [0] * len(names)
+        for link in graph['links']:
+            degrees[link['source']] += 1
+            degrees[link['target']] += 1
+        (xs, ys) = cls.layout(names, graph['links'])
+        with cls.eyeball.cursor() as curs:
+            # only one refresh writes at a time; readers are not blocked
+            curs.execute('LOCK TABLE strong_node, strong_link IN SHARE ROW EXCLUSIVE MODE')
+            curs.execute('DELETE FROM strong_link')
+            curs.execute('DELETE FROM strong_node')
+            curs.execute('''INSERT INTO strong_node (id, name, degree, x, y)
+                            SELECT * FROM unnest(%s::INT[], %s::TEXT[], %s::INT[], %s::REAL[], %s::REAL[])''',
+                         (list(range(len(names))), names, degrees, xs, ys))
+            curs.execute('''INSERT INTO strong_link (source, target, id)
+                            SELECT * FROM unnest(%s::INT[], %s::INT[]) WITH ORDINALITY''',
+                         ([link['source'] for link in graph['links']],
+                          [link['target'] for link in graph['links']]))
+            curs.execute('UPDATE strong_set_state SET refreshed = NOW()')
+            cls.eyeball.cache.bump(curs)
+            curs.connection.commit()
+        logging.info("Stored strong set: %d node(s), %d link(s)" % (len(names), len(graph['links'])))
+        return True
+
+    @classmethod
+    def layout(cls, names, links, fresh=False):
+        "Positions for the named nodes, as lists of x and y, starting from where they were before."
+        try:
+            # NumPy is only needed here, so processes that never refresh do without it
+            from layout import force_layout
+        except ImportError:
+            # without NumPy nodes are stored with no position, and the page lays them out
+            return ([None] * len(names), [None] * len(names))
+        initial = None
+        if not fresh:
+            with cls.eyeball.cursor() as curs:
+                curs.execute('SELECT name, x, y FROM strong_node WHERE x IS NOT NULL')
+                before = dict((name, (x, y)) for (name, x, y) in curs.fetchall())
+                curs.connection.commit()
+            initial = [before.get(name) for name in names]
+        positions = force_layout(len(names), [link['source'] for link in links],
+                                 [link['target'] for link in links], initial)
+        return ([float(x) for x in positions[:, 0]], [float(y) for y in positions[:, 1]])
+
+    @classmethod
+    def relayout(cls, fresh=False):
+        "Lay out the stored graph again, without working it out from relationship."
+        with cls.eyeball.cursor() as curs:
+            curs.execute('SELECT id, name FROM strong_node ORDER BY id')
+            names = [name for (nid, name) in curs.fetchall()]
+            curs.execute('SELECT source, target FROM strong_link')
+            links = [{'source': source, 'target': target} for (source, target) in curs.fetchall()]
+            curs.connection.commit()
+        (xs, ys) = cls.layout(names, links, fresh)
+        with cls.eyeball.cursor() as curs:
+            curs.execute('''UPDATE strong_node SET x = position.x, y = position.y
+                            FROM unnest(%s::TEXT[], %s::REAL[], %s::REAL[]) AS position (name, x, y)
+                            WHERE strong_node.name = position.name''', (names, xs, ys))
+            cls.eyeball.cache.bump(curs)
+            curs.connection.commit()
+        logging.info("Laid out %d node(s)" % len(names))
+
+    @classmethod
+    def graph(cls):
+        "The stored strong set, in the form Relationship.strong_set() returns, with node positions."
+        with cls.eyeball.cursor() as curs:
+            # one statement, so nodes and links come from the same refresh
+            curs.execute('''SELECT refreshed,
+                            (SELECT COALESCE(json_agg(json_build_object('name', name, 'x', x, 'y', y) ORDER BY id),
+                                             '[]') FROM strong_node),
+                            (SELECT COALESCE(json_agg(json_build_object('source', source,
+                                                                        'target', target) ORDER BY id),
+                                             '[]') FROM strong_link)
+                            FROM strong_set_state''')
+            (refreshed, nodes, links) = curs.fetchone()
+            curs.connection.commit()
+        if refreshed is None:
+            # never been worked out: leave that to the background loop, not a page view. Its
+            # refresh bumps the cache generation, so pages cached with the empty graph go.
+            cls.mark_stale(bump=False)
+        return {'nodes': nodes, 'links': links}
+
+    @classmethod
+    def neighborhood(cls, domain, hops=1, max_nodes=GRAPH_MAX_NODES, max_links=GRAPH_MAX_LINKS,
+                     min_degree=1, after=None):
+        '''
+        The part of the stored strong set within hops links of domain, or None if domain is not in
+        it. When a hop has more nodes than there is room for, the ones with the most links are
+        kept, and the result has the key to pass as after for the next page of the first hop.
+        Nodes with fewer than min_degree links are left out. Links are between node names.
+        '''
+        hops = max(1, min(hops, GRAPH_MAX_HOPS))
+        (max_nodes, max_links) = (max(1, min(max_nodes, 10 * GRAPH_MAX_NODES)),
+                                  max(0, min(max_links, 10 * GRAPH_MAX_LINKS)))
+        (next_key, truncated) = (None, False)
+        with cls.eyeball.cursor() as curs:
+            curs.execute('SELECT id, name, degree, x, y FROM strong_node WHERE name = %s', (domain,))
+            center = curs.fetchone()
+            if center is None:
+                return None
+            nodes = {center[0]: {'name': center[1], 'degree': center[2], 'x': center[3], 'y': center[4],
+                                 'hop': 0}}
+            frontier = [center[0]]
+            for hop in range(1, hops + 1):
+                room = max_nodes - len(nodes)
+                if room <= 0 or not frontier:
+                    truncated = truncated or bool(frontier)
+                    break
+                params = {'ids': frontier, 'seen': list(nodes), 'min_degree': min_degree,
+                          'limit': room + 1}
+                page = ''
+                if after and 1 == hop:
+                    page = 'AND (degree < %(degree)s OR (degree = %(degree)s AND name > %(name)s))'
+                    (params['degree'], params['name']) = after
+                curs.execute(NEIGHBORS % page, params)
+                rows = curs.fetchall()
+                if len(rows) > room:
+                    (rows, truncated) = (rows[:room], True)
+                    if 1 == hop:
+                        next_key = (rows[-1][2], rows[-1][1])
+                for (nid, name, degree, x, y) in rows:
+                    nodes[nid] = {'name': name, 'degree': degree, 'x': x, 'y': y, 'hop': hop}
+                frontier = [row[0] for row in rows]
+            curs.execute('''SELECT source, target FROM strong_link
+                            WHERE source = ANY(%s) AND target = ANY(%s) LIMIT %s''',
+                         (list(nodes), list(nodes), max_links + 1))
+            links = curs.fetchall()
+            curs.connection.commit()
+        if len(links) > max_links:
+            (links, truncated) = (links[:max_links], True)
+        return {'center': domain,
+                'nodes': sorted(nodes.values(), key=lambda n: (n['hop'], -n['degree'], n['name'])),
+                'links': [{'source': nodes[s]['name'], 'target': nodes[t]['name']} for (s, t) in links],
+                'truncated': truncated,
+                'next': next_key}
+
+    @classmethod
+    def overview(cls, level):
+        '''
+        The whole stored graph at a level of detail: the unit square cut into 2**level by 2**level
+        cells, with the number of nodes in each cell, where their middle is and the best connected
+        one's name, and the number of links between each pair of cells.
+        '''
+        size = 2 ** max(0, min(level, OVERVIEW_MAX_LEVEL))
+        with cls.eyeball.cursor() as curs:
+            curs.execute('''WITH node_cell AS (
+                                SELECT id, name, degree, x, y,
+                                LEAST(FLOOR(y * %(size)s), %(size)s - 1)::INT * %(size)s +
+                                LEAST(FLOOR(x * %(size)s), %(size)s - 1)::INT AS cell
+                                FROM strong_node WHERE x IS NOT NULL
+                            ), cells AS (
+                                SELECT cell, COUNT(*) AS nodes, AVG(x) AS x, AVG(y) AS y,
+                                (array_agg(name ORDER BY degree DESC, name))[1] AS name
+                                FROM node_cell GROUP BY cell
+                            ), cell_links AS (
+                                SELECT a.cell AS source, b.cell AS target, COUNT(*) AS links
+                                FROM strong_link
+                                JOIN node_cell a ON a.id = strong_link.source
+                                JOIN node_cell b ON b.id = strong_link.target
+                                WHERE a.cell <> b.cell GROUP BY a.cell, b.cell
+                            )
+                            SELECT (SELECT COALESCE(json_agg(cells ORDER BY cell), '[]') FROM cells),
+                                   (SELECT COALESCE(json_agg(cell_links), '[]') FROM cell_links)''',
+                         {'size': size})
+            (cells, links) = curs.fetchone()
+            curs.connection.commit()
+        return {'size': size, 'cells': cells, 'links': links}
+
+
+if __name__ == "__main__":
+    from eyeball import Eyeball
+    logging.basicConfig(level=logging.INFO)
+    e = Eyeball()
+    if sys.argv[1:] == ['if-due']:
+        e.strongset.refresh_if_due()
+    else:
+        e.strongset.refresh()
+
+# vim: autoindent textwidth=100 tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import logging
+import os
 from random import randint
 import unittest
 
@@ -11,8 +12,34 @@ except:
     print("To start the container and run tests, use test.sh")
     exit(1)
 
+from db import ConnectionPool, PoolTimeout
 from eyeball import Eyeball
 
+class FakeConnection(object):
+    "Just enough of a psycopg2 connection for ConnectionPool."
+
+    def __init__(self):
+        (self.closed, self.rollbacks) = (0, 0)
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+class FakePool(ConnectionPool):
+    "A ConnectionPool that makes FakeConnections instead of connecting."
+
+    def connect(self, attempts=5):
+        return FakeConnection()
+
+
 class EyeballTestCase(unittest.TestCase):
 
     def test_db_time(self):
@@ -66,18 +93,337 @@ class EyeballTestCase(unittest.TestCase):
         nodes = tg.relationship.strong_set()['nodes']
         # FIXME self.assertIn(n, nodes)
 
+    def test_stored_strong_set(self):
+        tg = Eyeball()
+        tg.strongset.refresh()
+        stored = tg.strongset.graph()
+        computed = tg.relationship.strong_set()
+        self.assertEqual([node['name'] for node in computed['nodes']],
+                         [node['name'] for node in stored['nodes']])
+        self.assertEqual(computed['links'], stored['links'])
+        overview = tg.strongset.overview(2)
+        self.assertEqual(len(stored['nodes']), sum(cell['nodes'] for cell in overview['cells']))
+        tg.strongset.mark_stale()
+        self.assertTrue(tg.strongset.refresh_if_due(interval=0))
+        self.assertFalse(tg.strongset.refresh_if_due(interval=0))
+
+    def test_response_cache(self):
+        tg = Eyeball()
+        made = []
+        def make():
+            made.append(1)
+            return 'page %d' % len(made)
+        first = tg.cache.get('/test/page', make)
+        self.assertEqual(first, tg.cache.get('/test/page', make))
+        self.assertEqual(1, len(made))
+        with tg.cursor() as curs:
+            tg.cache.bump(curs)
+            curs.connection.commit()
+        tg.cache.checked = 0
+        self.assertEqual(b'page 2', tg.cache.get('/test/page', make).body)
+
+    def test_neighborhood(self):
+        tg = Eyeball()
+        # the strong set starts from nytimes.com, so give it five first-hop neighbors
+        center = 'nytimes.com'
+        ta = tg.adstxt(domain=center, fulltext="").persist()
+        names = ['hood%d.example.com' % i for i in range(5)]
+        tg.ingest.relationships([tg.relationship(center, name, str(i), adstxt=ta)
+                                 for (i, name) in enumerate(names)], 'adstxt')
+        tg.strongset.refresh()
+        everything = tg.strongset.neighborhood(center, max_nodes=100)
+        self.assertFalse(everything['truncated'])
+        first_hop = [node['name'] for node in everything['nodes'] if 1 == node['hop']]
+        self.assertTrue(set(names) <= set(first_hop))
+        # pages of two first-hop nodes each, following next until there are no more
+        (seen, after) = ([], None)
+        while True:
+            graph = tg.strongset.neighborhood(center, max_nodes=3, after=after)
+            self.assertEqual(center, graph['nodes'][0]['name'])
+            self.assertLessEqual(len(graph['nodes']), 3)
+            seen.extend(node['name'] for node in graph['nodes'] if 1 == node['hop'])
+            after = graph['next']
+            if after is None:
+                break
+            self.assertTrue(graph['truncated'])
+        self.assertEqual(first_hop, seen)
+        self.assertIsNone(tg.strongset.neighborhood('not-in-the-graph.example.com'))
+
+    def test_relationship_graph(self):
+        tg = Eyeball()
+        ta = tg.adstxt(domain="graphpub.example.com", fulltext="").persist()
+        ts = tg.sellers(domain="graphssp.example.com").persist()
+        rel = tg.relationship('graphpub.example.com', 'graphssp.example.com', '7', adstxt=ta)
+        tg.ingest.relationships([rel], 'adstxt')
+        graph = tg.graph().load()
+        self.assertEqual(['graphssp.example.com'], graph.neighbors('graphpub.example.com', 'adstxt'))
+        self.assertEqual([], graph.neighbors('graphpub.example.com', 'both'))
+        rel.sellersjson = ts
+        tg.ingest.relationships([rel], 'sellersjson')
+        (before, graph) = (graph, graph.update())
+        self.assertEqual([], before.neighbors('graphpub.example.com', 'both'))
+        self.assertEqual([['graphpub.example.com', 'graphssp.example.com']],
+                         graph.paths('graphpub.example.com', 'graphssp.example.com'))
+        self.assertEqual({'graphpub.example.com': 1},
+                         graph.reachable('graphssp.example.com', direction='in'))
+
+    def test_analytics(self):
+        tg = Eyeball()
+        ta = tg.adstxt(domain="chainpub.example.com", fulltext="").persist()
+        tb = tg.adstxt(domain="chainssp.example.com", fulltext="").persist()
+        tg.ingest.relationships([tg.relationship('chainpub.example.com', 'chainssp.example.com', '1',
+                                                 adstxt=ta, account_type='DIRECT')], 'adstxt')
+        tg.ingest.relationships([tg.relationship('chainssp.example.com', 'chainexchange.example.com', '2',
+                                                 adstxt=tb, account_type='RESELLER')], 'adstxt')
+        tg.analytics.run()
+        rank = tg.analytics.lookup('chainexchange.example.com')
+        self.assertEqual(2, rank['chain_depth'])
+        self.assertEqual(1, rank['in_degree'])
+        self.assertEqual(rank['component'], tg.analytics.lookup('chainpub.example.com')['component'])
+        self.assertGreater(rank['pagerank'], tg.analytics.lookup('chainpub.example.com')['pagerank'])
+        self.assertIn('chainexchange.example.com',
+                      [r['name'] for r in tg.analytics.top('chain_depth', 1000, 2)['domains']])
+
     def test_parse_adstxt(self):
         tg = Eyeball()
         tg.adstxt.parse_file('https://blog.zgp.org/ads.txt')
         self.assertIn('aloodo.com', list(tg.relationship.all_sellers()))
         self.assertIn('blog.zgp.org', list(tg.relationship.all_sources()))
 
+    def test_job_queue(self):
+        tg = Eyeball()
+        tg.jobs.enqueue(['queue.example.com'], 'ads')
+        url = 'https://queue.example.com/ads.txt'
+        leased = tg.jobs.lease('ads', 'new', 'fetching', limit=10000)
+        self.assertIn(url, leased)
+        self.assertNotIn(url, tg.jobs.lease('ads', 'new', 'fetching', limit=10000))
+        tg.jobs.finish(leased, 'new')
+
+    def test_job_max_attempts(self):
+        from jobs import JOB_MAX_ATTEMPTS
+        tg = Eyeball()
+        tg.jobs.enqueue(['stuck.example.com'], 'ads')
+        url = 'https://stuck.example.com/ads.txt'
+        for attempt in range(JOB_MAX_ATTEMPTS):
+            self.assertIn(url, tg.jobs.lease('ads', 'new', 'fetching', limit=10000))
+            tg.jobs.expire_leases(timeout=-1)
+        self.assertNotIn(url, tg.jobs.lease('ads', 'new', 'fetching', limit=10000))
+        with tg.cursor() as curs:
+            curs.execute('SELECT status FROM crawl_jobs WHERE url = %s', (url,))
+            self.assertEqual('failed', curs.fetchone()[0])
+            curs.connection.commit()
+
+    def test_body_decoder(self):
+        import io
+        import zlib
+        from crawl import BodyDecoder, TooLarge
+        body = b'example.com, 1, DIRECT\n' * 1000
+        for compressed in (zlib.compress(body), zlib.compress(body)[2:-4]):  # zlib and raw deflate
+            out = io.StringIO()
+            decoder = BodyDecoder(out, content_encoding='deflate')
+            decoder.write(compressed)
+            decoder.close()
+            self.assertEqual(body.decode('utf-8'), out.getvalue())
+        decoder = BodyDecoder(io.StringIO(), content_encoding='deflate', max_size=1000)
+        with self.assertRaises(TooLarge):
+            decoder.write(zlib.compress(body))
+        self.assertEqual(1001, decoder.size)
+
+    def test_revisit_interval(self):
+        from schedule import Scheduler, CRAWL_MIN_INTERVAL, CRAWL_MAX_INTERVAL
+        self.assertLess(Scheduler.next_interval(86400, True), 86400)
+        self.assertGreater(Scheduler.next_interval(86400, False), 86400)
+        self.assertEqual(CRAWL_MIN_INTERVAL, Scheduler.next_interval(CRAWL_MIN_INTERVAL, True))
+        self.assertEqual(CRAWL_MAX_INTERVAL, Scheduler.next_interval(CRAWL_MAX_INTERVAL, False))
+
+    def test_blob_store(self):
+        from store import BlobStore
+        bs = BlobStore()
+        (a, b) = ('https://a.example.com/ads.txt', 'https://b.example.com/ads.txt')
+        for url in (a, b):
+            with bs.writer(url, 'ads', 'ETag: "abc"\n') as out:
+                out.write('example.com, 1337, DIRECT\n')
+        self.assertEqual(bs.content_hash(a, 'ads'), bs.content_hash(b, 'ads'))
+        self.assertEqual('"abc"', bs.headers(a, 'ads')['etag'])
+        self.assertEqual('ETag: "abc"\n\nexample.com, 1337, DIRECT\n', bs.read(a, 'ads'))
+
+    def test_segment_store(self):
+        import tempfile
+        from store import SegmentStore
+        ss = SegmentStore(tempfile.mkdtemp())
+        url = 'https://a.example.com/ads.txt'
+        for body in ('example.com, 1, DIRECT\n', 'example.com, 2, DIRECT\n'):
+            with ss.writer(url, 'ads', 'ETag: "abc"\n') as out:
+                out.write(body)
+        old = ss.active_name
+        # still open for writing, so left alone
+        self.assertEqual(0, SegmentStore(ss.directory).compact(min_age=-1))
+        ss.close()
+        self.assertEqual(1, SegmentStore(ss.directory).compact(min_age=-1))
+        self.assertFalse(os.path.exists(os.path.join(ss.directory, old + '.seg')))
+        self.assertFalse(os.path.exists(os.path.join(ss.directory, old + '.idx')))
+        ss = SegmentStore(ss.directory)
+        self.assertEqual('"abc"', ss.headers(url, 'ads')['etag'])
+        self.assertEqual('example.com, 2, DIRECT\n', ss.open_body(url, 'ads').read())
+
+    def test_persist_both_files(self):
+        tg = Eyeball()
+        ta = tg.adstxt(domain="persist.example.com", fulltext="").persist()
+        ts = tg.sellers(domain="persistssp.example.com").persist()
+        tg.relationship('persist.example.com', 'persistssp.example.com', '9', adstxt=ta,
+                        account_type='direct').persist()
+        tg.relationship('persist.example.com', 'persistssp.example.com', '9', sellersjson=ts,
+                        name='Persist').persist()
+        found = tg.relationship.lookup_one(source='persist.example.com', destination='persistssp.example.com')
+        self.assertEqual((ta.id, ts.id), (found.adstxt, found.sellersjson))
+        self.assertEqual(('DIRECT', 'Persist'), (found.account_type, found.name))
+        # a record from neither file leaves both links
+        tg.relationship('persist.example.com', 'persistssp.example.com', '9').persist()
+        found = tg.relationship.lookup_one(source='persist.example.com', destination='persistssp.example.com')
+        self.assertEqual((ta.id, ts.id), (found.adstxt, found.sellersjson))
+
+    def test_bulk_ingest(self):
+        tg = Eyeball()
+        ta = tg.adstxt(domain="bulk.example.com", fulltext="").persist()
+        ts = tg.sellers(domain="ssp.example.com").persist()
+        rels = [tg.relationship('bulk.example.com', 'ssp.example.com', '42', adstxt=ta,
+                                account_type='direct'),
+                tg.relationship('bulk.example.com', 'ssp.example.com', '42', adstxt=ta,
+                                account_type='reseller')]
+        tg.ingest.relationships(rels, 'adstxt')
+        tg.ingest.relationships([tg.relationship('bulk.example.com', 'ssp.example.com', '42',
+                                                 sellersjson=ts, name='Bulk\tExample')], 'sellersjson')
+        found = tg.relationship.lookup_one(source='bulk.example.com', destination='ssp.example.com')
+        self.assertEqual('RESELLER', found.account_type)
+        self.assertEqual((ta.id, ts.id), (found.adstxt, found.sellersjson))
+        self.assertEqual('Bulk\tExample', found.name)
+
+    def test_row_diff(self):
+        from ingest import RowDiff
+        tg = Eyeball()
+        ta = tg.adstxt(domain="diff.example.com", fulltext="").persist()
+        tg.ingest.relationships([tg.relationship('diff.example.com', 'ssp.example.com', str(i), adstxt=ta,
+                                                 account_type='DIRECT') for i in range(3)], 'adstxt')
+        with tg.cursor() as curs:
+            diff = RowDiff(tg.ingest, curs, 'adstxt', 'diff.example.com')
+            diff.relationships([tg.relationship('diff.example.com', 'ssp.example.com', i, adstxt=ta,
+                                                account_type=t)
+                                for (i, t) in (('0', 'DIRECT'), ('1', 'RESELLER'), ('3', 'DIRECT'))])
+            self.assertEqual((1, 1, 1), diff.finish())
+            curs.connection.commit()
+        found = tg.relationship.lookup_all(source='diff.example.com')
+        self.assertEqual(['0', '1', '3'], [rel.account_id for rel in found])
+
+    def test_iter_sellers(self):
+        import io
+        from sellers import iter_sellers
+        header = {}
+        text = '{"contact_email": "x@example.com", "sellers": [{"seller_id": 1}, {"seller_id": 2.5}], "version": 1.0}'
+        sellers = list(iter_sellers(io.StringIO(text), header, chunk_size=3))
+        self.assertEqual([{'seller_id': 1}, {'seller_id': 2.5}], sellers)
+        self.assertEqual({'contact_email': 'x@example.com', 'version': 1.0}, header)
+
+    def test_iter_all(self):
+        tg = Eyeball()
+        ta = tg.adstxt(domain="stream.example.com", fulltext="").persist()
+        tg.ingest.relationships([tg.relationship('stream.example.com', 'ssp%d.example.com' % i, str(i),
+                                                 adstxt=ta) for i in range(5)], 'adstxt')
+        streamed = tg.relationship.iter_all(source='stream.example.com')
+        self.assertEqual('ssp0.example.com', next(streamed).destination)
+        ta.persist()  # commits on another connection while the stream is open
+        self.assertEqual(4, len(list(streamed)))
+        self.assertEqual(tg.relationship.lookup_all(source='stream.example.com'),
+                         list(tg.relationship.iter_all(source='stream.example.com')))
+
+    def test_domain_page(self):
+        tg = Eyeball()
+        ta = tg.adstxt(domain="paged.example.com", fulltext="").persist()
+        tg.ingest.relationships([tg.relationship('paged.example.com', 'ssp%d.example.com' % i, str(i),
+                                                 adstxt=ta) for i in range(3)] +
+                                [tg.relationship('pub%d.example.com' % i, 'paged.example.com', str(i),
+                                                 adstxt=ta) for i in range(2)], 'adstxt')
+        (paged, after) = ([], None)
+        while True:
+            (rels, after) = tg.relationship.domain_page('paged.example.com', after, limit=2)
+            paged += rels
+            if after is None:
+                break
+        self.assertEqual(5, len(paged))
+        self.assertEqual(paged, list(tg.relationship.iter_domain('paged.example.com')))
+        self.assertEqual({'as_source': 3, 'as_destination': 2, 'in_adstxt': 3, 'in_sellersjson': 0},
+                         tg.relationship.summary('paged.example.com'))
+
     def test_extract_domain(self):
         from relationship import extract_domain
         for item in ('https://example.com/warez/', 'Example Dot Com (example.com)',
                      'joe@example.com', 'example.com/'):
             self.assertEqual('example.com', extract_domain(item))
 
+    def test_where(self):
+        from query import where
+        self.assertEqual(('WHERE source = %s AND account_id = %s', ['example.com', '1']),
+                         where((('id', None), ('source', 'example.com'), ('account_id', '1'))))
+        self.assertEqual(('', []), where((('id', None),)))
+
+    def test_page_key(self):
+        from query import decode_key, encode_key
+        self.assertEqual(('', 'example.com', '1'), decode_key(encode_key(('', 'example.com', '1')), 3))
+        self.assertRaises(ValueError, decode_key, 'not a key', 3)
+
+    def test_check_domains(self):
+        from domains import check_domains
+        self.assertEqual({'example.com': True, 'not a domain': False, None: False},
+                         check_domains(['example.com', 'not a domain', 'example.com', None]))
+
+    def test_pool_timeout(self):
+        pool = FakePool(0, 1, timeout=0.1)
+        conn = pool.getconn()
+        self.assertRaises(PoolTimeout, pool.getconn)
+        pool.putconn(conn)
+        self.assertIs(conn, pool.getconn())
+
+    def test_pool_replaces_broken(self):
+        pool = FakePool(1, 1)
+        conn = pool.getconn()
+        pool.putconn(conn, broken=True)
+        self.assertTrue(conn.closed)
+        self.assertEqual(0, pool.size)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        conn.closed = 1    # closed while idle in the pool
+        replacement = pool.getconn()
+        self.assertIsNot(conn, replacement)
+        self.assertFalse(replacement.closed)
+        self.assertEqual(1, pool.size)
+
+    def test_pool_rollback(self):
+        pool = FakePool(1, 1)
+        conn = pool.getconn()
+        conn.status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        pool.putconn(conn)
+        self.assertEqual(1, conn.rollbacks)
+        with pool.connection() as conn:
+            conn.status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        self.assertEqual(2, conn.rollbacks)
+
+    def test_pool_reentrant(self):
+        pool = FakePool(0, 2)
+        with pool.connection() as outer:
+            with pool.connection() as inner:
+                self.assertIs(outer, inner)
+            self.assertEqual(1, pool.size)
+        self.assertEqual([outer], [conn for (conn, since) in pool.idle])
+
+    def test_pool_fork(self):
+        pool = FakePool(2, 2)
+        parents = [conn for (conn, since) in pool.idle]
+        pool.pid = -1    # as if this process were a child forked after the pool was made
+        with pool.connection() as conn:
+            self.assertNotIn(conn, parents)
+        self.assertEqual(parents, pool.abandoned)
+        self.assertFalse(any(parent.closed for parent in parents))
+        self.assertEqual(1, pool.size)
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     demo_db = Eyeball(start_demo_db=True)
@@ -7,3 +7,113 @@ DB_HOST = 'localhost'
 DB_PORT = 5432
 
 SECRET_KEY = 'xyzzy'
+
+# Crawler settings. CRAWL_ASYNC uses one asyncio process with up to
+# CRAWL_CONCURRENCY requests in flight instead of a pool of 4 processes.
+CRAWL_ASYNC = True
+CRAWL_CONCURRENCY = 1000
+CRAWL_PER_HOST = 2
+CRAWL_TIMEOUT = 10
+
+# Use the crawl_jobs table as a work queue (see jobs.py). JOB_WORKERS is
+# the number of crawl and parse worker processes started by do_background.
+# A job is failed once its lease has run out JOB_MAX_ATTEMPTS times.
+USE_JOB_QUEUE = False
+JOB_WORKERS = 1
+JOB_BATCH_SIZE = 500
+JOB_LEASE_TIMEOUT = 600
+JOB_MAX_ATTEMPTS = 3
+
+# Revalidate mirrored files older than this many seconds with a
+# conditional request (If-None-Match / If-Modified-Since). None never refreshes.
+CRAWL_MAX_AGE = 86400
+
+# Revisit intervals in seconds. CRAWL_MAX_INTERVAL is the most time any
+# URL can go without being checked.
+CRAWL_INITIAL_INTERVAL = 86400
+CRAWL_MIN_INTERVAL = 3600
+CRAWL_MAX_INTERVAL = 7 * 86400
+
+# Politeness: requests open to one host or one IP address at a time, and
+# seconds between request starts to a host. The process pool crawler (no
+# CRAWL_ASYNC) opens one request to a host at a time. Failed fetches are retried
+# after CRAWL_BACKOFF_BASE seconds, doubling up to CRAWL_BACKOFF_MAX.
+CRAWL_PER_IP = 8
+CRAWL_HOST_DELAY = 1.0
+CRAWL_BACKOFF_BASE = 3600
+CRAWL_BACKOFF_MAX = 30 * 86400
+
+# Largest response body to mirror, in bytes after decompression
+CRAWL_MAX_SIZE = 256 * 1024 * 1024
+
+# 'files' keeps one file per URL. 'blobs' stores each distinct body once,
+# by sha256, with a version log per URL (see store.py). 'segments' packs
+# records into append-only segment files; compact with "store.py compact".
+MIRROR_STORE = 'files'
+SEGMENT_SIZE = 256 * 1024 * 1024
+
+# Keep an SQLite index of the mirror cache (see manifest.py).
+MIRROR_MANIFEST = True
+
+# Store the whole sellers.json file in sellersjson.fulltext. Off by default,
+# so very large files are only ever streamed. The sellers.json page then
+# shows the start of the mirrored copy instead.
+SELLERS_KEEP_FULLTEXT = False
+
+# Parse in a pool of PARSE_WORKERS processes (default: one per CPU) with a
+# single database writer, instead of one process per file type.
+PARSE_PIPELINE = False
+PARSE_WORKERS = None
+PARSE_COMMIT_ROWS = 100000
+
+# Re-parse changed files, writing only the relationships that were added,
+# changed or removed since the last version. Unchanged files are skipped.
+PARSE_INCREMENTAL = False
+
+# Domains taken off the discovery frontier at a time (see frontier.py).
+FRONTIER_BATCH_SIZE = 100
+
+# How many distinct strings to remember domain validation results for.
+DOMAIN_CACHE_SIZE = 65536
+
+# Database connection pool (see db.py). Callers wait up to DB_POOL_TIMEOUT
+# seconds for a connection when all DB_POOL_MAX are checked out.
+DB_POOL_MIN = 1
+DB_POOL_MAX = 10
+DB_POOL_TIMEOUT = 30
+
+# Rows fetched at a time by server-side cursors on large scans.
+DB_ITERSIZE = 2000
+
+# Refresh the stored strong set graph at most this often, in seconds,
+# while parsers are writing (see strongset.py).
+STRONG_SET_INTERVAL = 300
+
+# Web page caching (see cache.py). Set RESPONSE_CACHE_DIR to share cached
+# pages between web server processes. Browsers and proxies may reuse a
+# page for RESPONSE_MAX_AGE seconds before checking its ETag.
+RESPONSE_CACHE_SIZE = 1000
+RESPONSE_CACHE_DIR = None
+RESPONSE_MAX_AGE = 60
+
+# Relationships on each page of a domain page or the JSON API (at most 1000).
+DOMAIN_PAGE_SIZE = 100
+
+# Most nodes and links the graph page gets at a time (see strongset.py).
+GRAPH_MAX_NODES = 100
+GRAPH_MAX_LINKS = 500
+
+# Node layout at strong set refresh time (see layout.py). Graphs with more
+# than LAYOUT_EXACT_NODES nodes are laid out with sampled repulsion.
+LAYOUT_ITERATIONS = 100
+LAYOUT_EXACT_NODES = 2000
+
+# How often, in seconds, a process's in-memory relationship graph picks up
+# changed rows, and reads the whole table again (see graph.py).
+GRAPH_RELOAD = 300
+GRAPH_FULL_RELOAD = 3600
+
+# Batch graph analytics (see analytics.py). Resale chains longer than
+# MAX_CHAIN_DEPTH, which only happen on loops, count as that long.
+PAGERANK_DAMPING = 0.85
+MAX_CHAIN_DEPTH = 10
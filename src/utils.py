@@ -1,70 +1,101 @@
 #!/usr/bin/env python3
 
 import base64
+from contextlib import contextmanager
 import hashlib
-import logging
 import os
 import shutil
-import socket
 from tempfile import NamedTemporaryFile
-import time
 from urllib.parse import quote_plus, unquote
 
+import manifest
+
 root = '/var/cache/eyeball'
 
-def url_to_path(url, category):
+def url_to_path(url, category, kind='latest'):
     tmp = hashlib.sha256(url.encode('utf-8')).digest()
     h = base64.urlsafe_b64encode(tmp).decode('ascii')
-    return os.path.join(root, category, h[0:2], h[2:4], h[4:6], 'latest', quote_plus(url))
+    return os.path.join(root, category, h[0:2], h[2:4], h[4:6], kind, quote_plus(url))
+
+def blob_path(digest):
+    return os.path.join(root, 'blobs', digest[0:2], digest[2:4], digest)
 
 def path_to_url(path):
     return unquote(os.path.basename(path))
 
 def get_all_urls(category):
     "return urls oldest to newest"
-    urls = {}
-    feeddir = os.path.join(config.ROOT, category)
-    for root, dirs, files in os.walk(feeddir):
-        for filename in files:
-            if filename[:4] != 'http':
-                continue
-            pathname = os.path.join(feeddir, filename)
-            timestamp = os.path.getmtime(pathname)
-            tmp = unquote(filename)
-            if not 'amp;amp' in tmp:
-                urls[tmp] = timestamp
-    return [x for x in sorted(urls, key=urls.get)]
-
-def snarf_file(url, category):
-    "Get a file content or empty string if nothing there."
-    filename = url_to_path(url, category)
+    return [url for url in manifest.manifest.urls(category) if not 'amp;amp' in url]
+
+def parse_headers(lines):
+    "Dict of HTTP response headers, with lowercase names, from lines up to the first blank one."
+    headers = {}
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line:
+            break
+        if ':' in line:
+            (name, value) = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    return headers
+
+def read_headers(filename):
+    "Get the HTTP response headers saved at the top of a mirrored file, with lowercase names."
     try:
         with open(filename, 'r', encoding='utf-8') as fdin:
-            return fdin.read()
-    except:
-        logging.warning("Could not find file for %s in category %s" % (url, category))
-        raise
-        return('')
+            return parse_headers(fdin)
+    except (FileNotFoundError, UnicodeDecodeError):
+        return {}
 
-def spew_file(filename, content):
+def body_hash(filename):
+    "sha256 of a mirrored file's body, not counting the saved headers."
+    h = hashlib.sha256()
+    with open(filename, 'rb') as fdin:
+        for line in fdin:
+            if not line.strip(b'\r\n'):
+                break
+        for chunk in iter(lambda: fdin.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+@contextmanager
+def spewing(filename, record=True):
+    """Yield a scratch file that replaces filename when the block finishes, or is removed on error.
+    Pass record=False to leave the manifest entry to the caller."""
     try:
         os.makedirs(os.path.split(filename)[0])
     except FileExistsError:
         pass
-    with NamedTemporaryFile(dir=os.path.dirname(filename), mode='w+',
-                            delete=False, encoding='utf-8') as scratch:
-        scratch.write(content)
+    scratch = NamedTemporaryFile(dir=os.path.dirname(filename), mode='w+',
+                                 delete=False, encoding='utf-8')
+    try:
+        with scratch:
+            yield scratch
+    except:
+        os.unlink(scratch.name)
+        raise
     os.replace(scratch.name, filename)
+    set_owner(filename)
+    if record:
+        manifest.manifest.record(filename)
+
+def set_owner(filename):
     try:
         shutil.chown(filename, user="rapids", group="rapids")
     except LookupError:
         pass
 
+def spew_file(filename, content):
+    with spewing(filename) as scratch:
+        scratch.write(content)
+
 def touch_file(filename):
     try:
         os.utime(filename, None)
     except FileNotFoundError:
         spew_file(filename, '')
+        return
+    manifest.manifest.touched(filename)
 
 
 # vim: set expandtab:
@@ -1,41 +1,176 @@
+from functools import wraps
 from hashlib import sha1
 import hmac
 import json
 import logging
 import os
 
-from flask import Flask, abort, flash, make_response, redirect, request, render_template, session, url_for
+from flask import (Flask, Response, abort, flash, make_response, redirect, request, render_template,
+                   session, url_for)
 
+from cache import RESPONSE_MAX_AGE
+from crawl import domain_to_url
 from eyeball import Eyeball
+from query import RANK_ORDERS, decode_key, encode_key
+from relationship import DOMAIN_PAGE_SIZE
+from store import mirror
+from strongset import GRAPH_MAX_LINKS, GRAPH_MAX_NODES
 
 # Basic setup
 app = Flask(__name__)
 app.config.from_pyfile('config.py')
 
+FILE_PAGE_MAX = 1024 * 1024  # characters of a mirrored file to show when its text is not stored
+
+def cached(content_type='text/html; charset=utf-8'):
+    "Serve the view's output from the response cache, with an ETag to answer If-None-Match with 304."
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            entry = eyeball.cache.get(request.full_path, lambda: view(*args, **kwargs), content_type)
+            response = make_response(entry.body)
+            response.headers['Content-Type'] = entry.content_type
+            response.headers['Cache-Control'] = 'public, max-age=%d' % RESPONSE_MAX_AGE
+            response.set_etag(entry.etag)
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
+
+def page_args():
+    "The after and limit arguments of a request for a page of relationships."
+    try:
+        after = request.args.get('after')
+        after = decode_key(after, 3) if after else None
+        limit = int(request.args.get('limit', DOMAIN_PAGE_SIZE))
+    except ValueError:
+        abort(400)
+    return (after, limit)
+
 @app.route('/site.css')
 def favicon():
     return app.send_static_file('site.css')
 
 @app.route('/')
 def home():
-    strongset = eyeball.relationship.strong_set()
     return render_template('graph.html')
 
 @app.route('/graph.js')
+@cached('application/javascript')
 def graph_js():
-    return 'window.graph = %s' % eyeball.relationship.strong_set()
+    return 'window.graph = %s' % json.dumps(eyeball.strongset.graph())
 
 @app.route('/graph.json')
+@cached('application/json')
 def graph_json():
-    return 'window.graph = %s' % eyeball.relationship.strong_set()
+    return json.dumps(eyeball.strongset.graph())
+
+@app.route('/api/graph/<domain>')
+@cached('application/json')
+def graph_api(domain):
+    "The strong set around domain. See StrongSet.neighborhood for the arguments."
+    try:
+        after = request.args.get('after')
+        if after:
+            (degree, name) = decode_key(after, 2)
+            after = (int(degree), name)
+        graph = eyeball.strongset.neighborhood(domain,
+                                               hops=int(request.args.get('hops', 1)),
+                                               max_nodes=int(request.args.get('nodes', GRAPH_MAX_NODES)),
+                                               max_links=int(request.args.get('links', GRAPH_MAX_LINKS)),
+                                               min_degree=int(request.args.get('min_degree', 1)),
+                                               after=after or None)
+    except ValueError:
+        abort(400)
+    if graph is None:
+        abort(404)
+    if graph['next']:
+        graph['next'] = encode_key((str(graph['next'][0]), graph['next'][1]))
+    return json.dumps(graph)
+
+@app.route('/api/overview')
+@cached('application/json')
+def overview_api():
+    "The whole strong set zoomed out, in cells. See StrongSet.overview."
+    try:
+        level = int(request.args.get('level', 5))
+    except ValueError:
+        abort(400)
+    return json.dumps(eyeball.strongset.overview(level))
+
+@app.route('/api/paths/<source>/<destination>')
+@cached('application/json')
+def paths_api(source, destination):
+    "Supply paths from source to destination, through links of kind 'both', 'adstxt' or 'sellersjson'."
+    kind = request.args.get('kind', 'both')
+    try:
+        hops = max(1, min(int(request.args.get('hops', 3)), 6))
+    except ValueError:
+        abort(400)
+    if kind not in ('both', 'adstxt', 'sellersjson'):
+        abort(400)
+    return json.dumps({'source': source, 'destination': destination,
+                       'paths': eyeball.graph.current().paths(source, destination, kind, hops)})
+
+@app.route('/api/rank')
+@cached('application/json')
+def rank_api():
+    "The domains with the highest pagerank, in_degree, out_degree or chain_depth. See analytics.py."
+    order = request.args.get('order', 'pagerank')
+    try:
+        limit = max(1, min(int(request.args.get('limit', 50)), 1000))
+        min_depth = int(request.args.get('min_depth', 0))
+    except ValueError:
+        abort(400)
+    if order not in RANK_ORDERS:
+        abort(400)
+    return json.dumps(eyeball.analytics.top(order, limit, min_depth))
+
+def domain_summary(domain):
+    "Relationship counts for domain, worked out once per cache generation for all of its pages."
+    entry = eyeball.cache.get('/summary/%s' % domain,
+                              lambda: json.dumps(eyeball.relationship.summary(domain)),
+                              'application/json')
+    return json.loads(entry.body.decode('utf-8'))
 
 @app.route('/domain/<domain>')
+@cached()
 def domain_page(domain):
-    rellist = eyeball.relationship.lookup_all(destination=domain) + eyeball.relationship.lookup_all(source=domain)
+    (after, limit) = page_args()
+    (rellist, next_key) = eyeball.relationship.domain_page(domain, after, limit)
+    next_url = None
+    if next_key:
+        next_url = url_for('domain_page', domain=domain, after=encode_key(next_key),
+                           limit=request.args.get('limit'))
     return render_template('domain.html',
-                            title=domain, rellist=rellist)
+                            title=domain, rellist=rellist, next_url=next_url,
+                            summary=domain_summary(domain),
+                            rank=eyeball.analytics.lookup(domain))
+
+@app.route('/api/domain/<domain>')
+def domain_api(domain):
+    '''
+    A page of a domain's relationships as JSON, with a token for the next page, or with
+    stream=1, all of them as one JSON object per line.
+    '''
+    if request.args.get('stream'):
+        def generate():
+            for rel in eyeball.relationship.iter_domain(domain):
+                yield json.dumps(rel.as_dict()) + '\n'
+        return Response(generate(), mimetype='application/x-ndjson')
+    return domain_json(domain)
+
+@cached('application/json')
+def domain_json(domain):
+    (after, limit) = page_args()
+    (rellist, next_key) = eyeball.relationship.domain_page(domain, after, limit)
+    return json.dumps({'domain': domain,
+                       'summary': domain_summary(domain),
+                       'rank': eyeball.analytics.lookup(domain),
+                       'relationships': [rel.as_dict() for rel in rellist],
+                       'next': encode_key(next_key) if next_key else None})
 
 @app.route('/adstxt/<domain>')
+@cached()
 def adstxt_page(domain):
     adstxt = eyeball.adstxt.lookup_one(domain = domain)
     if not adstxt:
@@ -47,14 +182,23 @@ def adstxt_page(domain):
                            meta=adstxt)
 
 @app.route('/sellersjson/<domain>')
+@cached()
 def sellers_page(domain):
     sellers = eyeball.sellers.lookup_one(domain = domain)
     if not sellers:
         abort(404)
+    filecontent = sellers.fulltext
+    if filecontent is None:
+        # not stored (see SELLERS_KEEP_FULLTEXT), so show the start of the mirrored copy
+        try:
+            with mirror.open_body(domain_to_url(domain, 'sellers'), 'sellers') as fdin:
+                filecontent = fdin.read(FILE_PAGE_MAX)
+        except FileNotFoundError:
+            filecontent = ''
     return render_template('file.html',
                            title='sellers.json file for %s' % domain,
                            filename='sellers.json',
-                           filecontent = sellers.fulltext,
+                           filecontent = filecontent,
                            meta=sellers)
 
 # startup stuff